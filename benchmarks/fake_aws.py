@@ -0,0 +1,376 @@
+"""In-process stand-ins for the Batch and SNS services, for load testing without AWS.
+
+The fakes answer the requests of real botocore clients from the botocore before-send
+event, so request serialisation, response parsing and botocore's retries all run as
+they do against AWS. Each fake adds a configurable latency to every request and can
+inject throttling, server errors (retried by botocore) and client errors (not retried).
+"""
+
+import collections
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+
+from botocore.awsrequest import AWSResponse
+
+ACCOUNT_ID = "000000000000"
+SNS_XML_NAMESPACE = "http://sns.amazonaws.com/doc/2010-03-31/"
+
+
+def get_snake_case(operation):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", operation).lower()
+
+
+class RawResponse(io.BytesIO):
+    """Response body in the shape botocore reads it from urllib3."""
+
+    def stream(self, **kwargs):
+        contents = self.read()
+        while contents:
+            yield contents
+            contents = self.read()
+
+
+class FakeAwsService:
+    """Base of the fake services, injecting latency and failures into every request.
+
+    Arguments:
+        latency_seconds (float): the mean latency added to every request
+        latency_jitter_seconds (float): latency is uniform within this of the mean
+        throttle_rate (float): the fraction of requests throttled
+        max_requests_per_second (float): requests above this rate are throttled (or None)
+        error_rate (float): the fraction of requests failing with a server error
+        client_error_rate (float): the fraction of requests failing with a client error
+        seed (int): seed for the random failures and latencies
+
+    """
+
+    service_name = None
+
+    def __init__(
+        self,
+        latency_seconds=0.0,
+        latency_jitter_seconds=0.0,
+        throttle_rate=0.0,
+        max_requests_per_second=None,
+        error_rate=0.0,
+        client_error_rate=0.0,
+        seed=None,
+    ):
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.throttle_rate = throttle_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.error_rate = error_rate
+        self.client_error_rate = client_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = max_requests_per_second or 0
+        self.tokens_updated_at = time.monotonic()
+        self.requests = collections.Counter()
+        self.retries = collections.Counter()
+        self.throttles = collections.Counter()
+        self.errors = collections.Counter()
+
+    def register(self, session):
+        """Answers the requests of every client the botocore session creates for the service."""
+        session.register(f"before-send.{self.service_name}", self.handle_request)
+
+    def handle_request(self, request, event_name, **kwargs):
+        operation = event_name.rsplit(".", 1)[-1]
+        attempt = self.get_attempt(request)
+
+        with self.lock:
+            self.requests[operation] += 1
+            if attempt > 1:
+                self.retries[operation] += 1
+            latency = max(
+                0.0,
+                self.latency_seconds
+                + self.random.uniform(
+                    -self.latency_jitter_seconds, self.latency_jitter_seconds
+                ),
+            )
+            failure = self.random.random()
+            throttled = failure < self.throttle_rate or not self.take_token()
+
+        if latency:
+            time.sleep(latency)
+
+        if throttled:
+            with self.lock:
+                self.throttles[operation] += 1
+            return self.generate_throttling_response(request)
+
+        if failure < self.throttle_rate + self.error_rate:
+            with self.lock:
+                self.errors[operation] += 1
+            return self.generate_error_response(
+                request, 500, self.server_error_code, "Injected server error"
+            )
+
+        if failure < self.throttle_rate + self.error_rate + self.client_error_rate:
+            with self.lock:
+                self.errors[operation] += 1
+            return self.generate_error_response(
+                request, 400, self.client_error_code, "Injected client error"
+            )
+
+        return self.generate_response(request, operation)
+
+    def take_token(self):
+        """Takes a token of the service side rate limit, returning False if there is none."""
+        if not self.max_requests_per_second:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(
+            self.max_requests_per_second,
+            self.tokens + (now - self.tokens_updated_at) * self.max_requests_per_second,
+        )
+        self.tokens_updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    @staticmethod
+    def get_attempt(request):
+        """Returns the attempt number botocore's standard retry mode sends with a request."""
+        header = request.headers.get("amz-sdk-request", b"attempt=1")
+        if isinstance(header, bytes):
+            header = header.decode()
+        for field in header.split(";"):
+            name, _, value = field.strip().partition("=")
+            if name == "attempt":
+                return int(value)
+        return 1
+
+    @staticmethod
+    def generate_http_response(request, status_code, headers, body):
+        return AWSResponse(
+            request.url, status_code, headers, RawResponse(body.encode("utf-8"))
+        )
+
+    def get_statistics(self):
+        return {
+            operation: {
+                "requests": self.requests[operation],
+                "retries": self.retries[operation],
+                "throttles": self.throttles[operation],
+                "errors": self.errors[operation],
+            }
+            for operation in sorted(self.requests)
+        }
+
+
+class FakeBatchService(FakeAwsService):
+    """Fake of the Batch API calls the launcher makes.
+
+    Submitted jobs run for job_seconds and then succeed. Every queue is ENABLED and
+    every job definition has a single ACTIVE revision.
+    """
+
+    service_name = "batch"
+    server_error_code = "ServerException"
+    client_error_code = "ClientException"
+
+    def __init__(self, job_seconds=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.job_seconds = job_seconds
+        self.jobs = collections.OrderedDict()
+
+    def generate_throttling_response(self, request):
+        return self.generate_error_response(
+            request, 429, "TooManyRequestsException", "Too Many Requests"
+        )
+
+    def generate_error_response(self, request, status_code, code, message):
+        return self.generate_http_response(
+            request,
+            status_code,
+            {"x-amzn-ErrorType": code, "x-amzn-RequestId": str(uuid.uuid4())},
+            json.dumps({"message": message}),
+        )
+
+    def generate_response(self, request, operation):
+        body = json.loads(request.body or b"{}")
+        body = getattr(self, f"handle_{get_snake_case(operation)}")(body)
+
+        return self.generate_http_response(
+            request, 200, {"x-amzn-RequestId": str(uuid.uuid4())}, json.dumps(body)
+        )
+
+    def handle_submit_job(self, body):
+        job_id = str(uuid.uuid4())
+        job = {
+            "jobId": job_id,
+            "jobName": body["jobName"],
+            "jobArn": f"arn:aws:batch:eu-west-2:{ACCOUNT_ID}:job/{job_id}",
+            "jobQueue": body["jobQueue"],
+            "jobDefinition": body["jobDefinition"],
+            "createdAt": int(time.time() * 1000),
+        }
+        if "arrayProperties" in body:
+            job["arrayProperties"] = {"size": body["arrayProperties"]["size"]}
+
+        with self.lock:
+            self.jobs[job_id] = job
+
+        return {key: job[key] for key in ("jobArn", "jobName", "jobId")}
+
+    def get_job_status(self, job):
+        now = int(time.time() * 1000)
+        if now - job["createdAt"] < self.job_seconds * 1000:
+            return "RUNNING", None
+        return "SUCCEEDED", job["createdAt"] + int(self.job_seconds * 1000)
+
+    def describe_job(self, job):
+        status, stopped_at = self.get_job_status(job)
+        description = dict(job, status=status, startedAt=job["createdAt"])
+        if stopped_at is not None:
+            description["stoppedAt"] = stopped_at
+        return description
+
+    def handle_describe_jobs(self, body):
+        with self.lock:
+            jobs = [self.jobs[job_id] for job_id in body["jobs"] if job_id in self.jobs]
+
+        return {"jobs": [self.describe_job(job) for job in jobs]}
+
+    def handle_list_jobs(self, body):
+        job_names = set()
+        for job_filter in body.get("filters", []):
+            if job_filter["name"] == "JOB_NAME":
+                job_names.update(job_filter["values"])
+
+        with self.lock:
+            jobs = list(self.jobs.values())
+
+        summaries = []
+        for job in jobs:
+            if job_names and job["jobName"] not in job_names:
+                continue
+            if not job_names and job["jobQueue"] != body.get("jobQueue"):
+                continue
+            status, stopped_at = self.get_job_status(job)
+            if not job_names and status != body.get("jobStatus", "RUNNING"):
+                continue
+            summary = {
+                key: job[key] for key in ("jobArn", "jobId", "jobName", "createdAt")
+            }
+            summary["status"] = status
+            summaries.append(summary)
+
+        return {"jobSummaryList": summaries}
+
+    def handle_describe_job_queues(self, body):
+        return {
+            "jobQueues": [
+                {
+                    "jobQueueName": job_queue,
+                    "jobQueueArn": f"arn:aws:batch:eu-west-2:{ACCOUNT_ID}:job-queue/{job_queue}",
+                    "state": "ENABLED",
+                    "status": "VALID",
+                    "priority": 1,
+                    "computeEnvironmentOrder": [],
+                }
+                for job_queue in body.get("jobQueues", [])
+            ]
+        }
+
+    def handle_describe_job_definitions(self, body):
+        job_definition = body.get("jobDefinitionName", "definition")
+        return {
+            "jobDefinitions": [
+                {
+                    "jobDefinitionName": job_definition,
+                    "jobDefinitionArn": f"arn:aws:batch:eu-west-2:{ACCOUNT_ID}:job-definition/{job_definition}:1",
+                    "revision": 1,
+                    "status": "ACTIVE",
+                    "type": "container",
+                }
+            ]
+        }
+
+
+class FakeSnsService(FakeAwsService):
+    """Fake of the SNS Publish and PublishBatch calls, keeping the published messages."""
+
+    service_name = "sns"
+    server_error_code = "InternalError"
+    client_error_code = "InvalidParameter"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = []
+        self.message_ids = itertools.count(1)
+
+    def generate_throttling_response(self, request):
+        return self.generate_error_response(request, 400, "Throttling", "Rate exceeded")
+
+    def generate_error_response(self, request, status_code, code, message):
+        error_type = "Receiver" if status_code >= 500 else "Sender"
+        return self.generate_http_response(
+            request,
+            status_code,
+            {},
+            f'<ErrorResponse xmlns="{SNS_XML_NAMESPACE}"><Error><Type>{error_type}</Type>'
+            f"<Code>{code}</Code><Message>{message}</Message></Error>"
+            f"<RequestId>{uuid.uuid4()}</RequestId></ErrorResponse>",
+        )
+
+    def generate_response(self, request, operation):
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        parameters = dict(parse_qsl(body or "", keep_blank_values=True))
+
+        if operation == "PublishBatch":
+            result = self.handle_publish_batch(parameters)
+        else:
+            result = self.handle_publish(parameters)
+
+        return self.generate_http_response(
+            request,
+            200,
+            {},
+            f'<{operation}Response xmlns="{SNS_XML_NAMESPACE}">'
+            f"<{operation}Result>{result}</{operation}Result>"
+            f"<ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId></ResponseMetadata>"
+            f"</{operation}Response>",
+        )
+
+    def publish(self, topic_arn, message):
+        with self.lock:
+            self.messages.append((topic_arn, message))
+            return f"message-{next(self.message_ids)}"
+
+    def handle_publish(self, parameters):
+        message_id = self.publish(parameters.get("TopicArn"), parameters["Message"])
+        return f"<MessageId>{message_id}</MessageId>"
+
+    def handle_publish_batch(self, parameters):
+        members = []
+        index = 1
+        while f"PublishBatchRequestEntries.member.{index}.Id" in parameters:
+            prefix = f"PublishBatchRequestEntries.member.{index}"
+            message_id = self.publish(
+                parameters.get("TopicArn"), parameters[f"{prefix}.Message"]
+            )
+            members.append(
+                f"<member><Id>{escape(parameters[f'{prefix}.Id'])}</Id>"
+                f"<MessageId>{message_id}</MessageId></member>"
+            )
+            index += 1
+
+        return f"<Successful>{''.join(members)}</Successful><Failed/>"
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Cold start import time benchmark of the launcher module.
+
+Imports the module in fresh interpreters with `python -X importtime` and reports the
+cumulative import time of the module together with its most expensive imports. Results
+can be appended to a json lines history file to track cold start cost over time.
+
+Usage:
+    PYTHONPATH=src python benchmarks/import_time.py [--runs 10] [--history FILE]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+MODULE = "batch_job_launcher_lambda.batch_job_launcher"
+
+
+def run_import(environment):
+    """Imports the module in a fresh interpreter, returning {module: cumulative_us}."""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        env=environment,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+        check=True,
+    )
+
+    timings = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:") :].split("|")
+        timings[name.strip()] = int(cumulative)
+
+    return timings
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--no-bytecode",
+        action="store_true",
+        help="Compile from source on every run, as a deployment without .pyc files does",
+    )
+    parser.add_argument("--history", help="Json lines file to append the result to")
+    parser.add_argument(
+        "--max-milliseconds",
+        type=float,
+        help="Exit with an error if the median import time is above this",
+    )
+    arguments = parser.parse_args()
+
+    environment = dict(os.environ)
+
+    with tempfile.TemporaryDirectory() as pycache_prefix:
+        if arguments.no_bytecode:
+            environment["PYTHONDONTWRITEBYTECODE"] = "1"
+        else:
+            # Keep the bytecode out of the source tree and warm it before measuring
+            environment.pop("PYTHONDONTWRITEBYTECODE", None)
+            environment["PYTHONPYCACHEPREFIX"] = pycache_prefix
+            run_import(environment)
+
+        runs = [run_import(environment) for _ in range(arguments.runs)]
+
+    totals = sorted(run[MODULE] for run in runs)
+    median_us = statistics.median(totals)
+    median_run = min(runs, key=lambda run: abs(run[MODULE] - median_us))
+
+    print(
+        f"{MODULE}: median {median_us / 1000:.1f}ms, "
+        f"min {totals[0] / 1000:.1f}ms, max {totals[-1] / 1000:.1f}ms "
+        f"over {arguments.runs} runs"
+    )
+    print("Most expensive imports (cumulative) in the median run:")
+    heaviest = sorted(
+        (item for item in median_run.items() if item[0] != MODULE),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    for name, cumulative in heaviest[: arguments.top]:
+        print(f"  {cumulative / 1000:>8.1f}ms  {name}")
+
+    if arguments.history:
+        result = {
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "git_commit": get_git_commit(),
+            "python_version": sys.version.split()[0],
+            "bytecode": not arguments.no_bytecode,
+            "runs": arguments.runs,
+            "median_us": median_us,
+            "min_us": totals[0],
+            "max_us": totals[-1],
+        }
+        with open(arguments.history, "a") as history_file:
+            history_file.write(json.dumps(result) + "\n")
+
+    if arguments.max_milliseconds and median_us / 1000 > arguments.max_milliseconds:
+        sys.exit(
+            f"Median import time {median_us / 1000:.1f}ms is above "
+            f"{arguments.max_milliseconds}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
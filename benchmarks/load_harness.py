@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""End-to-end load test of the launcher handler against in-process fake Batch and SNS.
+
+Replays a burst of synthetic Glue success events against `handler` at a target rate,
+either one event per invocation as Glue sends them or in SQS batches. The handler
+runs as one warm container with real botocore clients, whose requests are answered
+by the fakes in benchmarks/fake_aws.py, so nothing leaves the process and the harness
+runs offline. Reports throughput, invocation and event latency percentiles, and the
+requests, retries, throttles and errors each fake service saw.
+
+Launcher settings are passed as environment variables with --env, for example
+--env BATCH_SUBMIT_RATE_PER_SECOND=20 or --env BATCH_COALESCE_MAX_EVENTS=100.
+
+Usage:
+    PYTHONPATH=src python benchmarks/load_harness.py [--events 500] [--rate 250] \\
+        [--source sqs --batch-size 10] [--latency-ms 20] [--throttle-rate 0.05]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from fake_aws import FakeBatchService, FakeSnsService
+
+HARNESS_ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "eu-west-2",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "ENVIRONMENT": "load-test",
+    "APPLICATION": "batch_job_launcher_lambda",
+    "LOG_LEVEL": "CRITICAL",
+    "MONITORING_SNS_TOPIC": "arn:aws:sns:eu-west-2:000000000000:monitoring",
+    "BATCH_JOB_QUEUE": "athena-reconciliation-queue",
+    "BATCH_JOB_NAME": "athena-reconciliation",
+    "BATCH_JOB_DEFINITION_NAME": "athena-reconciliation-definition",
+}
+COLLECTIONS = ["db.core.contract", "db.core.claimant", "db.agent.todo", "db.other.log"]
+
+
+def generate_glue_events(count):
+    return [
+        {
+            "correlation_id": f"load_test_{index}",
+            "collection_name": COLLECTIONS[index % len(COLLECTIONS)],
+            "snapshot_type": "incremental",
+            "export_date": "2020-01-22",
+            "shutdown_flag": "true",
+            "reprocess_files": "true",
+        }
+        for index in range(count)
+    ]
+
+
+def generate_sqs_event(glue_events, first_index):
+    return {
+        "Records": [
+            {
+                "messageId": f"message-{first_index + offset}",
+                "eventSource": "aws:sqs",
+                "body": json.dumps(glue_event),
+            }
+            for offset, glue_event in enumerate(glue_events)
+        ]
+    }
+
+
+def invoke(batch_job_launcher, source, glue_events, first_index):
+    """Invokes the handler, returning the number of records that failed."""
+    if source == "sqs":
+        response = batch_job_launcher.handler(
+            generate_sqs_event(glue_events, first_index), None
+        )
+        return len(response["batchItemFailures"])
+
+    try:
+        batch_job_launcher.handler(glue_events[0], None)
+    except Exception:
+        return 1
+    return 0
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_percentiles(values):
+    return " ".join(
+        f"p{int(fraction * 100)} {percentile(values, fraction) * 1000:.1f}"
+        for fraction in (0.5, 0.95, 0.99)
+    ) + (f" max {max(values) * 1000:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Events per second, 0 for all at once"
+    )
+    parser.add_argument("--source", choices=("glue", "sqs"), default="glue")
+    parser.add_argument(
+        "--batch-size", type=int, default=10, help="Records per SQS invocation"
+    )
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--latency-jitter-ms", type=float, default=10)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--max-requests-per-second",
+        type=float,
+        help="Batch throttles requests above this rate",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--client-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Launcher environment variable, may be repeated",
+    )
+    parser.add_argument(
+        "--max-p99-ms",
+        type=float,
+        help="Exit with an error if the p99 invocation latency is above this",
+    )
+    parser.add_argument(
+        "--min-success-rate",
+        type=float,
+        help="Exit with an error if fewer events than this fraction were launched",
+    )
+    arguments = parser.parse_args()
+
+    os.environ.update(HARNESS_ENVIRONMENT)
+    os.environ.update(setting.split("=", 1) for setting in arguments.env)
+
+    from batch_job_launcher_lambda import batch_job_launcher
+
+    fake_batch = FakeBatchService(
+        latency_seconds=arguments.latency_ms / 1000,
+        latency_jitter_seconds=arguments.latency_jitter_ms / 1000,
+        throttle_rate=arguments.throttle_rate,
+        max_requests_per_second=arguments.max_requests_per_second,
+        error_rate=arguments.error_rate,
+        client_error_rate=arguments.client_error_rate,
+        seed=arguments.seed,
+    )
+    fake_sns = FakeSnsService(
+        latency_seconds=arguments.latency_ms / 1000,
+        latency_jitter_seconds=arguments.latency_jitter_ms / 1000,
+        seed=arguments.seed,
+    )
+    session = batch_job_launcher.get_aws_session()
+    fake_batch.register(session)
+    fake_sns.register(session)
+
+    batch_size = arguments.batch_size if arguments.source == "sqs" else 1
+    glue_events = generate_glue_events(arguments.events)
+    invocation_latencies = []
+    event_latencies = []
+    failed_events = 0
+
+    start = time.perf_counter()
+    for first_index in range(0, len(glue_events), batch_size):
+        batch = glue_events[first_index : first_index + batch_size]
+        arrivals = [
+            start + (first_index + offset) / arguments.rate if arguments.rate else start
+            for offset in range(len(batch))
+        ]
+
+        # An invocation starts once its last event has arrived
+        delay = arrivals[-1] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        invocation_start = time.perf_counter()
+        failed_events += invoke(
+            batch_job_launcher, arguments.source, batch, first_index
+        )
+        finish = time.perf_counter()
+
+        invocation_latencies.append(finish - invocation_start)
+        event_latencies.extend(finish - arrival for arrival in arrivals)
+
+    elapsed = time.perf_counter() - start
+    success_rate = 1 - failed_events / len(glue_events)
+
+    print(
+        f"{len(glue_events)} events in {len(invocation_latencies)} invocations, "
+        f"{failed_events} failed ({success_rate:.1%} launched)"
+    )
+    print(f"throughput: {len(glue_events) / elapsed:.1f} events/s over {elapsed:.2f}s")
+    print(f"invocation latency ms: {format_percentiles(invocation_latencies)}")
+    print(f"event latency ms: {format_percentiles(event_latencies)}")
+    print(
+        f"{'api call':<28}{'requests':>10}{'retries':>10}{'throttles':>10}{'errors':>10}"
+    )
+    for service in (fake_batch, fake_sns):
+        for operation, statistics in service.get_statistics().items():
+            print(
+                f"{service.service_name + ' ' + operation:<28}"
+                + "".join(
+                    f"{statistics[name]:>10}"
+                    for name in ("requests", "retries", "throttles", "errors")
+                )
+            )
+
+    p99_ms = percentile(invocation_latencies, 0.99) * 1000
+    if arguments.max_p99_ms and p99_ms > arguments.max_p99_ms:
+        sys.exit(
+            f"p99 invocation latency {p99_ms:.1f}ms is above {arguments.max_p99_ms}ms"
+        )
+    if arguments.min_success_rate and success_rate < arguments.min_success_rate:
+        sys.exit(
+            f"{success_rate:.1%} of events launched, below {arguments.min_success_rate:.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""Microbenchmark of the per-invocation logging cost of the launcher.
+
+Compares the previous eager style (f-string messages with payloads double encoded by
+json.dumps before the level check) with the structured JsonFormatter, where extra fields
+are only serialised for records that are emitted.
+
+Usage:
+    PYTHONPATH=src python benchmarks/logging_benchmark.py [--iterations 20000]
+"""
+
+import argparse
+import json
+import logging
+import os
+import timeit
+
+from batch_job_launcher_lambda import batch_job_launcher
+
+EVENT = {
+    "correlation_id": "test_1",
+    "collection_name": "db.test.collection",
+    "snapshot_type": "incremental",
+    "export_date": "2020-01-22",
+    "shutdown_flag": "true",
+    "reprocess_files": "true",
+}
+PARAMETERS = {"collection": "db.test.collection", "date": "2020-01-22"}
+JOB_QUEUE = "athena-reconciliation-queue"
+JOB_NAME = "athena-reconciliation"
+JOB_DEFINITION_NAME = "athena-reconciliation-definition"
+JOB_ARN = "arn:aws:batch:eu-west-2:000000000000:job/00000000"
+JOB_ID = "00000000-0000-0000-0000-000000000000"
+
+
+def get_escaped_json_string(json_string):
+    try:
+        escaped_string = json.dumps(json.dumps(json_string))
+    except:
+        escaped_string = json.dumps(json_string)
+
+    return escaped_string
+
+
+def log_invocation_eagerly(logger):
+    """The log lines of one successful invocation in the previous eager style."""
+    dumped_event = get_escaped_json_string(EVENT)
+    logger.info(f'SNS Event", "sns_event": {dumped_event}, "mode": "handler')
+    logger.info(
+        f'Submitting batch job", "job_definition_name": "{JOB_DEFINITION_NAME}", '
+        + f'"job_queue": "{JOB_QUEUE}", "job_name": "{JOB_NAME}", "parameters": "{PARAMETERS}'
+    )
+    logger.info(
+        f'Batch job submitted successfully", '
+        + f'"job_queue": "{JOB_QUEUE}", "job_name": "{JOB_NAME}", '
+        + f'"job_definition_name": "{JOB_DEFINITION_NAME}", '
+        + f'"job_arn": "{JOB_ARN}", "job_id": "{JOB_ID}'
+    )
+
+
+def log_invocation_lazily(logger):
+    """The log lines of one successful invocation with structured extra fields."""
+    logger.info("SNS Event", extra={"sns_event": EVENT, "mode": "handler"})
+    logger.info(
+        "Submitting batch job",
+        extra={
+            "job_definition_name": JOB_DEFINITION_NAME,
+            "job_queue": JOB_QUEUE,
+            "job_name": JOB_NAME,
+            "parameters": PARAMETERS,
+        },
+    )
+    logger.info(
+        "Batch job submitted successfully",
+        extra={
+            "job_queue": JOB_QUEUE,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+            "job_arn": JOB_ARN,
+            "job_id": JOB_ID,
+        },
+    )
+
+
+def create_logger(name, formatter, level):
+    the_logger = logging.getLogger(name)
+    the_logger.propagate = False
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(formatter)
+    the_logger.addHandler(handler)
+    the_logger.setLevel(level)
+    return the_logger
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    iterations = parser.parse_args().iterations
+
+    eager_formatter = logging.Formatter(
+        '{ "timestamp": "%(asctime)s", "log_level": "%(levelname)s", "message": "%(message)s", '
+        '"environment": "dev", "application": "benchmark", '
+        '"module": "%(module)s", "process":"%(process)s", '
+        '"thread": "[%(thread)s]", "host": "localhost" }'
+    )
+    lazy_formatter = batch_job_launcher.JsonFormatter("dev", "benchmark", "localhost")
+
+    print(f"{'level':<10}{'eager us/invocation':>22}{'lazy us/invocation':>22}")
+    for level in ("INFO", "WARNING"):
+        eager_logger = create_logger(f"eager_{level}", eager_formatter, level)
+        lazy_logger = create_logger(f"lazy_{level}", lazy_formatter, level)
+
+        eager_seconds = timeit.timeit(
+            lambda: log_invocation_eagerly(eager_logger), number=iterations
+        )
+        lazy_seconds = timeit.timeit(
+            lambda: log_invocation_lazily(lazy_logger), number=iterations
+        )
+
+        print(
+            f"{level:<10}{eager_seconds / iterations * 1e6:>22.2f}"
+            f"{lazy_seconds / iterations * 1e6:>22.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""Replays an event trace through a simulated Batch queue to compare scheduling policies.
+
+Each event is given the schedulingPriorityOverride and shareIdentifier the launcher's
+scheduling rules (BATCH_SCHEDULING_RULES_JSON) assign it. The jobs then run on a fixed
+number of slots, scheduled like a Batch fair share queue. A share with a lower running
+job count multiplied by its weight factor is served first, and within a share the
+highest priority is served first, then the earliest arrival. Without rules the queue is
+FIFO, as a queue without a fair share policy is. The completion latency (arrival to
+finish) is reported per event class.
+
+The trace is a json lines file of {"arrival_seconds", "duration_seconds", "event"}, or
+a synthetic trace of full and incremental snapshots can be generated.
+
+Usage:
+    PYTHONPATH=src python benchmarks/scheduling_simulator.py --generate 2000 \\
+        --rules rules.json [--slots 20] [--share-weights '{"full": 2}']
+"""
+
+import argparse
+import heapq
+import json
+import random
+import statistics
+
+from batch_job_launcher_lambda import batch_job_launcher
+
+COLLECTIONS = ["db.core.contract", "db.core.claimant", "db.agent.todo", "db.other.log"]
+
+
+def read_trace(path):
+    with open(path, "r") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def generate_trace(count, window_seconds, full_fraction, seed):
+    """Generates a trace of incremental snapshots with a share of long full snapshots."""
+    generator = random.Random(seed)
+    trace = []
+
+    for index in range(count):
+        full = generator.random() < full_fraction
+        trace.append(
+            {
+                "arrival_seconds": generator.uniform(0, window_seconds),
+                "duration_seconds": (
+                    generator.uniform(1200, 2400)
+                    if full
+                    else generator.uniform(60, 180)
+                ),
+                "event": {
+                    "correlation_id": f"simulated_{index}",
+                    "collection_name": generator.choice(COLLECTIONS),
+                    "snapshot_type": "full" if full else "incremental",
+                },
+            }
+        )
+
+    return trace
+
+
+def simulate(trace, compiled_rules, slots, share_weights, class_field):
+    """Runs the trace through the simulated queue.
+
+    Returns:
+        dict: the completion latencies in seconds by event class
+
+    """
+    jobs = []
+    for order, entry in enumerate(sorted(trace, key=lambda e: e["arrival_seconds"])):
+        hints = batch_job_launcher.match_scheduling_rules(
+            compiled_rules, entry["event"]
+        )
+        jobs.append(
+            {
+                "order": order,
+                "arrival": entry["arrival_seconds"],
+                "duration": entry["duration_seconds"],
+                "priority": hints.get("scheduling_priority", 0),
+                "share": hints.get("share_identifier"),
+                "class": str(entry["event"].get(class_field)),
+            }
+        )
+
+    fifo = not compiled_rules
+    running = []
+    running_by_share = {}
+    runnable = []
+    latencies = {}
+    next_arrival = 0
+    now = 0.0
+
+    while next_arrival < len(jobs) or runnable or running:
+        arrival_time = (
+            jobs[next_arrival]["arrival"] if next_arrival < len(jobs) else float("inf")
+        )
+        finish_time = running[0][0] if running else float("inf")
+        now = min(arrival_time, finish_time)
+
+        while running and running[0][0] <= now:
+            _, _, job = heapq.heappop(running)
+            running_by_share[job["share"]] -= 1
+            latencies.setdefault(job["class"], []).append(now - job["arrival"])
+
+        while next_arrival < len(jobs) and jobs[next_arrival]["arrival"] <= now:
+            runnable.append(jobs[next_arrival])
+            next_arrival += 1
+
+        while runnable and len(running) < slots:
+            if fifo:
+                job = min(runnable, key=lambda candidate: candidate["order"])
+            else:
+                job = min(
+                    runnable,
+                    key=lambda candidate: (
+                        running_by_share.get(candidate["share"], 0)
+                        * share_weights.get(candidate["share"], 1),
+                        -candidate["priority"],
+                        candidate["order"],
+                    ),
+                )
+            runnable.remove(job)
+            running_by_share[job["share"]] = running_by_share.get(job["share"], 0) + 1
+            heapq.heappush(running, (now + job["duration"], job["order"], job))
+
+    return latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", help="Json lines trace to replay")
+    parser.add_argument(
+        "--generate", type=int, default=2000, help="Events to generate without --trace"
+    )
+    parser.add_argument("--generate-window-seconds", type=float, default=4 * 3600)
+    parser.add_argument("--generate-full-fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--rules", help="Json file of scheduling rules, as BATCH_SCHEDULING_RULES_JSON"
+    )
+    parser.add_argument("--slots", type=int, default=20)
+    parser.add_argument(
+        "--share-weights",
+        default="{}",
+        help="Json dict of share identifier to weight factor, lower is served more",
+    )
+    parser.add_argument("--class-field", default="snapshot_type")
+    arguments = parser.parse_args()
+
+    if arguments.trace:
+        trace = read_trace(arguments.trace)
+    else:
+        trace = generate_trace(
+            arguments.generate,
+            arguments.generate_window_seconds,
+            arguments.generate_full_fraction,
+            arguments.seed,
+        )
+
+    compiled_rules = []
+    if arguments.rules:
+        with open(arguments.rules, "r") as rules_file:
+            compiled_rules = batch_job_launcher.compile_scheduling_rules(
+                json.load(rules_file)
+            )
+
+    latencies = simulate(
+        trace,
+        compiled_rules,
+        arguments.slots,
+        json.loads(arguments.share_weights),
+        arguments.class_field,
+    )
+
+    print(f"policy: {'rules' if compiled_rules else 'fifo'}, {len(trace)} events")
+    print(f"{'class':<20}{'count':>8}{'p50 s':>12}{'p95 s':>12}{'max s':>12}")
+    for event_class, values in sorted(latencies.items()):
+        print(
+            f"{event_class:<20}{len(values):>8}"
+            f"{statistics.median(values):>12.0f}"
+            f"{percentile(values, 0.95):>12.0f}{max(values):>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,8 @@ setuptools.setup(
     entry_points={"console_scripts": ["batch_job_trigger=batch_job_launcher:main"]},
     package_dir={"": "src"},
     packages=setuptools.find_packages("src"),
-    install_requires=["argparse", "boto3"],
+    install_requires=["argparse", "botocore"],
+    extras_require={"yaml": ["PyYAML"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
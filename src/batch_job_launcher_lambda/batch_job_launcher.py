@@ -1,211 +1,5213 @@
 #!/usr/bin/env python3
 
 """batch_job_launcher_lambda"""
-import argparse
-import boto3
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
+import string
 import sys
 import socket
-import botocore
+import threading
+import time
+import types
+import botocore.config
+import botocore.exceptions
+import botocore.session
 
 UNSET_TEXT = "NOT_SET"
 
+# Defaults for the parameters that can also be given on the command line when run locally
+COMMAND_LINE_DEFAULTS = {
+    "aws_profile": "default",
+    "aws_region": "eu-west-2",
+    "sns_topic": None,
+    "environment": UNSET_TEXT,
+    "application": UNSET_TEXT,
+    "slack_channel_override": UNSET_TEXT,
+    "log_level": "INFO",
+}
+
+# Environment variables the config is built from, any change to these invalidates the cache
+CONFIG_ENVIRONMENT_VARIABLES = (
+    "AWS_PROFILE",
+    "AWS_REGION",
+    "ENVIRONMENT",
+    "APPLICATION",
+    "MONITORING_SNS_TOPIC",
+    "MONITORING_ERRORS_SEVERITY",
+    "MONITORING_ERRORS_TYPE",
+    "SLACK_CHANNEL_OVERRIDE",
+    "BATCH_JOB_QUEUE",
+    "BATCH_JOB_NAME",
+    "BATCH_JOB_DEFINITION_NAME",
+    "BATCH_PARAMETERS_JSON",
+    "LOG_LEVEL",
+    "BATCH_SUBMIT_CONCURRENCY",
+    "BATCH_JOB_NAME_TEMPLATE",
+    "BATCH_PARAMETERS_TEMPLATE_JSON",
+    "IDEMPOTENCY_KEY_FIELDS",
+    "IDEMPOTENCY_TTL_SECONDS",
+    "IDEMPOTENCY_CACHE_SIZE",
+    "IDEMPOTENCY_STORE_PATH",
+    "BATCH_COALESCE_MAX_EVENTS",
+    "BATCH_COALESCE_WINDOW_SECONDS",
+    "BATCH_SUBMIT_RATE_PER_SECOND",
+    "BATCH_SUBMIT_BURST",
+    "SNS_PUBLISH_RATE_PER_SECOND",
+    "SNS_PUBLISH_BURST",
+    "BATCH_JOB_QUEUES",
+    "BATCH_QUEUE_DEPTH_TTL_SECONDS",
+    "BATCH_QUEUE_MAX_DEPTH",
+    "BATCH_QUEUE_DEPTH_ACTION",
+    "METRICS_NAMESPACE",
+    "PROFILE_SAMPLE_RATE",
+    "PROFILE_TOP_N",
+    "PROFILE_TRACE_MEMORY",
+    "JOB_TRACKING_SECONDS",
+    "JOB_TRACKING_MIN_INTERVAL_SECONDS",
+    "JOB_TRACKING_MAX_INTERVAL_SECONDS",
+    "ALERT_AGGREGATION",
+    "ALERT_COOLDOWN_SECONDS",
+    "CIRCUIT_BREAKER_FAILURE_THRESHOLD",
+    "CIRCUIT_BREAKER_RESET_SECONDS",
+    "CIRCUIT_BREAKER_STORE_PATH",
+    "DEFERRAL_QUEUE_URL",
+    "DEFERRAL_DELAY_SECONDS",
+    "BATCH_METADATA_TTL_SECONDS",
+    "BATCH_SUBMIT_ENGINE",
+    "BATCH_ROUTING_CONFIG",
+    "BATCH_SCHEDULING_RULES_JSON",
+    "BATCH_PIPELINE_JSON",
+    "OUTBOX_STORE_PATH",
+    "OUTBOX_LEASE_SECONDS",
+    "OUTBOX_RETENTION_SECONDS",
+    "BATCH_PARAMETERS_OFFLOAD_URI",
+    "BATCH_PARAMETERS_OFFLOAD_THRESHOLD_BYTES",
+    "GLUE_EVENT_SCHEMA_JSON",
+)
+
+# Every field of the config, those only set from the command line are None in the lambda
+CONFIG_FIELDS = (
+    "aws_profile",
+    "aws_region",
+    "sns_topic",
+    "environment",
+    "application",
+    "monitoring_sns_topic",
+    "severity",
+    "notification_type",
+    "slack_channel_override",
+    "batch_job_queue",
+    "batch_job_name",
+    "batch_job_definition_name",
+    "batch_parameters_json",
+    "log_level",
+    "batch_submit_concurrency",
+    "batch_job_name_template",
+    "batch_parameters_template_json",
+    "idempotency_key_fields",
+    "idempotency_ttl_seconds",
+    "idempotency_cache_size",
+    "idempotency_store_path",
+    "batch_coalesce_max_events",
+    "batch_coalesce_window_seconds",
+    "batch_submit_rate_per_second",
+    "batch_submit_burst",
+    "sns_publish_rate_per_second",
+    "sns_publish_burst",
+    "batch_job_queues",
+    "batch_queue_depth_ttl_seconds",
+    "batch_queue_max_depth",
+    "batch_queue_depth_action",
+    "metrics_namespace",
+    "profile_sample_rate",
+    "profile_top_n",
+    "profile_trace_memory",
+    "job_tracking_seconds",
+    "job_tracking_min_interval_seconds",
+    "job_tracking_max_interval_seconds",
+    "alert_aggregation",
+    "alert_cooldown_seconds",
+    "circuit_breaker_failure_threshold",
+    "circuit_breaker_reset_seconds",
+    "circuit_breaker_store_path",
+    "deferral_queue_url",
+    "deferral_delay_seconds",
+    "batch_metadata_ttl_seconds",
+    "batch_submit_engine",
+    "batch_routing_config",
+    "batch_scheduling_rules_json",
+    "batch_pipeline_json",
+    "outbox_store_path",
+    "outbox_lease_seconds",
+    "outbox_retention_seconds",
+    "batch_parameters_offload_uri",
+    "batch_parameters_offload_threshold_bytes",
+    "glue_event_schema_json",
+    "backfill_events",
+    "backfill_collections",
+    "backfill_start_date",
+    "backfill_end_date",
+    "backfill_snapshot_type",
+    "backfill_checkpoint",
+    "backfill_chunk_size",
+    "backfill_concurrency",
+    "backfill_rate_per_second",
+    "backfill_track_jobs",
+    "sweep_outbox",
+)
+
+# Config fields that must be set, with the environment variable that sets them
+REQUIRED_CONFIG_FIELDS = (
+    ("monitoring_sns_topic", "MONITORING_SNS_TOPIC"),
+    ("batch_job_queue", "BATCH_JOB_QUEUE"),
+    ("batch_job_definition_name", "BATCH_JOB_DEFINITION_NAME"),
+)
+BATCH_SUBMIT_ENGINES = ("threads", "asyncio")
+BATCH_QUEUE_DEPTH_ACTIONS = ("defer", "reject")
+
+# Attributes every log record has, anything else on a record was passed via extra
+STANDARD_LOG_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", logging.INFO, "", 0, "", (), None).__dict__
+) | {"message", "asctime"}
+
+# Error codes AWS uses when a call is throttled
+THROTTLING_ERROR_CODES = frozenset(
+    [
+        "TooManyRequestsException",
+        "ThrottlingException",
+        "Throttling",
+        "ThrottledException",
+        "RequestLimitExceeded",
+    ]
+)
+
+# Errors botocore raises when the service could not be reached or did not answer in time
+CONNECTION_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+)
+
+# CloudWatch accepts at most this many values per metric in one embedded metric format line
+MAX_METRIC_VALUES_PER_LINE = 100
+
+# AWS Batch job names may only contain letters, numbers, hyphens and underscores
+INVALID_JOB_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_-]")
+MAX_JOB_NAME_LENGTH = 128
+
+# AWS Batch array jobs have at most this many children
+MAX_ARRAY_SIZE = 10000
+
+# Job parameter carrying the json manifest of coalesced events for array jobs
+ARRAY_MANIFEST_PARAMETER = "manifest"
+
+# Job statuses AWS Batch does not move a job on from
+TERMINAL_JOB_STATUSES = frozenset(["SUCCEEDED", "FAILED"])
+
+# DescribeJobs and DescribeJobQueues accept at most this many jobs or queues per call
+MAX_DESCRIBE_JOBS = 100
+MAX_DESCRIBE_JOB_QUEUES = 100
+
+# Queue depth is counted up to this many RUNNABLE jobs when no max depth is set
+MAX_COUNTED_QUEUE_DEPTH = 1000
+
+# States of the circuit breaker around batch job submission
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# SendMessageBatch accepts at most this many messages per call, and delays up to 15 minutes
+MAX_SEND_MESSAGE_BATCH_ENTRIES = 10
+MAX_SQS_DELAY_SECONDS = 900
+
+# PublishBatch accepts at most this many messages per call
+MAX_PUBLISH_BATCH_ENTRIES = 10
+
+# Seconds of the lambda timeout left over after tracking jobs to finish the invocation
+JOB_TRACKING_MARGIN_SECONDS = 5
+
+# Job spec fields a routing config may set, anything not set comes from the BATCH_JOB_* config
+ROUTING_JOB_SPEC_FIELDS = frozenset(
+    [
+        "job_queue",
+        "job_name",
+        "job_name_template",
+        "job_definition_name",
+        "parameters",
+        "parameters_template",
+    ]
+)
+
+# Fields of a pipeline stage, a job spec with a stage name and the stages it depends on
+PIPELINE_STAGE_FIELDS = ROUTING_JOB_SPEC_FIELDS | frozenset(["stage", "depends_on"])
+
+# The only dependency type between stages, child N of an array job waiting on child N
+PIPELINE_DEPENDENCY_TYPES = frozenset(["N_TO_N"])
+
+# Collection patterns with this prefix are regular expressions, ones ending with * prefixes
+ROUTING_REGEX_PREFIX = "re:"
+ROUTING_PREFIX_WILDCARD = "*"
+
+# Placeholder job id for idempotency keys whose submission is still in flight
+PENDING_JOB_ID = "PENDING"
+
+# Outbox entry states, and how far a job's createdAt may precede its entry's clock
+OUTBOX_PENDING = "pending"
+OUTBOX_DONE = "done"
+OUTBOX_CLOCK_SKEW_SECONDS = 60
+
+# Event key of scheduled invocations that sweep the outbox instead of launching jobs
+OUTBOX_SWEEP_EVENT_KEY = "outbox_sweep"
+
+# The only parameter of jobs whose parameters were offloaded, holding their location
+OFFLOADED_PARAMETERS_PARAMETER = "parameters_uri"
+
+
+class SubmissionDeferredError(Exception):
+    """Raised when a submission is held back locally and the event should be retried later."""
+
+
+class SubmissionRejectedError(Exception):
+    """Raised when a submission is refused locally without calling Batch."""
+
+
+class ConfigError(Exception):
+    """Raised when the config from the environment is incomplete or invalid."""
+
+
+class InvalidEventError(Exception):
+    """Raised when an event fails validation, so retrying it cannot succeed."""
+
+
+class Config:
+    """Immutable config, built and validated once per container.
+
+    Fields are slots so reading them costs no more than on a plain object, and setting
+    one raises. Use replace to derive a config with some fields changed.
+    """
+
+    __slots__ = CONFIG_FIELDS
+
+    def __init__(self, **values):
+        unknown_fields = set(values).difference(CONFIG_FIELDS)
+        if unknown_fields:
+            raise TypeError(f"Unknown config fields {sorted(unknown_fields)}")
+
+        for field in CONFIG_FIELDS:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Config is immutable, use replace to change {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Config is immutable, {name} cannot be deleted")
+
+    def replace(self, **changes):
+        """Returns a copy of the config with the given fields changed."""
+        return Config(**{**self.as_dict(), **changes})
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in CONFIG_FIELDS}
+
+    def __repr__(self):
+        return f"Config({self.as_dict()})"
+
+
 args = None
 logger = None
+command_line_arguments = {}
+aws_session = None
+compiled_templates = {}
+idempotency_cache = None
+idempotency_store = None
+idempotency_store_factory = None
+idempotency_lock = threading.Lock()
+# Guards the state built on first use, which pool workers may ask for at the same time
+cached_state_lock = threading.RLock()
+outbox_store = None
+outbox_store_factory = None
+parameter_offloader = None
+event_validator = None
+batch_submit_rate_limiter = None
+sns_publish_rate_limiter = None
+queue_router = None
+batch_metadata_cache = None
+routing_index = None
+scheduling_rules = None
+pipeline_stages = None
+metrics = None
+alert_aggregator = None
+submit_circuit_breaker = None
+config_fingerprint = None
+batch_client = None
+sns_client = None
+sqs_client = None
+s3_client = None
 
 boto_client_config = botocore.config.Config(
     max_pool_connections=100, retries={"max_attempts": 10, "mode": "standard"}
 )
 
 
-# Initialise logging
-def setup_logging(logger_level):
-    """Set the default logger with json output."""
-    the_logger = logging.getLogger()
-    for old_handler in the_logger.handlers:
-        the_logger.removeHandler(old_handler)
+class JsonFormatter(logging.Formatter):
+    """Formats log records as single line json.
+
+    Fields passed to the logger via extra are only serialised when the record is
+    emitted, so log lines below the configured level cost no json encoding.
+    """
+
+    def __init__(self, environment, application, hostname):
+        super().__init__()
+        self.environment = environment
+        self.application = application
+        self.hostname = hostname
+        self.encoder = json.JSONEncoder(default=str)
+        self.formatted_second = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        """Formats the record time, reusing the formatted date and time within a second."""
+        second = int(record.created)
+        cached_second, formatted = self.formatted_second
+
+        if second != cached_second:
+            formatted = time.strftime(self.default_time_format, self.converter(second))
+            self.formatted_second = (second, formatted)
+
+        return f"{formatted},{int(record.msecs):03d}"
+
+    def format(self, record):
+        log_entry = {
+            "timestamp": self.formatTime(record),
+            "log_level": record.levelname,
+            "message": record.getMessage(),
+            "environment": self.environment,
+            "application": self.application,
+            "module": record.module,
+            "process": record.process,
+            "thread": f"[{record.thread}]",
+            "host": self.hostname,
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_LOG_RECORD_ATTRIBUTES:
+                log_entry[key] = value
+
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+
+        return self.encoder.encode(log_entry)
+
+
+# Initialise logging
+def setup_logging(logger_level, config):
+    """Set the default logger with json output."""
+    the_logger = logging.getLogger()
+    for old_handler in the_logger.handlers:
+        the_logger.removeHandler(old_handler)
+
+    new_handler = logging.StreamHandler(sys.stdout)
+    hostname = socket.gethostname()
+
+    new_handler.setFormatter(
+        JsonFormatter(config.environment, config.application, hostname)
+    )
+    the_logger.addHandler(new_handler)
+    new_level = logging.getLevelName(logger_level)
+    the_logger.setLevel(new_level)
+
+    if the_logger.isEnabledFor(logging.DEBUG):
+        # Log everything from botocore through the json handler
+        logging.getLogger("botocore").setLevel(logging.DEBUG)
+        the_logger.debug(
+            "Using botocore",
+            extra={"version": botocore.__version__},
+        )
+
+    return the_logger
+
+
+def parse_command_line_arguments():
+    """Parse the supplied command line arguments, only used when run locally.
+
+    argparse is imported here as the lambda never parses a command line.
+
+    Returns:
+        dict: The parsed command line arguments
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Launch batch jobs from glue success events"
+    )
+
+    # Parse command line inputs and set defaults
+    parser.add_argument("--aws-profile", default=COMMAND_LINE_DEFAULTS["aws_profile"])
+    parser.add_argument("--aws-region", default=COMMAND_LINE_DEFAULTS["aws_region"])
+    parser.add_argument("--sns-topic", help="SNS topic ARN")
+    parser.add_argument(
+        "--environment",
+        help="Environment value",
+        default=COMMAND_LINE_DEFAULTS["environment"],
+    )
+    parser.add_argument(
+        "--application",
+        help="Application",
+        default=COMMAND_LINE_DEFAULTS["application"],
+    )
+    parser.add_argument(
+        "--slack-channel-override",
+        help="Slack channel to use for overriden jobs",
+        default=COMMAND_LINE_DEFAULTS["slack_channel_override"],
+    )
+    parser.add_argument(
+        "--log-level",
+        help="Log level for lambda",
+        default=COMMAND_LINE_DEFAULTS["log_level"],
+    )
+
+    backfill = parser.add_argument_group(
+        "backfill", "Submit jobs for many glue events instead of resources/event.json"
+    )
+    backfill.add_argument(
+        "--backfill-events", help="Json lines file of glue events to submit"
+    )
+    backfill.add_argument(
+        "--backfill-collections",
+        help="Comma separated collections to generate glue events for",
+    )
+    backfill.add_argument(
+        "--backfill-start-date", help="First export date to generate, YYYY-MM-DD"
+    )
+    backfill.add_argument(
+        "--backfill-end-date", help="Last export date to generate, YYYY-MM-DD"
+    )
+    backfill.add_argument(
+        "--backfill-snapshot-type",
+        help="Snapshot type of the generated glue events",
+        default="incremental",
+    )
+    backfill.add_argument(
+        "--backfill-checkpoint",
+        help="File recording the submitted events, so a rerun resumes where it stopped",
+        default="backfill.checkpoint",
+    )
+    backfill.add_argument(
+        "--backfill-chunk-size",
+        help="Events submitted between checkpoints",
+        type=int,
+        default=100,
+    )
+    backfill.add_argument(
+        "--backfill-concurrency",
+        help="Overrides BATCH_SUBMIT_CONCURRENCY",
+        type=int,
+    )
+    backfill.add_argument(
+        "--backfill-rate-per-second",
+        help="Overrides BATCH_SUBMIT_RATE_PER_SECOND",
+        type=float,
+    )
+    backfill.add_argument(
+        "--backfill-track-jobs",
+        help="Wait for the submitted jobs to finish, alerting on failures",
+        action="store_true",
+    )
+
+    outbox = parser.add_argument_group(
+        "outbox", "Reconcile the outbox at OUTBOX_STORE_PATH instead of submitting jobs"
+    )
+    outbox.add_argument(
+        "--sweep-outbox",
+        help="Complete or resubmit the pending outbox entries whose lease expired",
+        action="store_true",
+    )
+
+    return vars(parser.parse_args())
+
+
+def get_parameters():
+    """Build the parameters from the command line defaults and environment variables.
+
+    Returns:
+        Config: The parameters, starting from any parsed command line arguments
+
+    Raises:
+        ConfigError: listing every environment variable that could not be parsed
+
+    """
+    _args = types.SimpleNamespace(**{**COMMAND_LINE_DEFAULTS, **command_line_arguments})
+    errors = []
+
+    # Override arguments with environment variables where set
+    if "AWS_PROFILE" in os.environ:
+        _args.aws_profile = os.environ["AWS_PROFILE"]
+
+    if "AWS_REGION" in os.environ:
+        _args.aws_region = os.environ["AWS_REGION"]
+
+    if "ENVIRONMENT" in os.environ:
+        _args.environment = os.environ["ENVIRONMENT"]
+
+    if "APPLICATION" in os.environ:
+        _args.application = os.environ["APPLICATION"]
+
+    if "MONITORING_SNS_TOPIC" in os.environ:
+        _args.monitoring_sns_topic = os.environ["MONITORING_SNS_TOPIC"]
+
+    if "MONITORING_ERRORS_SEVERITY" in os.environ:
+        _args.severity = os.environ["MONITORING_ERRORS_SEVERITY"]
+    else:
+        _args.severity = "High"
+
+    if "MONITORING_ERRORS_TYPE" in os.environ:
+        _args.notification_type = os.environ["MONITORING_ERRORS_TYPE"]
+    else:
+        _args.notification_type = "Warning"
+
+    if "SLACK_CHANNEL_OVERRIDE" in os.environ:
+        _args.slack_channel_override = os.environ["SLACK_CHANNEL_OVERRIDE"]
+
+    if "BATCH_JOB_QUEUE" in os.environ:
+        _args.batch_job_queue = os.environ["BATCH_JOB_QUEUE"]
+
+    if "BATCH_JOB_NAME" in os.environ:
+        _args.batch_job_name = os.environ["BATCH_JOB_NAME"]
+
+    if "BATCH_JOB_DEFINITION_NAME" in os.environ:
+        _args.batch_job_definition_name = os.environ["BATCH_JOB_DEFINITION_NAME"]
+
+    if "BATCH_PARAMETERS_JSON" in os.environ:
+        _args.batch_parameters_json = parse_environment_variable(
+            "BATCH_PARAMETERS_JSON", json.loads, errors
+        )
+    else:
+        _args.batch_parameters_json = None
+
+    if "LOG_LEVEL" in os.environ:
+        _args.log_level = os.environ["LOG_LEVEL"]
+
+    if "BATCH_SUBMIT_CONCURRENCY" in os.environ:
+        _args.batch_submit_concurrency = parse_environment_variable(
+            "BATCH_SUBMIT_CONCURRENCY", int, errors
+        )
+    else:
+        _args.batch_submit_concurrency = 10
+
+    if "BATCH_JOB_NAME_TEMPLATE" in os.environ:
+        _args.batch_job_name_template = os.environ["BATCH_JOB_NAME_TEMPLATE"]
+    else:
+        _args.batch_job_name_template = None
+
+    if "BATCH_PARAMETERS_TEMPLATE_JSON" in os.environ:
+        _args.batch_parameters_template_json = parse_environment_variable(
+            "BATCH_PARAMETERS_TEMPLATE_JSON", json.loads, errors
+        )
+    else:
+        _args.batch_parameters_template_json = None
+
+    if "IDEMPOTENCY_KEY_FIELDS" in os.environ:
+        _args.idempotency_key_fields = [
+            field.strip()
+            for field in os.environ["IDEMPOTENCY_KEY_FIELDS"].split(",")
+            if field.strip()
+        ]
+    else:
+        _args.idempotency_key_fields = None
+
+    if "IDEMPOTENCY_TTL_SECONDS" in os.environ:
+        _args.idempotency_ttl_seconds = parse_environment_variable(
+            "IDEMPOTENCY_TTL_SECONDS", int, errors
+        )
+    else:
+        _args.idempotency_ttl_seconds = 86400
+
+    if "IDEMPOTENCY_CACHE_SIZE" in os.environ:
+        _args.idempotency_cache_size = parse_environment_variable(
+            "IDEMPOTENCY_CACHE_SIZE", int, errors
+        )
+    else:
+        _args.idempotency_cache_size = 1000
+
+    if "IDEMPOTENCY_STORE_PATH" in os.environ:
+        _args.idempotency_store_path = os.environ["IDEMPOTENCY_STORE_PATH"]
+    else:
+        _args.idempotency_store_path = None
+
+    if "BATCH_COALESCE_MAX_EVENTS" in os.environ:
+        _args.batch_coalesce_max_events = parse_environment_variable(
+            "BATCH_COALESCE_MAX_EVENTS", int, errors
+        )
+    else:
+        _args.batch_coalesce_max_events = 0
+
+    if "BATCH_COALESCE_WINDOW_SECONDS" in os.environ:
+        _args.batch_coalesce_window_seconds = parse_environment_variable(
+            "BATCH_COALESCE_WINDOW_SECONDS", float, errors
+        )
+    else:
+        _args.batch_coalesce_window_seconds = 0
+
+    if "BATCH_SUBMIT_RATE_PER_SECOND" in os.environ:
+        _args.batch_submit_rate_per_second = parse_environment_variable(
+            "BATCH_SUBMIT_RATE_PER_SECOND", float, errors
+        )
+    else:
+        _args.batch_submit_rate_per_second = None
+
+    if "BATCH_SUBMIT_BURST" in os.environ:
+        _args.batch_submit_burst = parse_environment_variable(
+            "BATCH_SUBMIT_BURST", int, errors
+        )
+    else:
+        _args.batch_submit_burst = None
+
+    if "SNS_PUBLISH_RATE_PER_SECOND" in os.environ:
+        _args.sns_publish_rate_per_second = parse_environment_variable(
+            "SNS_PUBLISH_RATE_PER_SECOND", float, errors
+        )
+    else:
+        _args.sns_publish_rate_per_second = None
+
+    if "SNS_PUBLISH_BURST" in os.environ:
+        _args.sns_publish_burst = parse_environment_variable(
+            "SNS_PUBLISH_BURST", int, errors
+        )
+    else:
+        _args.sns_publish_burst = None
+
+    if "BATCH_JOB_QUEUES" in os.environ:
+        _args.batch_job_queues = [
+            job_queue.strip()
+            for job_queue in os.environ["BATCH_JOB_QUEUES"].split(",")
+            if job_queue.strip()
+        ]
+    else:
+        _args.batch_job_queues = None
+
+    if "BATCH_QUEUE_DEPTH_TTL_SECONDS" in os.environ:
+        _args.batch_queue_depth_ttl_seconds = parse_environment_variable(
+            "BATCH_QUEUE_DEPTH_TTL_SECONDS", float, errors
+        )
+    else:
+        _args.batch_queue_depth_ttl_seconds = 30
+
+    if "BATCH_QUEUE_MAX_DEPTH" in os.environ:
+        _args.batch_queue_max_depth = parse_environment_variable(
+            "BATCH_QUEUE_MAX_DEPTH", int, errors
+        )
+    else:
+        _args.batch_queue_max_depth = None
+
+    if "BATCH_QUEUE_DEPTH_ACTION" in os.environ:
+        _args.batch_queue_depth_action = os.environ["BATCH_QUEUE_DEPTH_ACTION"]
+    else:
+        _args.batch_queue_depth_action = "defer"
+
+    if "METRICS_NAMESPACE" in os.environ:
+        _args.metrics_namespace = os.environ["METRICS_NAMESPACE"]
+    else:
+        _args.metrics_namespace = None
+
+    if "PROFILE_SAMPLE_RATE" in os.environ:
+        _args.profile_sample_rate = parse_environment_variable(
+            "PROFILE_SAMPLE_RATE", float, errors
+        )
+    else:
+        _args.profile_sample_rate = 0
+
+    if "PROFILE_TOP_N" in os.environ:
+        _args.profile_top_n = parse_environment_variable("PROFILE_TOP_N", int, errors)
+    else:
+        _args.profile_top_n = 15
+
+    if "PROFILE_TRACE_MEMORY" in os.environ:
+        _args.profile_trace_memory = (
+            os.environ["PROFILE_TRACE_MEMORY"].lower() == "true"
+        )
+    else:
+        _args.profile_trace_memory = False
+
+    if "JOB_TRACKING_SECONDS" in os.environ:
+        _args.job_tracking_seconds = parse_environment_variable(
+            "JOB_TRACKING_SECONDS", float, errors
+        )
+    else:
+        _args.job_tracking_seconds = 0
+
+    if "JOB_TRACKING_MIN_INTERVAL_SECONDS" in os.environ:
+        _args.job_tracking_min_interval_seconds = parse_environment_variable(
+            "JOB_TRACKING_MIN_INTERVAL_SECONDS", float, errors
+        )
+    else:
+        _args.job_tracking_min_interval_seconds = 5
+
+    if "JOB_TRACKING_MAX_INTERVAL_SECONDS" in os.environ:
+        _args.job_tracking_max_interval_seconds = parse_environment_variable(
+            "JOB_TRACKING_MAX_INTERVAL_SECONDS", float, errors
+        )
+    else:
+        _args.job_tracking_max_interval_seconds = 60
+
+    if "ALERT_AGGREGATION" in os.environ:
+        _args.alert_aggregation = os.environ["ALERT_AGGREGATION"].lower() == "true"
+    else:
+        _args.alert_aggregation = False
+
+    if "ALERT_COOLDOWN_SECONDS" in os.environ:
+        _args.alert_cooldown_seconds = parse_environment_variable(
+            "ALERT_COOLDOWN_SECONDS", float, errors
+        )
+    else:
+        _args.alert_cooldown_seconds = 300
+
+    if "CIRCUIT_BREAKER_FAILURE_THRESHOLD" in os.environ:
+        _args.circuit_breaker_failure_threshold = parse_environment_variable(
+            "CIRCUIT_BREAKER_FAILURE_THRESHOLD", int, errors
+        )
+    else:
+        _args.circuit_breaker_failure_threshold = None
+
+    if "CIRCUIT_BREAKER_RESET_SECONDS" in os.environ:
+        _args.circuit_breaker_reset_seconds = parse_environment_variable(
+            "CIRCUIT_BREAKER_RESET_SECONDS", float, errors
+        )
+    else:
+        _args.circuit_breaker_reset_seconds = 30
+
+    if "CIRCUIT_BREAKER_STORE_PATH" in os.environ:
+        _args.circuit_breaker_store_path = os.environ["CIRCUIT_BREAKER_STORE_PATH"]
+    else:
+        _args.circuit_breaker_store_path = None
+
+    if "DEFERRAL_QUEUE_URL" in os.environ:
+        _args.deferral_queue_url = os.environ["DEFERRAL_QUEUE_URL"]
+    else:
+        _args.deferral_queue_url = None
+
+    if "DEFERRAL_DELAY_SECONDS" in os.environ:
+        _args.deferral_delay_seconds = min(
+            parse_environment_variable("DEFERRAL_DELAY_SECONDS", int, errors) or 0,
+            MAX_SQS_DELAY_SECONDS,
+        )
+    else:
+        _args.deferral_delay_seconds = 60
+
+    if "BATCH_METADATA_TTL_SECONDS" in os.environ:
+        _args.batch_metadata_ttl_seconds = parse_environment_variable(
+            "BATCH_METADATA_TTL_SECONDS", float, errors
+        )
+    else:
+        _args.batch_metadata_ttl_seconds = None
+
+    if "BATCH_SUBMIT_ENGINE" in os.environ:
+        _args.batch_submit_engine = os.environ["BATCH_SUBMIT_ENGINE"]
+    else:
+        _args.batch_submit_engine = "threads"
+
+    if "BATCH_ROUTING_CONFIG" in os.environ:
+        _args.batch_routing_config = os.environ["BATCH_ROUTING_CONFIG"]
+    else:
+        _args.batch_routing_config = None
+
+    if "BATCH_SCHEDULING_RULES_JSON" in os.environ:
+        _args.batch_scheduling_rules_json = parse_environment_variable(
+            "BATCH_SCHEDULING_RULES_JSON", json.loads, errors
+        )
+    else:
+        _args.batch_scheduling_rules_json = None
+
+    if "BATCH_PIPELINE_JSON" in os.environ:
+        _args.batch_pipeline_json = parse_environment_variable(
+            "BATCH_PIPELINE_JSON", json.loads, errors
+        )
+    else:
+        _args.batch_pipeline_json = None
+
+    if "OUTBOX_STORE_PATH" in os.environ:
+        _args.outbox_store_path = os.environ["OUTBOX_STORE_PATH"]
+    else:
+        _args.outbox_store_path = None
+
+    if "OUTBOX_LEASE_SECONDS" in os.environ:
+        _args.outbox_lease_seconds = parse_environment_variable(
+            "OUTBOX_LEASE_SECONDS", int, errors
+        )
+    else:
+        _args.outbox_lease_seconds = 300
+
+    if "OUTBOX_RETENTION_SECONDS" in os.environ:
+        _args.outbox_retention_seconds = parse_environment_variable(
+            "OUTBOX_RETENTION_SECONDS", int, errors
+        )
+    else:
+        _args.outbox_retention_seconds = 86400
+
+    if "BATCH_PARAMETERS_OFFLOAD_URI" in os.environ:
+        _args.batch_parameters_offload_uri = os.environ["BATCH_PARAMETERS_OFFLOAD_URI"]
+    else:
+        _args.batch_parameters_offload_uri = None
+
+    if "BATCH_PARAMETERS_OFFLOAD_THRESHOLD_BYTES" in os.environ:
+        _args.batch_parameters_offload_threshold_bytes = parse_environment_variable(
+            "BATCH_PARAMETERS_OFFLOAD_THRESHOLD_BYTES", int, errors
+        )
+    else:
+        _args.batch_parameters_offload_threshold_bytes = 8192
+
+    if "GLUE_EVENT_SCHEMA_JSON" in os.environ:
+        _args.glue_event_schema_json = parse_environment_variable(
+            "GLUE_EVENT_SCHEMA_JSON", json.loads, errors
+        )
+    else:
+        _args.glue_event_schema_json = None
+
+    if errors:
+        raise ConfigError("Invalid config: " + "; ".join(errors))
+
+    return Config(**vars(_args))
+
+
+def parse_environment_variable(name, parse, errors):
+    """Parses an environment variable, recording an error and returning None if malformed.
+
+    Arguments:
+        name (string): the environment variable, which must be set
+        parse (function): converts the string value, e.g. int or json.loads
+        errors (list): the error messages to add to
+
+    """
+    try:
+        return parse(os.environ[name])
+    except ValueError as err:
+        errors.append(f"{name} is invalid: {err}")
+        return None
+
+
+def validate_config(config):
+    """Checks the config is complete and consistent before any AWS work is done.
+
+    Raises:
+        ConfigError: listing every problem found
+
+    """
+    errors = [
+        f"{variable} is not set"
+        for field, variable in REQUIRED_CONFIG_FIELDS
+        if not getattr(config, field, None)
+    ]
+
+    if (
+        not getattr(config, "batch_job_name", None)
+        and not config.batch_job_name_template
+    ):
+        errors.append("BATCH_JOB_NAME or BATCH_JOB_NAME_TEMPLATE is not set")
+
+    if config.batch_submit_concurrency < 1:
+        errors.append("BATCH_SUBMIT_CONCURRENCY must be at least 1")
+
+    if config.batch_submit_engine not in BATCH_SUBMIT_ENGINES:
+        errors.append(f"BATCH_SUBMIT_ENGINE must be one of {BATCH_SUBMIT_ENGINES}")
+
+    if config.batch_coalesce_max_events > MAX_ARRAY_SIZE:
+        errors.append(f"BATCH_COALESCE_MAX_EVENTS must not be above {MAX_ARRAY_SIZE}")
+
+    if config.batch_queue_depth_action not in BATCH_QUEUE_DEPTH_ACTIONS:
+        errors.append(
+            f"BATCH_QUEUE_DEPTH_ACTION must be one of {BATCH_QUEUE_DEPTH_ACTIONS}"
+        )
+
+    if not 0 <= config.profile_sample_rate <= 1:
+        errors.append("PROFILE_SAMPLE_RATE must be between 0 and 1")
+
+    if not 0 <= config.deferral_delay_seconds <= MAX_SQS_DELAY_SECONDS:
+        errors.append(
+            f"DEFERRAL_DELAY_SECONDS must be between 0 and {MAX_SQS_DELAY_SECONDS}"
+        )
+
+    if (
+        config.job_tracking_min_interval_seconds
+        > config.job_tracking_max_interval_seconds
+    ):
+        errors.append(
+            "JOB_TRACKING_MIN_INTERVAL_SECONDS must not be above "
+            "JOB_TRACKING_MAX_INTERVAL_SECONDS"
+        )
+
+    for field, variable in (
+        ("batch_parameters_json", "BATCH_PARAMETERS_JSON"),
+        ("batch_parameters_template_json", "BATCH_PARAMETERS_TEMPLATE_JSON"),
+        ("glue_event_schema_json", "GLUE_EVENT_SCHEMA_JSON"),
+    ):
+        if getattr(config, field) is not None and not isinstance(
+            getattr(config, field), dict
+        ):
+            errors.append(f"{variable} must be a json object")
+
+    if config.batch_scheduling_rules_json is not None:
+        try:
+            compile_scheduling_rules(config.batch_scheduling_rules_json)
+        except (ValueError, re.error) as err:
+            errors.append(f"BATCH_SCHEDULING_RULES_JSON is invalid: {err}")
+
+    if config.batch_routing_config:
+        try:
+            RoutingIndex(read_routing_config(config.batch_routing_config)["routes"])
+        except Exception as err:
+            # Unreadable files and yaml errors are reported alongside invalid routes
+            errors.append(
+                f"BATCH_ROUTING_CONFIG {config.batch_routing_config} is invalid: {err}"
+            )
+
+    for field, pattern in (
+        config.glue_event_schema_json
+        if isinstance(config.glue_event_schema_json, dict)
+        else {}
+    ).items():
+        try:
+            if pattern is not None:
+                re.compile(pattern)
+        except (re.error, TypeError) as err:
+            errors.append(
+                f"GLUE_EVENT_SCHEMA_JSON pattern of {field} is invalid: {err}"
+            )
+
+    if config.batch_parameters_offload_uri:
+        try:
+            parse_parameter_offload_uri(config.batch_parameters_offload_uri)
+        except ValueError as err:
+            errors.append(str(err))
+
+    if config.batch_pipeline_json is not None:
+        try:
+            compile_pipeline(config.batch_pipeline_json)
+        except ValueError as err:
+            errors.append(f"BATCH_PIPELINE_JSON is invalid: {err}")
+
+    if errors:
+        raise ConfigError("Invalid config: " + "; ".join(errors))
+
+
+def get_config_fingerprint():
+    """Returns the current values of the environment variables the config is built from."""
+    return tuple(os.environ.get(name) for name in CONFIG_ENVIRONMENT_VARIABLES)
+
+
+def load_cached_config():
+    """Builds the config and logger once per container, rebuilding only when the env changes.
+
+    Returns:
+        bool: True if the config was (re)built, False if the cached config was reused
+
+    """
+    global args
+    global logger
+    global config_fingerprint
+
+    fingerprint = get_config_fingerprint()
+    if args is not None and logger is not None and fingerprint == config_fingerprint:
+        return False
+
+    config = get_parameters()
+    logger = setup_logging(config.log_level, config)
+
+    # Raised before anything is cached, so every invocation fails until the env is fixed
+    validate_config(config)
+    apply_config(config)
+
+    config_fingerprint = fingerprint
+
+    return True
+
+
+def apply_config(config):
+    """Makes the config current, rebuilding the clients and state derived from it.
+
+    Used by the handler whenever the config is rebuilt and by the command line before a
+    backfill or outbox sweep, so both run with the same limiters, metrics and pool size.
+
+    Arguments:
+        config (Config): the validated config
+
+    """
+    global args
+    global batch_client
+    global sns_client
+    global idempotency_cache
+    global idempotency_store
+    global batch_submit_rate_limiter
+    global sns_publish_rate_limiter
+    global queue_router
+    global metrics
+    global alert_aggregator
+    global submit_circuit_breaker
+    global sqs_client
+    global batch_metadata_cache
+    global boto_client_config
+    global routing_index
+    global scheduling_rules
+    global pipeline_stages
+    global outbox_store
+    global parameter_offloader
+    global s3_client
+    global event_validator
+
+    # Built before anything is replaced, so a failure leaves no config cached to reuse
+    circuit_breaker = create_submit_circuit_breaker(config)
+    offloader = create_parameter_offloader(config)
+
+    args = config
+
+    # Clients and idempotency tiers depend on the config so are rebuilt alongside it
+    batch_client = None
+    sns_client = None
+    sqs_client = None
+    s3_client = None
+    idempotency_cache = None
+    idempotency_store = None
+    queue_router = None
+    batch_metadata_cache = None
+    routing_index = None
+    scheduling_rules = None
+    pipeline_stages = None
+    outbox_store = None
+    event_validator = None
+
+    # Every call in flight holds its own pooled connection
+    if args.batch_submit_concurrency > boto_client_config.max_pool_connections:
+        boto_client_config = boto_client_config.merge(
+            botocore.config.Config(max_pool_connections=args.batch_submit_concurrency)
+        )
+
+    metrics = None
+    if args.metrics_namespace:
+        metrics = MetricsRecorder(
+            args.metrics_namespace,
+            {"Application": args.application, "Environment": args.environment},
+        )
+
+    batch_submit_rate_limiter = create_rate_limiter(
+        args.batch_submit_rate_per_second, args.batch_submit_burst
+    )
+    sns_publish_rate_limiter = create_rate_limiter(
+        args.sns_publish_rate_per_second, args.sns_publish_burst
+    )
+
+    alert_aggregator = None
+    if args.alert_aggregation:
+        alert_aggregator = AlertAggregator(args.alert_cooldown_seconds)
+
+    submit_circuit_breaker = circuit_breaker
+    parameter_offloader = offloader
+
+
+def get_cached_clients():
+    """Returns the batch and sns clients, creating them on first use in this container."""
+    global batch_client
+    global sns_client
+
+    if batch_client is None:
+        batch_client = get_batch_client()
+
+    if sns_client is None:
+        sns_client = get_sns_client()
+
+    return batch_client, sns_client
+
+
+def reset_cached_state():
+    """Clears the cached config, logger and clients so the next invocation rebuilds them."""
+    global args
+    global logger
+    global config_fingerprint
+    global batch_client
+    global sns_client
+    global idempotency_cache
+    global idempotency_store
+    global batch_submit_rate_limiter
+    global sns_publish_rate_limiter
+    global queue_router
+    global metrics
+    global alert_aggregator
+    global submit_circuit_breaker
+    global sqs_client
+    global batch_metadata_cache
+    global routing_index
+    global scheduling_rules
+    global pipeline_stages
+    global outbox_store
+    global parameter_offloader
+    global s3_client
+    global event_validator
+
+    args = None
+    logger = None
+    config_fingerprint = None
+    batch_client = None
+    sns_client = None
+    idempotency_cache = None
+    idempotency_store = None
+    batch_submit_rate_limiter = None
+    sns_publish_rate_limiter = None
+    queue_router = None
+    metrics = None
+    alert_aggregator = None
+    submit_circuit_breaker = None
+    sqs_client = None
+    batch_metadata_cache = None
+    routing_index = None
+    scheduling_rules = None
+    pipeline_stages = None
+    outbox_store = None
+    parameter_offloader = None
+    s3_client = None
+    event_validator = None
+
+
+class MetricsRecorder:
+    """Collects per-invocation timers and counters for CloudWatch embedded metric format.
+
+    Everything recorded during an invocation is buffered and written to stdout as a single
+    json line by flush, so CloudWatch extracts the metrics from the logs without any API
+    calls. Timers keep every value so CloudWatch can compute percentiles.
+    """
+
+    def __init__(self, namespace, dimensions, clock=time.time, stream=None):
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.clock = clock
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.timings = collections.defaultdict(list)
+        self.counts = collections.Counter()
+
+    def add_timing(self, name, milliseconds):
+        """Records a duration in milliseconds."""
+        with self.lock:
+            self.timings[name].append(round(milliseconds, 3))
+
+    def increment(self, name, value=1):
+        """Adds value to a counter."""
+        with self.lock:
+            self.counts[name] += value
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """Records the duration of the with block as a timer."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, (time.perf_counter() - start) * 1000)
+
+    def record_api_call(self, name, start, response):
+        """Records the latency, retries and throttling of an AWS API call.
+
+        Arguments:
+            name (string): the metric name of the API call
+            start (float): the perf_counter value when the call started
+            response (dict): the API response, or the error response if the call failed
+
+        """
+        self.add_timing(f"{name}Time", (time.perf_counter() - start) * 1000)
+
+        response_metadata = response.get("ResponseMetadata", {})
+        retry_attempts = response_metadata.get("RetryAttempts", 0)
+        if retry_attempts:
+            self.increment("Retries", retry_attempts)
+
+        error_code = response.get("Error", {}).get("Code")
+        if error_code:
+            self.increment(f"{name}Errors")
+        if error_code in THROTTLING_ERROR_CODES:
+            self.increment("Throttles")
+
+    def flush(self):
+        """Writes the buffered metrics as embedded metric format and clears the buffer."""
+        with self.lock:
+            timings = self.timings
+            counts = self.counts
+            self.timings = collections.defaultdict(list)
+            self.counts = collections.Counter()
+
+        if not timings and not counts:
+            return
+
+        values = {name: count for name, count in counts.items()}
+        units = {name: "Count" for name in counts}
+        overflow = {}
+
+        for name, timing_values in timings.items():
+            values[name] = timing_values[:MAX_METRIC_VALUES_PER_LINE]
+            units[name] = "Milliseconds"
+            if len(timing_values) > MAX_METRIC_VALUES_PER_LINE:
+                overflow[name] = timing_values[MAX_METRIC_VALUES_PER_LINE:]
+
+        lines = [self.generate_line(values, units)]
+
+        # Only timers exceeding the per line limit need further lines
+        while overflow:
+            values = {
+                name: timing_values[:MAX_METRIC_VALUES_PER_LINE]
+                for name, timing_values in overflow.items()
+            }
+            overflow = {
+                name: timing_values[MAX_METRIC_VALUES_PER_LINE:]
+                for name, timing_values in overflow.items()
+                if len(timing_values) > MAX_METRIC_VALUES_PER_LINE
+            }
+            lines.append(self.generate_line(values, units))
+
+        stream = self.stream or sys.stdout
+        stream.write("".join(line + "\n" for line in lines))
+        stream.flush()
+
+    def generate_line(self, values, units):
+        """Generates one embedded metric format json line for the metric values."""
+        metric_line = {
+            "_aws": {
+                "Timestamp": int(self.clock() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(self.dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": units[name]} for name in values
+                        ],
+                    }
+                ],
+            }
+        }
+        metric_line.update(self.dimensions)
+        metric_line.update(values)
+
+        return json.dumps(metric_line)
+
+
+def increment_metric(name, value=1):
+    """Adds value to a counter if metrics are enabled."""
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+def call_aws_api(metric_name, api_call, **arguments):
+    """Calls an AWS API, recording its latency, retries and throttles if metrics are enabled.
+
+    Arguments:
+        metric_name (string): the metric name of the API call, e.g. SubmitJob
+        api_call (function): the client method to call
+        arguments (dict): the keyword arguments for the call
+
+    """
+    if metrics is None:
+        return api_call(**arguments)
+
+    start = time.perf_counter()
+    try:
+        response = api_call(**arguments)
+    except botocore.exceptions.ClientError as err:
+        metrics.record_api_call(metric_name, start, err.response)
+        raise
+
+    metrics.record_api_call(metric_name, start, response)
+
+    return response
+
+
+class TokenBucket:
+    """Client-side token bucket that shapes calls to an AWS API before it throttles them.
+
+    Callers that find the bucket empty reserve a token and sleep until it refills, so
+    waits are spread fairly across threads rather than retried blindly by botocore.
+    """
+
+    def __init__(
+        self, rate_per_second, capacity, clock=time.monotonic, sleep=time.sleep
+    ):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = float(capacity)
+        self.updated_at = clock()
+        self.acquired_count = 0
+        self.waited_count = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available.
+
+        Returns:
+            float: the number of seconds waited
+
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate_per_second,
+            )
+            self.updated_at = now
+            self.tokens -= 1
+
+            wait_seconds = max(0.0, -self.tokens / self.rate_per_second)
+
+            self.acquired_count += 1
+            if wait_seconds > 0:
+                self.waited_count += 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+        if wait_seconds > 0:
+            self.sleep(wait_seconds)
+
+        return wait_seconds
+
+    def get_metrics(self):
+        """Returns the wait time metrics of the bucket."""
+        with self.lock:
+            return {
+                "acquired_count": self.acquired_count,
+                "waited_count": self.waited_count,
+                "total_wait_seconds": self.total_wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+def create_rate_limiter(rate_per_second, burst):
+    """Creates a token bucket for the rate, or returns None if no rate is configured.
+
+    Arguments:
+        rate_per_second (float): the sustained number of calls allowed per second (or None)
+        burst (int): the number of calls allowed in a burst (or None to match the rate)
+
+    """
+    if not rate_per_second:
+        return None
+
+    return TokenBucket(rate_per_second, burst or max(1, int(rate_per_second)))
+
+
+class QueueRouter:
+    """Routes submissions to the least loaded of several candidate job queues.
+
+    Queue depth (the number of RUNNABLE jobs) and queue state are cached for ttl_seconds.
+    Between refreshes each routed submission is added to the cached depth so a burst is
+    spread across the queues rather than sent to whichever was idle at the last refresh.
+    Queue state comes from metadata_cache, shared with submissions when one is given.
+    Depths are listed outside the lock, so other submissions are not held up by the
+    ListJobs pages.
+    """
+
+    def __init__(
+        self,
+        batch_client,
+        job_queues,
+        ttl_seconds,
+        max_depth=None,
+        depth_action="defer",
+        clock=time.monotonic,
+        metadata_cache=None,
+    ):
+        self.batch_client = batch_client
+        self.job_queues = job_queues
+        self.ttl_seconds = ttl_seconds
+        self.max_depth = max_depth
+        self.depth_action = depth_action
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.queue_depths = {}
+        self.metadata_cache = metadata_cache or BatchMetadataCache(
+            batch_client, ttl_seconds, clock
+        )
+
+    def select_queue(self, job_count=1):
+        """Returns the queue to submit job_count jobs to.
+
+        Raises:
+            SubmissionDeferredError: if every queue is at max_depth and the action is defer
+            SubmissionRejectedError: if every queue is at max_depth and the action is reject
+
+        """
+        enabled_queues = self.get_enabled_queues()
+        if not enabled_queues:
+            raise SubmissionRejectedError(
+                f"None of the job queues {self.job_queues} are enabled"
+            )
+
+        for job_queue in enabled_queues:
+            self.get_queue_depth(job_queue)
+
+        with self.lock:
+            # Read again under the lock to include submissions routed in the meantime
+            depths = {
+                job_queue: self.queue_depths[job_queue][0]
+                for job_queue in enabled_queues
+            }
+
+            job_queue = min(depths, key=depths.get)
+
+            if self.max_depth is not None and depths[job_queue] >= self.max_depth:
+                error_class = (
+                    SubmissionRejectedError
+                    if self.depth_action == "reject"
+                    else SubmissionDeferredError
+                )
+                raise error_class(
+                    f"All job queues have at least {self.max_depth} RUNNABLE jobs"
+                )
+
+            depth, fetched_at = self.queue_depths[job_queue]
+            self.queue_depths[job_queue] = (depth + job_count, fetched_at)
+
+            return job_queue
+
+    def get_enabled_queues(self):
+        """Returns the candidate queues that are ENABLED and VALID, refreshed on the TTL."""
+        descriptions = self.metadata_cache.get_job_queues(self.job_queues)
+
+        return [
+            job_queue
+            for job_queue in self.job_queues
+            if is_job_queue_enabled(descriptions[job_queue])
+        ]
+
+    def get_queue_depth(self, job_queue):
+        """Returns the number of RUNNABLE jobs in the queue, refreshed on the TTL.
+
+        Counting stops once max_depth, or MAX_COUNTED_QUEUE_DEPTH without one, is reached
+        as the exact depth beyond it is not needed.
+        """
+        now = self.clock()
+        with self.lock:
+            cached = self.queue_depths.get(job_queue)
+            if cached is not None and now - cached[1] < self.ttl_seconds:
+                return cached[0]
+
+        depth_limit = (
+            self.max_depth if self.max_depth is not None else MAX_COUNTED_QUEUE_DEPTH
+        )
+        depth = 0
+        list_jobs_arguments = {
+            "jobQueue": job_queue,
+            "jobStatus": "RUNNABLE",
+            "maxResults": 100,
+        }
+
+        while True:
+            response = call_aws_api(
+                "ListJobs", self.batch_client.list_jobs, **list_jobs_arguments
+            )
+            depth += len(response["jobSummaryList"])
+
+            if "nextToken" not in response or depth >= depth_limit:
+                break
+
+            list_jobs_arguments["nextToken"] = response["nextToken"]
+
+        with self.lock:
+            # Keep a depth another submission refreshed while this one was listing
+            cached = self.queue_depths.get(job_queue)
+            if cached is None or cached[1] < now:
+                self.queue_depths[job_queue] = (depth, now)
+
+            return self.queue_depths[job_queue][0]
+
+
+def get_queue_router(batch_client):
+    """Returns the queue router, or None if no candidate queues are configured."""
+    global queue_router
+
+    if queue_router is None and args.batch_job_queues:
+        with cached_state_lock:
+            if queue_router is None:
+                queue_router = QueueRouter(
+                    batch_client,
+                    args.batch_job_queues,
+                    args.batch_queue_depth_ttl_seconds,
+                    args.batch_queue_max_depth,
+                    args.batch_queue_depth_action,
+                    metadata_cache=get_batch_metadata_cache(batch_client),
+                )
+
+    return queue_router
+
+
+class BatchMetadataCache:
+    """Caches job definition revisions and job queue descriptions for ttl_seconds.
+
+    Lookups hold the lock while fetching, so a burst of concurrent submissions makes one
+    describe call per entry rather than one each.
+    """
+
+    def __init__(self, batch_client, ttl_seconds, clock=time.monotonic):
+        self.batch_client = batch_client
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.job_definition_arns = {}
+        self.job_queues = {}
+
+    def get_job_definition_arn(self, job_definition):
+        """Returns the ARN of the latest ACTIVE revision of the job definition.
+
+        Job definitions already pinned to a revision (name:revision or an ARN) are
+        returned unchanged.
+
+        Raises:
+            SubmissionRejectedError: if the job definition has no ACTIVE revision
+
+        """
+        if ":" in job_definition:
+            return job_definition
+
+        with self.lock:
+            now = self.clock()
+            cached = self.job_definition_arns.get(job_definition)
+            if cached is not None and now - cached[1] < self.ttl_seconds:
+                return cached[0]
+
+            latest = None
+            describe_arguments = {
+                "jobDefinitionName": job_definition,
+                "status": "ACTIVE",
+            }
+
+            while True:
+                response = call_aws_api(
+                    "DescribeJobDefinitions",
+                    self.batch_client.describe_job_definitions,
+                    **describe_arguments,
+                )
+
+                for description in response["jobDefinitions"]:
+                    if latest is None or description["revision"] > latest["revision"]:
+                        latest = description
+
+                if "nextToken" not in response:
+                    break
+
+                describe_arguments["nextToken"] = response["nextToken"]
+
+            if latest is None:
+                raise SubmissionRejectedError(
+                    f"Job definition {job_definition} has no ACTIVE revision"
+                )
+
+            self.job_definition_arns[job_definition] = (
+                latest["jobDefinitionArn"],
+                now,
+            )
+
+            return latest["jobDefinitionArn"]
+
+    def get_job_queues(self, job_queues):
+        """Returns the description of each job queue, refreshing those older than the TTL.
+
+        Returns:
+            dict: the description by queue name or ARN, None for queues that do not exist
+
+        """
+        with self.lock:
+            now = self.clock()
+            stale_queues = [
+                job_queue
+                for job_queue in job_queues
+                if job_queue not in self.job_queues
+                or now - self.job_queues[job_queue][1] >= self.ttl_seconds
+            ]
+
+            for index in range(0, len(stale_queues), MAX_DESCRIBE_JOB_QUEUES):
+                requested_queues = stale_queues[index : index + MAX_DESCRIBE_JOB_QUEUES]
+                response = call_aws_api(
+                    "DescribeJobQueues",
+                    self.batch_client.describe_job_queues,
+                    jobQueues=requested_queues,
+                )
+
+                descriptions = {}
+                for description in response["jobQueues"]:
+                    descriptions[description["jobQueueName"]] = description
+                    descriptions[description["jobQueueArn"]] = description
+
+                for job_queue in requested_queues:
+                    self.job_queues[job_queue] = (descriptions.get(job_queue), now)
+
+            return {
+                job_queue: self.job_queues[job_queue][0] for job_queue in job_queues
+            }
+
+    def check_job_queue(self, job_queue):
+        """Checks the job queue can accept submissions.
+
+        Raises:
+            SubmissionRejectedError: if the queue does not exist or is not ENABLED and VALID
+
+        """
+        description = self.get_job_queues([job_queue])[job_queue]
+
+        if description is None:
+            raise SubmissionRejectedError(f"Job queue {job_queue} does not exist")
+
+        if not is_job_queue_enabled(description):
+            raise SubmissionRejectedError(
+                f"Job queue {job_queue} is {description['state']} "
+                f"and {description['status']}"
+            )
+
+
+def is_job_queue_enabled(description):
+    """Returns True if the described job queue is ENABLED and VALID."""
+    return (
+        description is not None
+        and description["state"] == "ENABLED"
+        and description["status"] == "VALID"
+    )
+
+
+def get_batch_metadata_cache(batch_client):
+    """Returns the job metadata cache, or None if BATCH_METADATA_TTL_SECONDS is not set."""
+    global batch_metadata_cache
+
+    if batch_metadata_cache is None and args.batch_metadata_ttl_seconds:
+        with cached_state_lock:
+            if batch_metadata_cache is None:
+                batch_metadata_cache = BatchMetadataCache(
+                    batch_client, args.batch_metadata_ttl_seconds
+                )
+
+    return batch_metadata_cache
+
+
+def resolve_job_definition(batch_client, job_queue, job_definition):
+    """Checks the queue and pins the job definition revision when metadata is cached.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        job_queue (string): the queue the job will be submitted to
+        job_definition (string): the job definition name
+
+    Returns:
+        string: the job definition revision ARN, or job_definition if metadata is not cached
+
+    """
+    metadata_cache = get_batch_metadata_cache(batch_client)
+    if metadata_cache is None:
+        return job_definition
+
+    metadata_cache.check_job_queue(job_queue)
+
+    return metadata_cache.get_job_definition_arn(job_definition)
+
+
+def route_job_queue(batch_client, job_queue, job_count=1):
+    """Returns the queue to submit to, choosing between the candidate queues if configured.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        job_queue (string): the queue to use when no candidate queues are configured
+        job_count (int): the number of jobs being submitted
+
+    """
+    router = get_queue_router(batch_client)
+    if router is None:
+        return job_queue
+
+    return router.select_queue(job_count)
+
+
+class CircuitBreaker:
+    """Fails submissions fast while AWS Batch is unhealthy instead of retrying every one.
+
+    Closed, calls go through and consecutive failures are counted. At failure_threshold
+    the circuit opens and calls are refused for reset_seconds, after which it is half
+    open and lets a single trial call through. The trial succeeding closes the circuit,
+    failing opens it again. With a store the state is shared between containers, and
+    the trial is claimed in the store so only one container makes it. A trial with no
+    outcome after reset_seconds, e.g. from a container that timed out, is claimed again.
+    """
+
+    def __init__(
+        self, name, failure_threshold, reset_seconds, store=None, clock=time.time
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.store = store
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        self.failure_count = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def allow(self):
+        """Returns True if a call may be made now, False if it should fail fast."""
+        with self.lock:
+            self.load()
+
+            if self.state == CIRCUIT_CLOSED:
+                return True
+
+            # Half open, opened_at is when the trial was claimed
+            now = self.clock()
+            if self.trial_in_flight or now - self.opened_at < self.reset_seconds:
+                return False
+
+            if not self.claim_trial(now):
+                return False
+
+            self.trial_in_flight = True
+            return True
+
+    def claim_trial(self, now):
+        """Moves the circuit to half open with a trial claimed at now.
+
+        Returns:
+            bool: False if another container changed the stored state first
+
+        """
+        if self.store is not None and not self.store.compare_and_put(
+            self.name,
+            (self.state, self.opened_at),
+            (CIRCUIT_HALF_OPEN, self.failure_count, now),
+        ):
+            self.load()
+            return False
+
+        if self.state != CIRCUIT_HALF_OPEN:
+            self.transition(CIRCUIT_HALF_OPEN)
+        self.opened_at = now
+
+        return True
+
+    def release_trial(self):
+        """Gives up a claimed trial that made no call, so the next call can be the trial."""
+        with self.lock:
+            if not self.trial_in_flight:
+                return
+
+            self.trial_in_flight = False
+            # Backdated so the circuit is due a trial straight away
+            self.opened_at = self.clock() - self.reset_seconds
+            self.save()
+
+    def record_success(self):
+        """Records a call the service handled, closing the circuit."""
+        with self.lock:
+            self.trial_in_flight = False
+
+            if self.state == CIRCUIT_CLOSED and self.failure_count == 0:
+                return
+
+            self.failure_count = 0
+            if self.state != CIRCUIT_CLOSED:
+                self.transition(CIRCUIT_CLOSED)
+            self.save()
+
+    def record_failure(self):
+        """Records a call that failed because of the service, opening the circuit if due."""
+        with self.lock:
+            self.trial_in_flight = False
+            self.load()
+            self.failure_count += 1
+
+            if (
+                self.state == CIRCUIT_HALF_OPEN
+                or self.failure_count >= self.failure_threshold
+            ) and self.state != CIRCUIT_OPEN:
+                self.opened_at = self.clock()
+                self.transition(CIRCUIT_OPEN)
+            self.save()
+
+    def transition(self, state):
+        logger.warning(
+            "Circuit breaker state changed",
+            extra={
+                "circuit_breaker": self.name,
+                "from_state": self.state,
+                "to_state": state,
+                "failure_count": self.failure_count,
+            },
+        )
+        increment_metric(
+            {
+                CIRCUIT_OPEN: "CircuitOpened",
+                CIRCUIT_HALF_OPEN: "CircuitHalfOpened",
+                CIRCUIT_CLOSED: "CircuitClosed",
+            }[state]
+        )
+        self.state = state
+
+    def load(self):
+        if self.store is None:
+            return
+
+        stored_state = self.store.get(self.name)
+        if stored_state is not None:
+            self.state, self.failure_count, self.opened_at = stored_state
+
+    def save(self):
+        if self.store is not None:
+            self.store.put(self.name, self.state, self.failure_count, self.opened_at)
+
+
+class SqliteCircuitBreakerStore:
+    """Shared circuit breaker state in a SQLite file, e.g. on a file system all containers mount.
+
+    Any object providing the same get, put and compare_and_put methods can be passed to
+    CircuitBreaker.
+    """
+
+    def __init__(self, path):
+        # Imported here as only deployments with a shared store need it
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS circuit_breakers "
+            "(name TEXT PRIMARY KEY, state TEXT, failure_count INTEGER, opened_at REAL)"
+        )
+        self.connection.commit()
+
+    def get(self, name):
+        """Returns the (state, failure_count, opened_at) of the circuit, or None if unknown."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT state, failure_count, opened_at FROM circuit_breakers "
+                "WHERE name = ?",
+                (name,),
+            ).fetchone()
+
+        return tuple(row) if row else None
+
+    def put(self, name, state, failure_count, opened_at):
+        """Records the state of the circuit."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO circuit_breakers VALUES (?, ?, ?, ?)",
+                (name, state, failure_count, opened_at),
+            )
+            self.connection.commit()
+
+    def compare_and_put(self, name, expected, replacement):
+        """Records the state only if the stored state still matches what was loaded.
+
+        Arguments:
+            name (string): the name of the circuit
+            expected (tuple): the (state, opened_at) the caller last loaded
+            replacement (tuple): the (state, failure_count, opened_at) to record
+
+        Returns:
+            bool: True if the state was recorded
+
+        """
+        state, failure_count, opened_at = replacement
+
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE circuit_breakers SET state = ?, failure_count = ?, "
+                "opened_at = ? WHERE name = ? AND state = ? AND opened_at IS ?",
+                (state, failure_count, opened_at, name) + tuple(expected),
+            )
+            if cursor.rowcount == 0:
+                # A circuit that was never stored has nothing to conflict with
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO circuit_breakers VALUES (?, ?, ?, ?)",
+                    (name, state, failure_count, opened_at),
+                )
+            self.connection.commit()
+
+        return cursor.rowcount == 1
+
+
+def create_submit_circuit_breaker(config):
+    """Creates the batch submission circuit breaker, or returns None if not configured."""
+    if not config.circuit_breaker_failure_threshold:
+        return None
+
+    store = None
+    if config.circuit_breaker_store_path:
+        store = SqliteCircuitBreakerStore(config.circuit_breaker_store_path)
+
+    return CircuitBreaker(
+        "batch-submit",
+        config.circuit_breaker_failure_threshold,
+        config.circuit_breaker_reset_seconds,
+        store,
+    )
+
+
+def is_service_failure(err):
+    """Returns True if the error means the service is unhealthy rather than the request bad."""
+    if isinstance(err, botocore.exceptions.ClientError):
+        error_code = err.response.get("Error", {}).get("Code")
+        status_code = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error_code in THROTTLING_ERROR_CODES or status_code >= 500
+
+    # Other botocore errors, e.g. ParamValidationError, are raised before any request
+    return isinstance(err, CONNECTION_ERRORS)
+
+
+def get_aws_session():
+    """Returns the botocore session the clients are created from, creating it on first use.
+
+    Clients are created from botocore directly, as importing boto3 also imports
+    s3transfer which adds to every cold start without being used.
+    """
+    global aws_session
+
+    if aws_session is None:
+        aws_session = botocore.session.get_session()
+
+    return aws_session
+
+
+def setup_aws_session(profile_name, region_name):
+    """Sets up the botocore session for the given profile and region when run locally."""
+    global aws_session
+
+    aws_session = botocore.session.Session(profile=profile_name)
+    aws_session.set_config_variable("region", region_name)
+
+
+def get_sns_client():
+    global boto_client_config
+
+    return get_aws_session().create_client("sns", config=boto_client_config)
+
+
+def get_batch_client():
+    global boto_client_config
+
+    return get_aws_session().create_client("batch", config=boto_client_config)
+
+
+def get_sqs_client():
+    global boto_client_config
+
+    return get_aws_session().create_client("sqs", config=boto_client_config)
+
+
+def get_s3_client():
+    global boto_client_config
+
+    return get_aws_session().create_client("s3", config=boto_client_config)
+
+
+def get_cached_s3_client():
+    """Returns the s3 client, creating it on first use as only offloaded parameters need it."""
+    global s3_client
+
+    if s3_client is None:
+        with cached_state_lock:
+            if s3_client is None:
+                s3_client = get_s3_client()
+
+    return s3_client
+
+
+def get_cached_sqs_client():
+    """Returns the sqs client, creating it on first use as only deferrals need it."""
+    global sqs_client
+
+    if sqs_client is None:
+        with cached_state_lock:
+            if sqs_client is None:
+                sqs_client = get_sqs_client()
+
+    return sqs_client
+
+
+def handler(event, context):
+    """Handle the event from AWS.
+
+    Args:
+        event (Object): The event details from AWS
+        context (Object): The context info from AWS
+
+    """
+    handler_start = time.perf_counter()
+    config_rebuilt = load_cached_config()
+
+    if metrics is not None:
+        metrics.add_timing("ConfigTime", (time.perf_counter() - handler_start) * 1000)
+        metrics.increment("ConfigRebuilds" if config_rebuilt else "WarmStarts")
+
+    try:
+        if is_profiled_invocation():
+            return profile_invocation(process_event, event, context, config_rebuilt)
+
+        return process_event(event, context, config_rebuilt)
+    finally:
+        flush_error_alerts(sns_client)
+
+        if metrics is not None:
+            metrics.add_timing(
+                "HandlerTime", (time.perf_counter() - handler_start) * 1000
+            )
+            metrics.flush()
+
+
+def process_event(event, context, config_rebuilt):
+    """Launches the batch jobs for the event.
+
+    Args:
+        event (Object): The event details from AWS
+        context (Object): The context info from AWS
+        config_rebuilt (bool): True if the config was built for this invocation
+
+    """
+    logger.info(
+        "SNS Event",
+        extra={"sns_event": event, "mode": "handler", "warm_start": not config_rebuilt},
+    )
+
+    sweep = isinstance(event, dict) and event.get(OUTBOX_SWEEP_EVENT_KEY)
+
+    # Malformed events are rejected before any client is created
+    glue_events = None if sweep else get_glue_events(event)
+
+    if glue_events is None and not sweep:
+        reason = get_event_validator().validate(event)
+        if reason is not None:
+            increment_metric("InvalidEvents")
+            logger.error("Rejecting invalid glue event", extra={"reason": reason})
+            raise InvalidEventError(reason)
+    elif glue_events is not None:
+        valid_glue_events, rejected_results = validate_glue_events(glue_events)
+
+    if metrics is not None:
+        with metrics.time("ClientCreationTime"):
+            batch_client, sns_client = get_cached_clients()
+    else:
+        batch_client, sns_client = get_cached_clients()
+
+    if sweep:
+        totals = sweep_outbox(batch_client, sns_client)
+        logger.info("Outbox sweep complete", extra=totals)
+
+        return totals
+
+    if glue_events is None:
+        if get_routing_index() is not None:
+            result = launch_batch_jobs(batch_client, sns_client, [(None, event)])[0]
+        else:
+            result = launch_batch_job(batch_client, sns_client, event)
+
+        if result["deferred"]:
+            result = divert_deferred_events([(None, event)], [result])[0]
+
+        if result["deferred"]:
+            # Fail the invocation so the event is retried by the lambda service
+            raise SubmissionDeferredError(result["error_message"])
+
+        track_launched_jobs(batch_client, sns_client, [result], context)
+
+        return None
+
+    results = launch_batch_jobs(batch_client, sns_client, valid_glue_events)
+
+    if rejected_results:
+        launched = iter(results)
+        results = [
+            (
+                rejected_results[position]
+                if position in rejected_results
+                else next(launched)
+            )
+            for position in range(len(glue_events))
+        ]
+
+    results = divert_deferred_events(glue_events, results)
+
+    failed_count = len([result for result in results if result["error_message"]])
+    logger.info(
+        "Processed multi-record event",
+        extra={"record_count": len(results), "failed_count": failed_count},
+    )
+
+    log_rate_limiter_metrics()
+    track_launched_jobs(batch_client, sns_client, results, context)
+
+    if is_sqs_event(event):
+        return generate_batch_item_failures(results)
+
+    return results
+
+
+def divert_deferred_events(glue_events, results):
+    """Sends the deferred glue events to the deferral queue, if one is configured.
+
+    Diverted events are handed off rather than failed, so a circuit breaker or full job
+    queues do not hold up the source of the event. Events that fail to send stay deferred.
+
+    Arguments:
+        glue_events (list): (record_id, glue_event) tuples
+        results (list): the launch result for each glue event
+
+    Returns:
+        list: the results, with diverted events no longer deferred
+
+    """
+    if not args.deferral_queue_url:
+        return results
+
+    deferred_positions = [
+        position for position, result in enumerate(results) if result["deferred"]
+    ]
+    if not deferred_positions:
+        return results
+
+    results = list(results)
+    diverted_count = 0
+
+    for index in range(0, len(deferred_positions), MAX_SEND_MESSAGE_BATCH_ENTRIES):
+        entries = [
+            {
+                "Id": str(position),
+                "MessageBody": json.dumps(glue_events[position][1]),
+                "DelaySeconds": args.deferral_delay_seconds,
+            }
+            for position in deferred_positions[
+                index : index + MAX_SEND_MESSAGE_BATCH_ENTRIES
+            ]
+        ]
+
+        try:
+            response = call_aws_api(
+                "SendMessageBatch",
+                get_cached_sqs_client().send_message_batch,
+                QueueUrl=args.deferral_queue_url,
+                Entries=entries,
+            )
+        except botocore.exceptions.ClientError as err:
+            logger.error(
+                "Failed to divert deferred events",
+                extra={"error_message": str(err), "event_count": len(entries)},
+            )
+            continue
+
+        for entry in response.get("Successful", []):
+            position = int(entry["Id"])
+            results[position] = generate_launch_result(results[position]["record_id"])
+            diverted_count += 1
+
+    increment_metric("EventsDiverted", diverted_count)
+    logger.info(
+        "Diverted deferred events to the deferral queue",
+        extra={
+            "diverted_count": diverted_count,
+            "deferred_count": len(deferred_positions),
+            "deferral_queue_url": args.deferral_queue_url,
+        },
+    )
+
+    return results
+
+
+def is_profiled_invocation():
+    """Decides whether to profile this invocation, sampled at the configured rate."""
+    if args.profile_sample_rate <= 0:
+        return False
+
+    if args.profile_sample_rate >= 1:
+        return True
+
+    # Only imported when profiling is switched on to keep it off the cold start path
+    import random
+
+    return random.random() < args.profile_sample_rate
+
+
+def profile_invocation(function, *arguments):
+    """Runs the function under cProfile, and tracemalloc if enabled, logging its hotspots.
+
+    Threads started during the call, such as the submission pool workers, are profiled
+    too and merged into the hotspots. Threads that were already running are not.
+
+    Arguments:
+        function (function): the function to profile
+        arguments (list): the positional arguments for the function
+
+    """
+    # Only imported when profiling is switched on to keep it off the cold start path
+    import cProfile
+    import tracemalloc
+
+    trace_memory = args.profile_trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+
+    thread_profilers = []
+
+    def profile_thread(frame, event, arg):
+        # Called once as each new thread starts, handing it over to its own profiler
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            # From Python 3.12 a single profiler already sees every thread
+            return
+        thread_profilers.append(thread_profiler)
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    threading.setprofile(profile_thread)
+    try:
+        return profiler.runcall(function, *arguments)
+    finally:
+        threading.setprofile(None)
+        duration_milliseconds = (time.perf_counter() - start) * 1000
+        profile = {
+            "duration_milliseconds": round(duration_milliseconds, 3),
+            "hotspots": get_profile_hotspots(
+                [profiler] + thread_profilers, args.profile_top_n
+            ),
+        }
+
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            profile["memory_peak_bytes"] = peak_bytes
+            profile["memory_hotspots"] = get_memory_hotspots(
+                snapshot, args.profile_top_n
+            )
+
+        logger.info("Handler profile", extra={"profile": profile})
+
+
+def get_profile_hotspots(profilers, top_n):
+    """Summarises the functions with the most internal time across the profiles.
+
+    Arguments:
+        profilers (list): the finished cProfile.Profile of each profiled thread
+        top_n (int): the number of functions to include
+
+    Returns:
+        list: the hotspots, most expensive first
+
+    """
+    # Only imported when profiling is switched on to keep it off the cold start path
+    import pstats
+
+    function_stats = pstats.Stats(*profilers).stats
+    heaviest = sorted(
+        function_stats.items(), key=lambda item: item[1][2], reverse=True
+    )[:top_n]
+
+    return [
+        {
+            "function": f"{os.path.basename(file_name)}:{line_number}({function_name})",
+            "calls": call_count,
+            "total_milliseconds": round(total_time * 1000, 3),
+            "cumulative_milliseconds": round(cumulative_time * 1000, 3),
+        }
+        for (file_name, line_number, function_name), (
+            _,
+            call_count,
+            total_time,
+            cumulative_time,
+            _,
+        ) in heaviest
+    ]
+
+
+def get_memory_hotspots(snapshot, top_n):
+    """Summarises the source lines holding the most memory in the tracemalloc snapshot.
+
+    Arguments:
+        snapshot (tracemalloc.Snapshot): the snapshot taken at the end of the invocation
+        top_n (int): the number of lines to include
+
+    Returns:
+        list: the hotspots, largest first
+
+    """
+    return [
+        {
+            "location": f"{os.path.basename(statistic.traceback[0].filename)}:"
+            f"{statistic.traceback[0].lineno}",
+            "size_bytes": statistic.size,
+            "count": statistic.count,
+        }
+        for statistic in snapshot.statistics("lineno")[:top_n]
+    ]
+
+
+def track_launched_jobs(batch_client, sns_client, results, context):
+    """Waits for the launched jobs to finish, within JOB_TRACKING_SECONDS and the timeout.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        results (list): the launch results
+        context (Object): The context info from AWS (or None)
+
+    """
+    if args.job_tracking_seconds <= 0:
+        return
+
+    timeout_seconds = args.job_tracking_seconds
+    if context is not None:
+        timeout_seconds = min(
+            timeout_seconds,
+            context.get_remaining_time_in_millis() / 1000 - JOB_TRACKING_MARGIN_SECONDS,
+        )
+
+    tracker = create_job_status_tracker(batch_client, sns_client)
+    tracker.add_results(results)
+    tracker.wait(timeout_seconds)
+
+
+def create_job_status_tracker(batch_client, sns_client):
+    """Creates a job status tracker with the configured poll intervals."""
+    return JobStatusTracker(
+        batch_client,
+        sns_client,
+        args.job_tracking_min_interval_seconds,
+        args.job_tracking_max_interval_seconds,
+    )
+
+
+class JobStatusTracker:
+    """Follows submitted jobs to completion with batched DescribeJobs calls.
+
+    The poll interval starts at min_interval_seconds and doubles up to
+    max_interval_seconds while no job finishes, dropping back as soon as one does, so
+    long running jobs cost few API calls and short ones are still reported promptly.
+    Failed jobs are alerted through the monitoring SNS topic.
+    """
+
+    def __init__(
+        self,
+        batch_client,
+        sns_client,
+        min_interval_seconds,
+        max_interval_seconds,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.batch_client = batch_client
+        self.sns_client = sns_client
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max(min_interval_seconds, max_interval_seconds)
+        self.clock = clock
+        self.sleep = sleep
+        # A dict rather than a set so jobs are described in submission order
+        self.pending_job_ids = {}
+        self.finished = collections.Counter()
+
+    def add(self, job_id):
+        """Tracks a submitted job, array job children are tracked through their parent."""
+        self.pending_job_ids[job_id.split(":")[0]] = None
+
+    def add_results(self, results):
+        """Tracks the jobs submitted in the launch results, ignoring failures and duplicates."""
+        for result in results:
+            for job_result in result.get("jobs", [result]):
+                if (
+                    job_result["job_id"]
+                    and not job_result["error_message"]
+                    and not job_result["duplicate"]
+                ):
+                    self.add(job_result["job_id"])
+
+    def poll(self):
+        """Describes the pending jobs once, reporting the jobs that have finished.
+
+        Returns:
+            int: the number of jobs that finished since the last poll
+
+        """
+        job_ids = list(self.pending_job_ids)
+        finished_count = 0
+
+        for index in range(0, len(job_ids), MAX_DESCRIBE_JOBS):
+            response = call_aws_api(
+                "DescribeJobs",
+                self.batch_client.describe_jobs,
+                jobs=job_ids[index : index + MAX_DESCRIBE_JOBS],
+            )
+
+            for job in response.get("jobs", []):
+                if job["status"] in TERMINAL_JOB_STATUSES:
+                    self.pending_job_ids.pop(job["jobId"], None)
+                    self.report_job(job)
+                    finished_count += 1
+
+        return finished_count
+
+    def wait(self, timeout_seconds=None):
+        """Polls until every job has finished or the timeout passes.
+
+        Arguments:
+            timeout_seconds (float): the maximum time to wait (or None to wait for all jobs)
+
+        Returns:
+            int: the number of jobs still unfinished
+
+        """
+        deadline = None if timeout_seconds is None else self.clock() + timeout_seconds
+        interval_seconds = self.min_interval_seconds
+
+        while self.pending_job_ids:
+            sleep_seconds = interval_seconds
+            if deadline is not None:
+                sleep_seconds = min(sleep_seconds, deadline - self.clock())
+                if sleep_seconds <= 0:
+                    break
+
+            self.sleep(sleep_seconds)
+
+            if self.poll():
+                interval_seconds = self.min_interval_seconds
+            else:
+                interval_seconds = min(interval_seconds * 2, self.max_interval_seconds)
+
+        logger.info(
+            "Finished tracking batch jobs",
+            extra={
+                "succeeded_count": self.finished["SUCCEEDED"],
+                "failed_count": self.finished["FAILED"],
+                "unfinished_job_ids": list(self.pending_job_ids),
+            },
+        )
+
+        return len(self.pending_job_ids)
+
+    def report_job(self, job):
+        """Logs and records the metrics of a finished job, alerting if it failed."""
+        status = job["status"]
+        self.finished[status] += 1
+        increment_metric("JobsSucceeded" if status == "SUCCEEDED" else "JobsFailed")
+
+        job_details = {
+            "job_id": job["jobId"],
+            "job_name": job.get("jobName"),
+            "status": status,
+            "status_reason": job.get("statusReason"),
+        }
+
+        # Batch reports times as epoch milliseconds
+        if "createdAt" in job and "startedAt" in job:
+            job_details["queued_milliseconds"] = job["startedAt"] - job["createdAt"]
+        if "startedAt" in job and "stoppedAt" in job:
+            job_details["run_milliseconds"] = job["stoppedAt"] - job["startedAt"]
+
+        if metrics is not None:
+            if "queued_milliseconds" in job_details:
+                metrics.add_timing("JobQueuedTime", job_details["queued_milliseconds"])
+            if "run_milliseconds" in job_details:
+                metrics.add_timing("JobRunTime", job_details["run_milliseconds"])
+
+        if status == "SUCCEEDED":
+            logger.info("Batch job succeeded", extra=job_details)
+            return
+
+        logger.warning("Batch job failed", extra=job_details)
+        send_error_alert(
+            self.sns_client,
+            f"Batch job {job['jobId']} failed: "
+            + job.get("statusReason", "no status reason"),
+            {
+                "job_queue": job.get("jobQueue"),
+                "job_name": job.get("jobName"),
+                "job_definition_name": job.get("jobDefinition"),
+            },
+        )
+
+
+def log_rate_limiter_metrics():
+    """Logs the wait time metrics of the configured rate limiters."""
+    for name, rate_limiter in (
+        ("batch_submit", batch_submit_rate_limiter),
+        ("sns_publish", sns_publish_rate_limiter),
+    ):
+        if rate_limiter is None:
+            continue
+
+        metrics = rate_limiter.get_metrics()
+        logger.info(
+            "Rate limiter metrics",
+            extra={
+                "rate_limiter": name,
+                "acquired_count": metrics["acquired_count"],
+                "waited_count": metrics["waited_count"],
+                "total_wait_seconds": metrics["total_wait_seconds"],
+                "max_wait_seconds": metrics["max_wait_seconds"],
+            },
+        )
+
+
+def is_sqs_event(event):
+    """Returns True if the event is a batch of SQS records."""
+    return (
+        isinstance(event, dict)
+        and bool(event.get("Records"))
+        and all(record.get("eventSource") == "aws:sqs" for record in event["Records"])
+    )
+
+
+def generate_batch_item_failures(results):
+    """Generates an SQS partial batch response so only the failed messages are retried.
+
+    Arguments:
+        results (list): the launch result for each SQS record
+
+    """
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": result["record_id"]}
+            for result in results
+            if result["error_message"]
+        ]
+    }
+
+
+def get_glue_events(event):
+    """Extracts the individual glue success events from a multi-record event.
+
+    Supports a plain list of glue events, SQS records (including SNS envelopes delivered
+    via SQS without raw message delivery) and SNS records.
+
+    Arguments:
+        event (Object): The event details from AWS
+
+    Returns:
+        list: (record_id, glue_event) tuples, or None if the event is a single glue event
+
+    """
+    if isinstance(event, list):
+        return [
+            (
+                (
+                    glue_event.get("correlation_id", str(index))
+                    if isinstance(glue_event, dict)
+                    else str(index)
+                ),
+                glue_event,
+            )
+            for index, glue_event in enumerate(event)
+        ]
+
+    if not isinstance(event, dict) or "Records" not in event:
+        return None
+
+    glue_events = []
+    for index, record in enumerate(event["Records"]):
+        if record.get("eventSource") == "aws:sqs":
+            record_id = record["messageId"]
+            glue_event = load_json_message(record["body"])
+            if (
+                isinstance(glue_event, dict)
+                and glue_event.get("Type") == "Notification"
+                and "Message" in glue_event
+            ):
+                glue_event = load_json_message(glue_event["Message"])
+        elif record.get("EventSource") == "aws:sns":
+            record_id = record["Sns"]["MessageId"]
+            glue_event = load_json_message(record["Sns"]["Message"])
+        else:
+            record_id = str(index)
+            glue_event = record
+
+        glue_events.append((record_id, glue_event))
+
+    return glue_events
+
+
+def load_json_message(message):
+    """Parses a record's json message, returning None if it is malformed so only that
+    record fails validation."""
+    try:
+        return json.loads(message)
+    except ValueError:
+        return None
+
+
+class GlueEventValidator:
+    """Checks glue events against the fields the config needs, compiled once per config.
+
+    An event must be a json object with every required field set to a non-empty
+    scalar, matching the field's regular expression if it has one. Checks run in
+    order and stop at the first failure, so a valid event costs a few dict lookups.
+    """
+
+    def __init__(self, field_patterns):
+        self.checks = tuple(
+            (field, re.compile(pattern).fullmatch if pattern is not None else None)
+            for field, pattern in field_patterns.items()
+        )
+
+    def validate(self, glue_event):
+        """Returns why the event is invalid, or None if it is valid."""
+        if not isinstance(glue_event, dict):
+            return "Event is not a json object"
+
+        for field, fullmatch in self.checks:
+            value = glue_event.get(field)
+
+            if value is None or value == "":
+                return f"Event field '{field}' is missing"
+
+            if isinstance(value, (dict, list)):
+                return f"Event field '{field}' is not a single value"
+
+            if fullmatch is not None and fullmatch(str(value)) is None:
+                return f"Event field '{field}' has an unexpected value"
+
+        return None
+
+
+def get_event_validator():
+    """Returns the glue event validator, compiling it on first use.
+
+    Required fields are those in GLUE_EVENT_SCHEMA_JSON and any used by the job name
+    and parameter templates, including those of pipeline stages.
+    """
+    global event_validator
+
+    if event_validator is None:
+        with cached_state_lock:
+            if event_validator is None:
+                event_validator = compile_event_validator()
+
+    return event_validator
+
+
+def compile_event_validator():
+    """Compiles the glue event validator from the templates and GLUE_EVENT_SCHEMA_JSON."""
+    templates = list((args.batch_parameters_template_json or {}).values())
+    if args.batch_job_name_template:
+        templates.append(args.batch_job_name_template)
+
+    for _, job_spec, _ in get_pipeline() or []:
+        templates.extend((job_spec.get("parameters_template") or {}).values())
+        if job_spec.get("job_name_template"):
+            templates.append(job_spec["job_name_template"])
+
+    field_patterns = {
+        field_name: None
+        for template in templates
+        if isinstance(template, str)
+        for _, field_name in compile_template(template)
+        if field_name is not None
+    }
+    field_patterns.update(args.glue_event_schema_json or {})
+
+    return GlueEventValidator(field_patterns)
+
+
+def validate_glue_events(glue_events):
+    """Splits the glue events of a multi-record event into the valid and the rejected.
+
+    Arguments:
+        glue_events (list): (record_id, glue_event) tuples
+
+    Returns:
+        tuple: the valid (record_id, glue_event) tuples, and the failed launch results
+            of the invalid events keyed by their position in glue_events
+
+    """
+    validator = get_event_validator()
+    valid_glue_events = []
+    rejected_results = {}
+
+    for position, (record_id, glue_event) in enumerate(glue_events):
+        reason = validator.validate(glue_event)
+
+        if reason is None:
+            valid_glue_events.append((record_id, glue_event))
+            continue
+
+        increment_metric("InvalidEvents")
+        logger.error(
+            "Rejecting invalid glue event",
+            extra={"reason": reason, "record_id": record_id},
+        )
+        rejected_results[position] = generate_launch_result(
+            record_id, error_message=reason
+        )
+
+    return valid_glue_events, rejected_results
+
+
+def launch_batch_jobs(batch_client, sns_client, glue_events):
+    """Launches a batch job per glue event through a bounded thread pool.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_events (list): (record_id, glue_event) tuples
+
+    Returns:
+        list: the result of each launch, in the same order as glue_events
+
+    """
+    max_workers = max(1, min(args.batch_submit_concurrency, len(glue_events)))
+
+    if get_routing_index() is not None:
+        return launch_routed_batch_jobs(
+            batch_client, sns_client, glue_events, max_workers
+        )
+
+    if args.batch_submit_engine == "asyncio":
+        engine = AsyncSubmissionEngine(max_workers)
+        return engine.run(
+            engine.launch_batch_jobs, batch_client, sns_client, glue_events
+        )
+
+    if args.batch_coalesce_max_events > 1:
+        return launch_coalesced_batch_jobs(
+            batch_client, sns_client, glue_events, max_workers
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                launch_batch_job_for_record,
+                batch_client,
+                sns_client,
+                glue_event,
+                record_id,
+            )
+            for record_id, glue_event in glue_events
+        ]
+
+        return [future.result() for future in futures]
+
+
+def launch_routed_batch_jobs(batch_client, sns_client, glue_events, max_workers):
+    """Launches the jobs the routing index matches for each glue event.
+
+    Events matching no route launch the job configured by the BATCH_JOB_* variables.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_events (list): (record_id, glue_event) tuples
+        max_workers (int): the maximum number of jobs submitted in parallel
+
+    Returns:
+        list: the merged result of each glue event's jobs, in the same order as glue_events
+
+    """
+    launches = [
+        (position, record_id, glue_event, job_spec)
+        for position, (record_id, glue_event) in enumerate(glue_events)
+        for job_spec in get_routing_index().match(glue_event) or [None]
+    ]
+
+    max_workers = max(1, min(args.batch_submit_concurrency, len(launches)))
+
+    if args.batch_submit_engine == "asyncio":
+        engine = AsyncSubmissionEngine(max_workers)
+        results = engine.run(
+            engine.launch_routed_batch_jobs, batch_client, sns_client, launches
+        )
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    launch_batch_job_for_record,
+                    batch_client,
+                    sns_client,
+                    glue_event,
+                    record_id,
+                    job_spec,
+                )
+                for _, record_id, glue_event, job_spec in launches
+            ]
+            results = [future.result() for future in futures]
+
+    return merge_routed_results(glue_events, launches, results)
+
+
+def merge_routed_results(glue_events, launches, results):
+    """Merges the results of the jobs launched for each glue event into one per event.
+
+    An event fails if any of its jobs failed, so its source retries it, and is deferred
+    if any of its jobs were deferred. The individual job results are kept under "jobs".
+
+    Arguments:
+        glue_events (list): (record_id, glue_event) tuples
+        launches (list): (position, record_id, glue_event, job_spec) tuples that were launched
+        results (list): the result of each launch
+
+    Returns:
+        list: the merged results, in the same order as glue_events
+
+    """
+    job_results = [[] for _ in glue_events]
+    for (position, _, _, _), result in zip(launches, results):
+        job_results[position].append(result)
+
+    merged_results = []
+    for (record_id, _), record_results in zip(glue_events, job_results):
+        error_messages = [
+            result["error_message"]
+            for result in record_results
+            if result["error_message"]
+        ]
+
+        merged_result = generate_launch_result(
+            record_id,
+            job_arn=record_results[0]["job_arn"],
+            job_id=record_results[0]["job_id"],
+            error_message="; ".join(error_messages) or None,
+            duplicate=all(result["duplicate"] for result in record_results),
+            deferred=any(result["deferred"] for result in record_results),
+        )
+        merged_result["jobs"] = record_results
+        merged_results.append(merged_result)
+
+    return merged_results
+
+
+def launch_coalesced_batch_jobs(batch_client, sns_client, glue_events, max_workers):
+    """Coalesces glue events into array jobs, submitted through a bounded thread pool.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_events (list): (record_id, glue_event) tuples
+        max_workers (int): the maximum number of array jobs submitted in parallel
+
+    Returns:
+        list: the result of each launch, in the same order as glue_events
+
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        coalescer = EventCoalescer(
+            args.batch_coalesce_max_events,
+            args.batch_coalesce_window_seconds,
+            lambda coalesced_events: futures.append(
+                executor.submit(
+                    launch_array_batch_job, batch_client, sns_client, coalesced_events
+                )
+            ),
+        )
+
+        for record_id, glue_event in glue_events:
+            coalescer.add(record_id, glue_event)
+        coalescer.flush()
+
+        return [result for future in futures for result in future.result()]
+
+
+class AsyncSubmissionEngine:
+    """Drives submissions from an asyncio event loop with at most concurrency calls in flight.
+
+    botocore has no asynchronous API, so each blocking call runs on an executor sized to
+    the concurrency while coroutines schedule, compose and gather them. Synchronous
+    callers such as the handler drive a coroutine to completion with run. asyncio is
+    imported in the methods so the thread pool engine does not pay for it at cold start.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.executor = None
+
+    def run(self, coroutine_function, *arguments):
+        """Runs the coroutine function to completion on a new event loop.
+
+        Arguments:
+            coroutine_function (function): the coroutine function, e.g. a method of the engine
+            arguments (list): the positional arguments for the coroutine function
+
+        """
+        import asyncio
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency
+        )
+        try:
+            return asyncio.run(coroutine_function(*arguments))
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def call(self, function, *arguments, **keyword_arguments):
+        """Runs a blocking function on the engine's executor, returning its result."""
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(function, *arguments, **keyword_arguments)
+        )
+
+    async def submit_batch_job(self, *arguments, **keyword_arguments):
+        """Asynchronous counterpart of submit_batch_job, taking the same arguments."""
+        return await self.call(submit_batch_job, *arguments, **keyword_arguments)
+
+    async def send_sns_message(self, *arguments):
+        """Asynchronous counterpart of send_sns_message, taking the same arguments."""
+        return await self.call(send_sns_message, *arguments)
+
+    async def launch_routed_batch_jobs(self, batch_client, sns_client, launches):
+        """Launches a batch job per routed launch.
+
+        Arguments:
+            batch_client (client): The boto3 client for Batch
+            sns_client (client): The boto3 client for SNS
+            launches (list): (position, record_id, glue_event, job_spec) tuples
+
+        Returns:
+            list: the result of each launch, in the same order as launches
+
+        """
+        import asyncio
+
+        return list(
+            await asyncio.gather(
+                *(
+                    self.call(
+                        launch_batch_job_for_record,
+                        batch_client,
+                        sns_client,
+                        glue_event,
+                        record_id,
+                        job_spec,
+                    )
+                    for _, record_id, glue_event, job_spec in launches
+                )
+            )
+        )
+
+    async def launch_batch_jobs(self, batch_client, sns_client, glue_events):
+        """Launches a batch job per glue event, or coalesced array jobs if configured.
+
+        Arguments:
+            batch_client (client): The boto3 client for Batch
+            sns_client (client): The boto3 client for SNS
+            glue_events (list): (record_id, glue_event) tuples
+
+        Returns:
+            list: the result of each launch, in the same order as glue_events
+
+        """
+        import asyncio
+
+        if args.batch_coalesce_max_events <= 1:
+            return list(
+                await asyncio.gather(
+                    *(
+                        self.call(
+                            launch_batch_job_for_record,
+                            batch_client,
+                            sns_client,
+                            glue_event,
+                            record_id,
+                        )
+                        for record_id, glue_event in glue_events
+                    )
+                )
+            )
+
+        array_launches = []
+        coalescer = EventCoalescer(
+            args.batch_coalesce_max_events,
+            args.batch_coalesce_window_seconds,
+            lambda coalesced_events: array_launches.append(
+                asyncio.ensure_future(
+                    self.call(
+                        launch_array_batch_job,
+                        batch_client,
+                        sns_client,
+                        coalesced_events,
+                    )
+                )
+            ),
+        )
+
+        for record_id, glue_event in glue_events:
+            coalescer.add(record_id, glue_event)
+        coalescer.flush()
+
+        return [
+            result
+            for results in await asyncio.gather(*array_launches)
+            for result in results
+        ]
+
+
+class EventCoalescer:
+    """Buffers glue events and hands them on in groups.
+
+    A group is flushed once max_events are buffered or window_seconds has passed since
+    the first buffered event, whichever comes first.
+    """
+
+    def __init__(
+        self, max_events, window_seconds, flush_callback, clock=time.monotonic
+    ):
+        self.max_events = max_events
+        self.window_seconds = window_seconds
+        self.flush_callback = flush_callback
+        self.clock = clock
+        self.buffer = []
+        self.first_event_time = None
+
+    def add(self, record_id, glue_event):
+        """Buffers the event, flushing if the count or window has been reached."""
+        if not self.buffer:
+            self.first_event_time = self.clock()
+
+        self.buffer.append((record_id, glue_event))
+
+        if len(self.buffer) >= self.max_events:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        """Flushes the buffer if the window has elapsed since the first buffered event."""
+        if (
+            self.buffer
+            and self.window_seconds
+            and self.clock() - self.first_event_time >= self.window_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        """Hands any buffered events to the flush callback."""
+        if not self.buffer:
+            return
+
+        coalesced_events = self.buffer
+        self.buffer = []
+        self.first_event_time = None
+        self.flush_callback(coalesced_events)
+
+
+def launch_array_batch_job(batch_client, sns_client, glue_events):
+    """Launches one array job for the glue events, child index N processing manifest entry N.
+
+    The manifest is passed as a json list in the job parameter named by
+    ARRAY_MANIFEST_PARAMETER. Each entry is the rendered parameters for the event when
+    BATCH_PARAMETERS_TEMPLATE_JSON is set, otherwise the glue event itself. The job
+    is named BATCH_JOB_NAME, or BATCH_JOB_NAME_TEMPLATE rendered from the first event
+    when only the template is set. With BATCH_PIPELINE_JSON set, each stage is an
+    array job over the same manifest.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_events (list): (record_id, glue_event) tuples
+
+    Returns:
+        list: the result of each launch, in the same order as glue_events
+
+    """
+    results = [None] * len(glue_events)
+    members = []
+    manifest = []
+
+    for position, (record_id, glue_event) in enumerate(glue_events):
+        try:
+            job_request = build_job_request(glue_event)
+        except Exception as err:
+            logger.error(
+                "Unable to build batch job request",
+                extra={"error_message": err, "record_id": record_id},
+            )
+            results[position] = generate_launch_result(
+                record_id, error_message=str(err)
+            )
+            continue
+
+        idempotency_key = generate_idempotency_key(glue_event, job_request)
+        if idempotency_key is not None:
+            existing_job_id = claim_idempotency_key(idempotency_key)
+            if existing_job_id is not None:
+                increment_metric("DuplicatesSkipped")
+                results[position] = generate_launch_result(
+                    record_id, job_id=existing_job_id, duplicate=True
+                )
+                continue
+
+        members.append((position, record_id, glue_event, idempotency_key))
+        manifest.append(
+            job_request["parameters"]
+            if args.batch_parameters_template_json
+            else glue_event
+        )
+
+    if len(members) == 1:
+        # Batch array jobs need at least two children, so a lone event is a plain job
+        position, record_id, glue_event, idempotency_key = members[0]
+        if idempotency_key is not None:
+            release_idempotency_key(idempotency_key)
+        results[position] = launch_batch_job_for_record(
+            batch_client, sns_client, glue_event, record_id
+        )
+    elif members:
+        manifest_json = json.dumps(manifest)
+        job_request = build_job_request()
+
+        stage_job_ids = {}
+        try:
+            # The array job takes the hints of its most urgent event so none waits longer
+            scheduling_hints = max(
+                (get_scheduling_hints(glue_event) for _, _, glue_event, _ in members),
+                key=lambda hints: hints.get("scheduling_priority", float("-inf")),
+            )
+
+            # Every stage of a pipeline is an array job over the same manifest
+            for stage_name, job_spec, dependencies in get_pipeline() or [
+                (None, None, [])
+            ]:
+                job_request = build_job_request(None, job_spec)
+                if not job_request["job_name"]:
+                    # Without a fixed name the array is named after its first event
+                    job_request["job_name"] = build_job_request(
+                        members[0][2], job_spec
+                    )["job_name"]
+                job_request["job_queue"] = route_job_queue(
+                    batch_client, job_request["job_queue"], len(members)
+                )
+                job_request["job_definition_name"] = resolve_job_definition(
+                    batch_client,
+                    job_request["job_queue"],
+                    job_request["job_definition_name"],
+                )
+
+                parameters = dict(job_request["parameters"] or {})
+                parameters[ARRAY_MANIFEST_PARAMETER] = manifest_json
+
+                submit_arguments = dict(scheduling_hints)
+                for dependency, dependency_type in dependencies:
+                    # With N_TO_N, child N waits only on child N of the stage it depends on
+                    dependency_entry = {"jobId": stage_job_ids[dependency]}
+                    if dependency_type:
+                        dependency_entry["type"] = dependency_type
+                    submit_arguments.setdefault("depends_on", []).append(
+                        dependency_entry
+                    )
+
+                response = submit_batch_job(
+                    batch_client,
+                    job_request["job_queue"],
+                    job_request["job_name"],
+                    job_request["job_definition_name"],
+                    parameters,
+                    array_size=len(members),
+                    **submit_arguments,
+                )
+
+                job_arn = response["jobArn"]
+                job_id = response["jobId"]
+                stage_job_ids[stage_name] = job_id
+
+                logger.info(
+                    "Batch array job submitted successfully",
+                    extra={
+                        "job_queue": job_request["job_queue"],
+                        "job_name": job_request["job_name"],
+                        "job_definition_name": job_request["job_definition_name"],
+                        "job_arn": job_arn,
+                        "job_id": job_id,
+                        "array_size": len(members),
+                        "stage": stage_name,
+                    },
+                )
+
+            for index, (position, record_id, _, idempotency_key) in enumerate(members):
+                child_job_id = f"{job_id}:{index}"
+                if idempotency_key is not None:
+                    record_idempotency_key(idempotency_key, child_job_id)
+                results[position] = generate_launch_result(
+                    record_id, job_arn=job_arn, job_id=child_job_id
+                )
+        except Exception as err:
+            if isinstance(err, botocore.exceptions.ClientError):
+                error_message = err.response["Error"]["Message"]
+            else:
+                error_message = str(err)
+
+            deferred = isinstance(err, SubmissionDeferredError)
+
+            if deferred:
+                increment_metric("SubmissionsDeferred", len(members))
+                logger.warning(
+                    "Deferring batch array job submission",
+                    extra={
+                        "reason": error_message,
+                        "job_name": job_request["job_name"],
+                        "array_size": len(members),
+                    },
+                )
+            else:
+                logger.error(
+                    "Error occurred submitting batch array job",
+                    extra={
+                        "error_message": error_message,
+                        "job_queue": job_request["job_queue"],
+                        "job_name": job_request["job_name"],
+                        "job_definition_name": job_request["job_definition_name"],
+                        "array_size": len(members),
+                    },
+                )
+
+                send_error_alert(sns_client, error_message)
+
+            # The keys are released so a retry resubmits every stage, which would leave
+            # the arrays already submitted running twice
+            terminate_batch_jobs(
+                batch_client,
+                stage_job_ids.values(),
+                f"Array job submission failed: {error_message}",
+            )
+
+            for position, record_id, _, idempotency_key in members:
+                if idempotency_key is not None:
+                    release_idempotency_key(idempotency_key)
+                results[position] = generate_launch_result(
+                    record_id, error_message=error_message, deferred=deferred
+                )
+
+    return results
+
+
+def launch_batch_job_for_record(
+    batch_client, sns_client, glue_event, record_id, job_spec=None
+):
+    """Launches a batch job for one record, converting unexpected errors into a failed result.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_event (dict): the glue success event for the record
+        record_id (string): the id of the record being processed
+        job_spec (dict): the routed job spec to launch (or None for the configured job)
+
+    """
+    try:
+        return launch_batch_job(
+            batch_client, sns_client, glue_event, record_id, job_spec
+        )
+    except Exception as err:
+        error_message = str(err)
+
+        logger.error(
+            "Unexpected error launching batch job",
+            extra={"error_message": error_message, "record_id": record_id},
+        )
+
+        send_error_alert(sns_client, error_message)
+
+        return generate_launch_result(record_id, error_message=error_message)
+
+
+def launch_batch_job(
+    batch_client,
+    sns_client,
+    glue_event=None,
+    record_id=None,
+    job_spec=None,
+    depends_on=None,
+):
+    """Submits the batch job, sending a monitoring alert if submission fails.
+
+    The configured job is launched as a pipeline when BATCH_PIPELINE_JSON is set.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_event (dict): the glue success event the job is launched for (or None)
+        record_id (string): the id of the record being processed (or None)
+        job_spec (dict): the routed job spec to launch (or None for the configured job)
+        depends_on (list): the dependsOn entries of the jobs this job waits for (or None)
+
+    Returns:
+        dict: the launch result containing the job id or the error message
+
+    """
+    if job_spec is None and get_pipeline() is not None:
+        return launch_pipeline(batch_client, sns_client, glue_event, record_id)
+
+    job_request = build_job_request(glue_event, job_spec)
+
+    idempotency_key = generate_idempotency_key(glue_event, job_request)
+    if idempotency_key is not None:
+        existing_job_id = claim_idempotency_key(idempotency_key)
+
+        if existing_job_id is not None:
+            increment_metric("DuplicatesSkipped")
+            logger.info(
+                "Skipping duplicate batch job submission",
+                extra={
+                    "idempotency_key": idempotency_key,
+                    "existing_job_id": existing_job_id,
+                    "job_name": job_request["job_name"],
+                    "record_id": record_id,
+                },
+            )
+
+            return generate_launch_result(
+                record_id, job_id=existing_job_id, duplicate=True
+            )
+
+    # Taken before routing so a retried event maps to the same entry whichever queue it gets
+    outbox_entry_id = generate_outbox_entry_id(glue_event, job_request)
+    outbox_claimed = False
+
+    try:
+        job_request["job_queue"] = route_job_queue(
+            batch_client, job_request["job_queue"]
+        )
+        job_request["job_definition_name"] = resolve_job_definition(
+            batch_client, job_request["job_queue"], job_request["job_definition_name"]
+        )
+        scheduling_hints = get_scheduling_hints(glue_event)
+
+        if outbox_entry_id is not None:
+            existing_job_id = open_outbox_entry(
+                batch_client,
+                outbox_entry_id,
+                generate_outbox_submission(job_request, scheduling_hints, depends_on),
+            )
+
+            if existing_job_id is not None:
+                increment_metric("DuplicatesSkipped")
+                logger.info(
+                    "Skipping batch job already submitted from the outbox",
+                    extra={
+                        "outbox_entry_id": outbox_entry_id,
+                        "existing_job_id": existing_job_id,
+                        "job_name": job_request["job_name"],
+                        "record_id": record_id,
+                    },
+                )
+
+                if idempotency_key is not None:
+                    record_idempotency_key(idempotency_key, existing_job_id)
+
+                return generate_launch_result(
+                    record_id, job_id=existing_job_id, duplicate=True
+                )
+
+            outbox_claimed = True
+
+        submit_arguments = dict(scheduling_hints)
+        if depends_on:
+            submit_arguments["depends_on"] = depends_on
+
+        response = submit_batch_job(
+            batch_client,
+            job_request["job_queue"],
+            job_request["job_name"],
+            job_request["job_definition_name"],
+            job_request["parameters"],
+            **submit_arguments,
+        )
+
+        job_arn = response["jobArn"]
+        job_id = response["jobId"]
+
+        if outbox_claimed:
+            # Once launched the entry must stay, even if completing it fails below
+            outbox_claimed = False
+            get_outbox_store().complete(outbox_entry_id, job_id, time.time())
+
+        logger.info(
+            "Batch job submitted successfully",
+            extra={
+                "job_queue": job_request["job_queue"],
+                "job_name": job_request["job_name"],
+                "job_definition_name": job_request["job_definition_name"],
+                "job_arn": job_arn,
+                "job_id": job_id,
+                "record_id": record_id,
+            },
+        )
+
+        if idempotency_key is not None:
+            record_idempotency_key(idempotency_key, job_id)
+
+        return generate_launch_result(record_id, job_arn=job_arn, job_id=job_id)
+    except Exception as err:
+        if idempotency_key is not None:
+            release_idempotency_key(idempotency_key)
+
+        if outbox_claimed:
+            abandon_outbox_entry(outbox_entry_id, err)
+
+        if isinstance(err, SubmissionDeferredError):
+            increment_metric("SubmissionsDeferred")
+            logger.warning(
+                "Deferring batch job submission",
+                extra={
+                    "reason": err,
+                    "job_name": job_request["job_name"],
+                    "record_id": record_id,
+                },
+            )
+
+            return generate_launch_result(
+                record_id, error_message=str(err), deferred=True
+            )
+
+        if isinstance(err, botocore.exceptions.ClientError):
+            error_message = err.response["Error"]["Message"]
+        elif isinstance(err, SubmissionRejectedError):
+            error_message = str(err)
+        else:
+            raise
+
+        logger.error(
+            "Error occurred submitting batch job",
+            extra={
+                "error_message": error_message,
+                "job_queue": job_request["job_queue"],
+                "job_name": job_request["job_name"],
+                "job_definition_name": job_request["job_definition_name"],
+                "record_id": record_id,
+            },
+        )
+
+        send_error_alert(sns_client, error_message, job_request)
+
+        return generate_launch_result(record_id, error_message=error_message)
+
+
+def launch_pipeline(batch_client, sns_client, glue_event=None, record_id=None):
+    """Submits every stage of the pipeline, each depending on the jobs of earlier stages.
+
+    Batch holds a stage until the jobs it depends on have succeeded, so the whole
+    pipeline is submitted at once with no polling between stages. Submission stops at
+    the first stage that fails or is deferred, as its dependents cannot be wired to it.
+    The stages already submitted are terminated unless idempotency keys or the outbox
+    let a retry resume from them.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_event (dict): the glue success event the pipeline is launched for (or None)
+        record_id (string): the id of the record being processed (or None)
+
+    Returns:
+        dict: the result of the last stage launched, with every stage's result under "jobs"
+
+    """
+    stage_job_ids = {}
+    stage_results = []
+    resumable = glue_event is not None and (
+        bool(args.idempotency_key_fields) or get_outbox_store() is not None
+    )
+
+    for stage_name, job_spec, dependencies in get_pipeline():
+        # A plain job can only wait on the whole of the jobs it depends on
+        depends_on = [
+            {"jobId": stage_job_ids[dependency]} for dependency, _ in dependencies
+        ]
+
+        result = launch_batch_job(
+            batch_client, sns_client, glue_event, record_id, job_spec, depends_on
+        )
+        result["stage"] = stage_name
+        stage_results.append(result)
+
+        if result["job_id"] is None or result["job_id"] == PENDING_JOB_ID:
+            # Failed, deferred or still being launched by another delivery of the event
+            if result["job_id"] is None and not resumable:
+                # Nothing records the stages submitted, so a retry would run them twice
+                terminate_batch_jobs(
+                    batch_client,
+                    stage_job_ids.values(),
+                    f"Pipeline submission failed: {result['error_message']}",
+                )
+            break
+
+        stage_job_ids[stage_name] = result["job_id"]
+
+    last_result = stage_results[-1]
+    merged_result = generate_launch_result(
+        record_id,
+        job_arn=last_result["job_arn"],
+        job_id=last_result["job_id"],
+        error_message=last_result["error_message"],
+        duplicate=all(result["duplicate"] for result in stage_results),
+        deferred=last_result["deferred"],
+    )
+    merged_result["jobs"] = stage_results
+
+    return merged_result
+
+
+def compile_pipeline(stages):
+    """Validates the pipeline stages, returning them in an order they can be submitted in.
+
+    Arguments:
+        stages (list): job specs, each with a unique "stage" name and optionally
+            "depends_on", a list of stage names or dicts of "stage" and "type"
+
+    Returns:
+        list: (stage_name, job_spec, dependencies) tuples where dependencies are
+            (stage_name, dependency_type) tuples and dependency_type may be None
+
+    Raises:
+        ValueError: if a stage is invalid, or the dependencies are unknown or cyclic
+
+    """
+    if not isinstance(stages, list) or not stages:
+        raise ValueError("The pipeline must be a non-empty list of stages")
+
+    compiled_stages = {}
+    job_identities = set()
+
+    for order, stage in enumerate(stages):
+        if not isinstance(stage, dict) or not isinstance(stage.get("stage"), str):
+            raise ValueError(f"Pipeline stage {order} needs a stage name")
+
+        stage_name = stage["stage"]
+        if stage_name in compiled_stages:
+            raise ValueError(f"Pipeline stage {stage_name} is defined more than once")
+
+        unknown_fields = set(stage) - PIPELINE_STAGE_FIELDS
+        if unknown_fields:
+            raise ValueError(
+                f"Pipeline stage {stage_name} has unknown fields {sorted(unknown_fields)}"
+            )
+
+        # Stages share idempotency and outbox keys unless their jobs differ
+        job_identity = tuple(
+            json.dumps(stage.get(field), sort_keys=True)
+            for field in ("job_definition_name", "job_name", "job_name_template")
+        )
+        if job_identity in job_identities:
+            raise ValueError(
+                f"Pipeline stage {stage_name} needs a job name or job definition "
+                "differing from the other stages"
+            )
+        job_identities.add(job_identity)
+
+        dependencies = []
+        for dependency in stage.get("depends_on") or []:
+            if isinstance(dependency, str):
+                dependency = {"stage": dependency}
+
+            dependency_type = dependency.get("type")
+            if dependency_type is not None and (
+                dependency_type not in PIPELINE_DEPENDENCY_TYPES
+            ):
+                raise ValueError(
+                    f"Pipeline stage {stage_name} has unknown dependency type "
+                    f"{dependency_type}"
+                )
+
+            dependencies.append((dependency.get("stage"), dependency_type))
+
+        job_spec = {
+            field: value
+            for field, value in stage.items()
+            if field in ROUTING_JOB_SPEC_FIELDS
+        }
+        compiled_stages[stage_name] = (stage_name, job_spec, dependencies)
+
+    for stage_name, _, dependencies in compiled_stages.values():
+        for dependency, _ in dependencies:
+            if dependency not in compiled_stages:
+                raise ValueError(
+                    f"Pipeline stage {stage_name} depends on unknown stage {dependency}"
+                )
+
+    # Stages are submitted in config order, each held back until its dependencies are in
+    ordered_stages = []
+    submitted = set()
+    remaining = list(compiled_stages.values())
+
+    while remaining:
+        ready = [
+            compiled_stage
+            for compiled_stage in remaining
+            if all(dependency in submitted for dependency, _ in compiled_stage[2])
+        ]
+        if not ready:
+            raise ValueError(
+                "Pipeline stages "
+                f"{sorted(compiled_stage[0] for compiled_stage in remaining)} "
+                "have cyclic dependencies"
+            )
+
+        for compiled_stage in ready:
+            ordered_stages.append(compiled_stage)
+            submitted.add(compiled_stage[0])
+        remaining = [
+            compiled_stage
+            for compiled_stage in remaining
+            if compiled_stage[0] not in submitted
+        ]
+
+    return ordered_stages
+
+
+def get_pipeline():
+    """Returns the compiled pipeline stages, or None if no BATCH_PIPELINE_JSON is configured."""
+    global pipeline_stages
+
+    if pipeline_stages is None and args.batch_pipeline_json:
+        with cached_state_lock:
+            if pipeline_stages is None:
+                pipeline_stages = compile_pipeline(args.batch_pipeline_json)
+
+    return pipeline_stages
+
+
+def build_job_request(glue_event=None, job_spec=None):
+    """Builds the batch job request, rendering any configured templates from the glue event.
+
+    Arguments:
+        glue_event (dict): the glue success event the job is launched for (or None)
+        job_spec (dict): a routed job spec overriding the configured job (or None)
+
+    Returns:
+        dict: the job queue, job name, job definition name and parameters to submit
+
+    """
+    job_request = {
+        "job_queue": args.batch_job_queue,
+        "job_name": args.batch_job_name,
+        "job_definition_name": args.batch_job_definition_name,
+        "parameters": args.batch_parameters_json,
+    }
+    job_name_template = args.batch_job_name_template
+    parameters_template = args.batch_parameters_template_json
+
+    if job_spec is not None:
+        for field in ("job_queue", "job_name", "job_definition_name", "parameters"):
+            if field in job_spec:
+                job_request[field] = job_spec[field]
+
+        # A job spec's own name or parameters replace the configured templates
+        if "job_name" in job_spec or "job_name_template" in job_spec:
+            job_name_template = job_spec.get("job_name_template")
+        if "parameters" in job_spec or "parameters_template" in job_spec:
+            parameters_template = job_spec.get("parameters_template")
+
+    if glue_event is None:
+        return job_request
+
+    if job_name_template:
+        job_name = render_template(job_name_template, glue_event)
+        job_request["job_name"] = INVALID_JOB_NAME_CHARACTERS.sub("_", job_name)[
+            :MAX_JOB_NAME_LENGTH
+        ]
+
+    if parameters_template:
+        job_request["parameters"] = {
+            key: render_template(value, glue_event)
+            for key, value in parameters_template.items()
+        }
+
+    return job_request
+
+
+class RoutingIndex:
+    """Matches glue events to the job specs of routes keyed on collection name patterns.
+
+    Patterns are compiled once: exact names into a dict, prefix patterns ending in * into
+    a character trie walked once along the collection name, and patterns starting re:
+    into regular expressions, the only ones tried one by one. Lookups therefore cost the
+    length of the name plus the number of regex routes, however many exact and prefix
+    routes there are. Routes may also restrict the snapshot_type they match.
+    """
+
+    def __init__(self, routes):
+        self.exact_routes = {}
+        self.prefix_trie = {}
+        self.regex_routes = []
+        self.route_count = len(routes)
+
+        for order, route in enumerate(routes):
+            compiled_route = self.compile_route(order, route)
+            pattern = route["collection_name"]
+
+            if pattern.startswith(ROUTING_REGEX_PREFIX):
+                self.regex_routes.append(
+                    (re.compile(pattern[len(ROUTING_REGEX_PREFIX) :]), compiled_route)
+                )
+            elif pattern.endswith(ROUTING_PREFIX_WILDCARD):
+                node = self.prefix_trie
+                for character in pattern[: -len(ROUTING_PREFIX_WILDCARD)]:
+                    node = node.setdefault(character, {})
+                node.setdefault(None, []).append(compiled_route)
+            else:
+                self.exact_routes.setdefault(pattern, []).append(compiled_route)
+
+    @staticmethod
+    def compile_route(order, route):
+        """Validates a route, returning (order, snapshot_types, job_specs)."""
+        if "collection_name" not in route or not route.get("jobs"):
+            raise ValueError(f"Route {order} needs a collection_name and jobs")
+
+        for job_spec in route["jobs"]:
+            unknown_fields = set(job_spec) - ROUTING_JOB_SPEC_FIELDS
+            if unknown_fields:
+                raise ValueError(
+                    f"Route {order} has unknown job spec fields {sorted(unknown_fields)}"
+                )
+
+        snapshot_types = route.get("snapshot_type")
+        if isinstance(snapshot_types, str):
+            snapshot_types = [snapshot_types]
+
+        return (
+            order,
+            frozenset(snapshot_types) if snapshot_types else None,
+            route["jobs"],
+        )
+
+    def match(self, glue_event):
+        """Returns the job specs of every route matching the event, in config order.
+
+        Arguments:
+            glue_event (dict): the glue success event
+
+        Returns:
+            list: the job specs, empty if no route matches
+
+        """
+        collection_name = glue_event.get("collection_name")
+        if collection_name is None:
+            return []
+
+        candidates = list(self.exact_routes.get(collection_name, ()))
+
+        node = self.prefix_trie
+        candidates.extend(node.get(None, ()))
+        for character in collection_name:
+            node = node.get(character)
+            if node is None:
+                break
+            candidates.extend(node.get(None, ()))
+
+        candidates.extend(
+            compiled_route
+            for pattern, compiled_route in self.regex_routes
+            if pattern.match(collection_name)
+        )
+
+        snapshot_type = glue_event.get("snapshot_type")
+
+        return [
+            job_spec
+            for _, snapshot_types, job_specs in sorted(
+                candidates, key=lambda compiled_route: compiled_route[0]
+            )
+            if snapshot_types is None or snapshot_type in snapshot_types
+            for job_spec in job_specs
+        ]
+
+
+def compile_field_pattern(pattern):
+    """Compiles an event field pattern into a predicate on the field value.
+
+    Patterns follow the routing config: an exact value, a prefix ending in * or a regular
+    expression starting re:.
+    """
+    if pattern.startswith(ROUTING_REGEX_PREFIX):
+        regex = re.compile(pattern[len(ROUTING_REGEX_PREFIX) :])
+        return lambda value: value is not None and regex.match(str(value)) is not None
+
+    if pattern.endswith(ROUTING_PREFIX_WILDCARD):
+        prefix = pattern[: -len(ROUTING_PREFIX_WILDCARD)]
+        return lambda value: value is not None and str(value).startswith(prefix)
+
+    return lambda value: value == pattern
+
+
+def compile_scheduling_rules(rules):
+    """Compiles the scheduling rules into (conditions, hints) tuples.
+
+    Arguments:
+        rules (list): dicts of "match", a dict of event field to pattern (or list of
+            patterns), and the "scheduling_priority" and "share_identifier" to apply
+
+    Raises:
+        ValueError: if a rule is malformed
+
+    """
+    if not isinstance(rules, list):
+        raise ValueError("The scheduling rules must be a list")
+
+    compiled_rules = []
+
+    for order, rule in enumerate(rules):
+        if not isinstance(rule, dict) or not isinstance(rule.get("match", {}), dict):
+            raise ValueError(f"Scheduling rule {order} must be an object with a match")
+
+        priority = rule.get("scheduling_priority")
+        if priority is not None and (
+            not isinstance(priority, int) or isinstance(priority, bool)
+        ):
+            raise ValueError(f"Scheduling rule {order} priority must be an integer")
+
+        share_identifier = rule.get("share_identifier")
+        if share_identifier is not None and not isinstance(share_identifier, str):
+            raise ValueError(
+                f"Scheduling rule {order} share_identifier must be a string"
+            )
+
+        conditions = []
+        for field, patterns in rule.get("match", {}).items():
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            if not isinstance(patterns, list) or not all(
+                isinstance(pattern, str) for pattern in patterns
+            ):
+                raise ValueError(
+                    f"Scheduling rule {order} patterns of {field} must be strings"
+                )
+            conditions.append(
+                (field, [compile_field_pattern(pattern) for pattern in patterns])
+            )
+
+        hints = {
+            hint: rule[hint]
+            for hint in ("scheduling_priority", "share_identifier")
+            if rule.get(hint) is not None
+        }
+        compiled_rules.append((conditions, hints))
+
+    return compiled_rules
+
+
+def get_scheduling_hints(glue_event):
+    """Returns the scheduling hints of the first scheduling rule matching the event.
+
+    Arguments:
+        glue_event (dict): the glue success event (or None)
+
+    Returns:
+        dict: the scheduling_priority and share_identifier keyword arguments for
+            submit_batch_job, empty if no rule matches
+
+    """
+    global scheduling_rules
+
+    if glue_event is None or not args.batch_scheduling_rules_json:
+        return {}
+
+    if scheduling_rules is None:
+        with cached_state_lock:
+            if scheduling_rules is None:
+                scheduling_rules = compile_scheduling_rules(
+                    args.batch_scheduling_rules_json
+                )
+
+    return match_scheduling_rules(scheduling_rules, glue_event)
+
+
+def match_scheduling_rules(compiled_rules, glue_event):
+    """Returns the hints of the first compiled scheduling rule matching the event, or {}."""
+    for conditions, hints in compiled_rules:
+        if all(
+            any(predicate(glue_event.get(field)) for predicate in predicates)
+            for field, predicates in conditions
+        ):
+            return hints
+
+    return {}
+
+
+def load_routing_index(path):
+    """Loads and compiles the routing config from a json file, or yaml if PyYAML is installed.
+
+    Arguments:
+        path (string): the path of the config file, read as yaml if it ends .yaml or .yml
+
+    Returns:
+        RoutingIndex: the compiled routes
+
+    """
+    routing_index = RoutingIndex(read_routing_config(path)["routes"])
+
+    logger.info(
+        "Loaded batch routing config",
+        extra={"path": path, "route_count": routing_index.route_count},
+    )
+
+    return routing_index
+
+
+def read_routing_config(path):
+    """Reads the routing config from a json file, or yaml if PyYAML is installed."""
+    with open(path, "r") as config_file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                # Optional dependency, only needed for yaml routing configs
+                import yaml
+            except ImportError:
+                raise ImportError(
+                    f"PyYAML is required to load the yaml routing config {path}"
+                )
+
+            return yaml.safe_load(config_file)
+
+        return json.load(config_file)
+
+
+def get_routing_index():
+    """Returns the routing index, or None if no BATCH_ROUTING_CONFIG is configured."""
+    global routing_index
+
+    if routing_index is None and args.batch_routing_config:
+        with cached_state_lock:
+            if routing_index is None:
+                routing_index = load_routing_index(args.batch_routing_config)
+
+    return routing_index
+
+
+def compile_template(template):
+    """Compiles a template once per container into its literal text and event field parts.
+
+    Templates use python format syntax, e.g. "reconciliation-{collection_name}".
+
+    Arguments:
+        template (string): the template to compile
+
+    Returns:
+        list: (literal_text, field_name) tuples where field_name may be None
+
+    """
+    compiled_template = compiled_templates.get(template)
+
+    if compiled_template is None:
+        compiled_template = [
+            (literal_text, field_name)
+            for literal_text, field_name, _, _ in string.Formatter().parse(template)
+        ]
+        compiled_templates[template] = compiled_template
+
+    return compiled_template
+
+
+def render_template(template, glue_event):
+    """Renders a template using the fields of the glue event.
+
+    Arguments:
+        template (string): the template to render
+        glue_event (dict): the glue success event to take field values from
+
+    """
+    rendered = []
+
+    for literal_text, field_name in compile_template(template):
+        rendered.append(literal_text)
+
+        if field_name is None:
+            continue
+
+        if field_name not in glue_event:
+            raise Exception(
+                f"Event field '{field_name}' required by template '{template}' is missing"
+            )
+
+        rendered.append(str(glue_event[field_name]))
+
+    return "".join(rendered)
+
+
+def generate_launch_result(
+    record_id,
+    job_arn=None,
+    job_id=None,
+    error_message=None,
+    duplicate=False,
+    deferred=False,
+):
+    """Generates the result of launching a batch job for a record.
+
+    Arguments:
+        record_id (string): the id of the record being processed (or None)
+        job_arn (string): the arn of the submitted job (or None)
+        job_id (string): the id of the submitted job (or None)
+        error_message (string): the error message if the launch failed (or None)
+        duplicate (bool): True if the submission was skipped as a duplicate
+        deferred (bool): True if the submission was held back to be retried later
+
+    """
+    return {
+        "record_id": record_id,
+        "job_arn": job_arn,
+        "job_id": job_id,
+        "error_message": error_message,
+        "duplicate": duplicate,
+        "deferred": deferred,
+    }
+
+
+def read_backfill_events(path):
+    """Streams the glue events from a json lines file.
+
+    A line that is not valid json is logged with its line number and yielded as None,
+    so the rest of the file is still replayed.
+
+    Arguments:
+        path (string): the path of the file, with one glue event per line
+
+    Yields:
+        dict: each glue event, or None for a malformed line
+
+    """
+    with open(path, "r") as events_file:
+        for line_number, line in enumerate(events_file, 1):
+            if not line.strip():
+                continue
+
+            try:
+                glue_event = json.loads(line)
+            except json.JSONDecodeError as err:
+                logger.error(
+                    "Skipping malformed backfill line",
+                    extra={
+                        "path": path,
+                        "line_number": line_number,
+                        "error_message": str(err),
+                    },
+                )
+                yield None
+                continue
+
+            yield glue_event
+
+
+def generate_backfill_events(collection_names, start_date, end_date, snapshot_type):
+    """Generates a glue event per collection for each export date in the range.
+
+    Arguments:
+        collection_names (list): the collections to generate events for
+        start_date (string): the first export date, YYYY-MM-DD
+        end_date (string): the last export date (inclusive), YYYY-MM-DD
+        snapshot_type (string): the snapshot type of the events
+
+    Yields:
+        dict: each glue event, ordered by export date
+
+    """
+    # Only imported for backfills to keep it off the cold start path
+    import datetime
+
+    export_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    last_export_date = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+
+    while export_date <= last_export_date:
+        for collection_name in collection_names:
+            yield {
+                "correlation_id": f"backfill_{collection_name}_{export_date}",
+                "collection_name": collection_name,
+                "snapshot_type": snapshot_type,
+                "export_date": str(export_date),
+            }
+        export_date += datetime.timedelta(days=1)
+
+
+def generate_backfill_key(glue_event):
+    """Generates the checkpoint key identifying a glue event across backfill runs."""
+    return hashlib.sha256(
+        json.dumps(glue_event, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def load_backfill_checkpoint(path):
+    """Loads the keys of the glue events already submitted by previous backfill runs.
+
+    Arguments:
+        path (string): the checkpoint file, with one key per line
+
+    Returns:
+        set: the submitted keys, empty if the file does not exist yet
+
+    """
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, "r") as checkpoint_file:
+        return set(line.strip() for line in checkpoint_file if line.strip())
+
+
+def run_backfill(
+    batch_client, sns_client, glue_events, checkpoint_path, chunk_size, tracker=None
+):
+    """Submits the glue events in chunks, checkpointing each chunk once it has completed.
+
+    Events already in the checkpoint are skipped, and events that failed are left out of
+    it, so rerunning the same backfill after an interruption or failures only submits the
+    remaining work. At most one chunk is resubmitted if the process is killed mid chunk.
+    Events the event validator rejects are counted and logged rather than submitted.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+        glue_events (iterable): the glue events, consumed lazily
+        checkpoint_path (string): the checkpoint file
+        chunk_size (int): the number of events submitted between checkpoints
+        tracker (JobStatusTracker): tracks the submitted jobs (or None)
+
+    Returns:
+        dict: the number of events submitted, duplicated, skipped, rejected and failed
+
+    """
+    completed_keys = load_backfill_checkpoint(checkpoint_path)
+    totals = collections.Counter(
+        submitted=0, duplicate=0, skipped=0, rejected=0, failed=0
+    )
+    validator = get_event_validator()
+    pending = []
+
+    with open(checkpoint_path, "a") as checkpoint_file:
+
+        def submit_chunk(chunk):
+            results = launch_batch_jobs(batch_client, sns_client, chunk)
+
+            if tracker is not None:
+                tracker.add_results(results)
+
+            for result in results:
+                if result["error_message"]:
+                    totals["failed"] += 1
+                    continue
+
+                totals["duplicate" if result["duplicate"] else "submitted"] += 1
+                checkpoint_file.write(result["record_id"] + "\n")
+
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            flush_error_alerts(sns_client)
+
+            logger.info("Backfill progress", extra=dict(totals))
+
+        for glue_event in glue_events:
+            if glue_event is None:
+                # A line read_backfill_events could not parse, logged as it was read
+                totals["rejected"] += 1
+                continue
+
+            key = generate_backfill_key(glue_event)
+
+            # Also drops events repeated within the input
+            if key in completed_keys:
+                totals["skipped"] += 1
+                continue
+
+            reason = validator.validate(glue_event)
+            if reason is not None:
+                totals["rejected"] += 1
+                increment_metric("InvalidEvents")
+                logger.error(
+                    "Rejecting invalid backfill event",
+                    extra={"reason": reason, "backfill_key": key},
+                )
+                continue
+
+            completed_keys.add(key)
+            pending.append((key, glue_event))
+
+            if len(pending) >= chunk_size:
+                submit_chunk(pending)
+                pending = []
+
+        if pending:
+            submit_chunk(pending)
+
+    return dict(totals)
+
+
+def get_backfill_events():
+    """Returns the glue events for the backfill described by the command line."""
+    if args.backfill_events:
+        return read_backfill_events(args.backfill_events)
+
+    if not args.backfill_start_date or not args.backfill_end_date:
+        raise ValueError(
+            "--backfill-start-date and --backfill-end-date are required with "
+            "--backfill-collections"
+        )
+
+    return generate_backfill_events(
+        [
+            collection_name.strip()
+            for collection_name in args.backfill_collections.split(",")
+            if collection_name.strip()
+        ],
+        args.backfill_start_date,
+        args.backfill_end_date,
+        args.backfill_snapshot_type,
+    )
+
+
+class IdempotencyCache:
+    """In-memory TTL and LRU tier of idempotency keys that have already been launched."""
+
+    def __init__(self, max_size, ttl_seconds, clock=time.time):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns the job id for the key, or None if it is unknown or expired."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        job_id, expires_at = entry
+        if expires_at <= self.clock():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return job_id
+
+    def put(self, key, job_id):
+        """Records the job id for the key, evicting the least recently used entries."""
+        self.entries[key] = (job_id, self.clock() + self.ttl_seconds)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def remove(self, key):
+        """Forgets the key."""
+        self.entries.pop(key, None)
+
+
+class SqliteIdempotencyStore:
+    """Persistent idempotency backend using a local SQLite file.
+
+    This is the local stand-in for a shared store. Any object providing the same
+    get, put and remove methods can be used instead through set_idempotency_store_factory.
+    """
+
+    def __init__(self, path):
+        # Imported here as only deployments with a persistent store need it
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys "
+            "(idempotency_key TEXT PRIMARY KEY, job_id TEXT, expires_at REAL)"
+        )
+        self.connection.commit()
+
+    def get(self, key, now):
+        """Returns the job id for the key, or None if it is unknown or expired."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT job_id FROM idempotency_keys "
+                "WHERE idempotency_key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, key, job_id, expires_at):
+        """Records the job id for the key until expires_at."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?)",
+                (key, job_id, expires_at),
+            )
+            self.connection.commit()
+
+    def remove(self, key):
+        """Forgets the key."""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM idempotency_keys WHERE idempotency_key = ?", (key,)
+            )
+            self.connection.commit()
+
+
+def get_idempotency_tiers():
+    """Returns the in-memory cache and persistent store (or None), creating them on first use."""
+    global idempotency_cache
+    global idempotency_store
+
+    if idempotency_cache is None:
+        with cached_state_lock:
+            if idempotency_cache is None:
+                # The cache is set last, so a caller that sees it also sees the store
+                idempotency_store = create_idempotency_store(args)
+                idempotency_cache = IdempotencyCache(
+                    args.idempotency_cache_size, args.idempotency_ttl_seconds
+                )
+
+    return idempotency_cache, idempotency_store
+
+
+def create_idempotency_store(config):
+    """Creates the persistent idempotency store, or returns None if not configured."""
+    if idempotency_store_factory is not None:
+        return idempotency_store_factory(config)
+
+    if config.idempotency_store_path:
+        return SqliteIdempotencyStore(config.idempotency_store_path)
+
+    return None
+
+
+def set_idempotency_store_factory(factory):
+    """Registers the factory of the persistent idempotency store, kept across config rebuilds.
+
+    Register it before the first invocation, for example in a wrapper module that is
+    the lambda entry point, to persist keys in a store shared between containers.
+
+    Arguments:
+        factory (function): called with the config when the tiers are built, returning
+            an object with the get, put and remove methods of SqliteIdempotencyStore
+            (or None for no persistent store). None restores the SQLite store at
+            IDEMPOTENCY_STORE_PATH.
+
+    """
+    global idempotency_store_factory
+    global idempotency_cache
+    global idempotency_store
+
+    with cached_state_lock:
+        idempotency_store_factory = factory
+        idempotency_cache = None
+        idempotency_store = None
+
+
+def generate_idempotency_key(glue_event, job_request):
+    """Generates the idempotency key for a job launched from a glue event.
+
+    Arguments:
+        glue_event (dict): the glue success event (or None)
+        job_request (dict): the job request built for the event
+
+    Returns:
+        string: the key, or None if idempotency is not configured
+
+    """
+    if glue_event is None or not args.idempotency_key_fields:
+        return None
+
+    key_values = [glue_event.get(field) for field in args.idempotency_key_fields]
+    key_values.append(job_request["job_definition_name"])
+    key_values.append(job_request["job_name"])
+
+    return hashlib.sha256(
+        json.dumps(key_values, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def claim_idempotency_key(key):
+    """Claims the key for a new submission unless it has already been launched.
+
+    Arguments:
+        key (string): the idempotency key
+
+    Returns:
+        string: the existing job id (or PENDING_JOB_ID if in flight) if already launched,
+            otherwise None once the key has been claimed
+
+    """
+    cache, store = get_idempotency_tiers()
+
+    with idempotency_lock:
+        existing_job_id = cache.get(key)
+
+        if existing_job_id is None and store is not None:
+            existing_job_id = store.get(key, time.time())
+            if existing_job_id is not None:
+                cache.put(key, existing_job_id)
+
+        if existing_job_id is None:
+            cache.put(key, PENDING_JOB_ID)
+
+    return existing_job_id
+
+
+def record_idempotency_key(key, job_id):
+    """Records the job id launched for a claimed key in every tier."""
+    cache, store = get_idempotency_tiers()
+
+    with idempotency_lock:
+        cache.put(key, job_id)
+
+    if store is not None:
+        store.put(key, job_id, time.time() + args.idempotency_ttl_seconds)
+
+
+def release_idempotency_key(key):
+    """Releases a claimed key after a failed submission so it can be retried."""
+    cache, _ = get_idempotency_tiers()
+
+    with idempotency_lock:
+        cache.remove(key)
+
+
+class SqliteOutboxStore:
+    """Outbox of intended batch job submissions using a local SQLite file.
+
+    An entry is written as pending before SubmitJob is called and completed with the
+    job id after it returns, so a submission interrupted in between can be reconciled
+    against Batch. This is the local stand-in for a shared store. Any object providing
+    the same methods can be used instead through set_outbox_store_factory.
+    """
+
+    def __init__(self, path):
+        # Imported here as only deployments with an outbox need it
+        import sqlite3
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (entry_id TEXT PRIMARY KEY, "
+            "status TEXT, submission TEXT, job_id TEXT, created_at REAL, "
+            "attempted_at REAL)"
+        )
+        self.connection.commit()
+
+    def claim(self, entry_id, submission, now):
+        """Writes a pending entry unless one exists.
+
+        Returns:
+            dict: the existing entry, or None if the entry was written
+
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO outbox VALUES (?, ?, ?, NULL, ?, ?)",
+                (entry_id, OUTBOX_PENDING, json.dumps(submission), now, now),
+            )
+            self.connection.commit()
+
+            if cursor.rowcount == 1:
+                return None
+
+            row = self.connection.execute(
+                "SELECT * FROM outbox WHERE entry_id = ?", (entry_id,)
+            ).fetchone()
+
+        return self.generate_entry(row) if row else None
+
+    def renew(self, entry_id, now):
+        """Takes the lease of a pending entry before it is reconciled or resubmitted."""
+        self.update(
+            "UPDATE outbox SET attempted_at = ? WHERE entry_id = ?", now, entry_id
+        )
+
+    def release(self, entry_id):
+        """Expires the lease of a pending entry so the next attempt reconciles it at once."""
+        self.update("UPDATE outbox SET attempted_at = 0 WHERE entry_id = ?", entry_id)
+
+    def complete(self, entry_id, job_id, now):
+        """Records the job launched for the entry."""
+        self.update(
+            "UPDATE outbox SET status = ?, job_id = ?, attempted_at = ? "
+            "WHERE entry_id = ?",
+            OUTBOX_DONE,
+            job_id,
+            now,
+            entry_id,
+        )
+
+    def remove(self, entry_id):
+        """Forgets the entry."""
+        self.update("DELETE FROM outbox WHERE entry_id = ?", entry_id)
+
+    def get_pending(self, attempted_before):
+        """Returns the pending entries whose lease expired before the given time."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM outbox WHERE status = ? AND attempted_at < ? "
+                "ORDER BY created_at",
+                (OUTBOX_PENDING, attempted_before),
+            ).fetchall()
+
+        return [self.generate_entry(row) for row in rows]
+
+    def remove_completed(self, completed_before):
+        """Forgets the completed entries older than the given time, returning how many."""
+        return self.update(
+            "DELETE FROM outbox WHERE status = ? AND attempted_at < ?",
+            OUTBOX_DONE,
+            completed_before,
+        )
+
+    def update(self, statement, *parameters):
+        with self.lock:
+            cursor = self.connection.execute(statement, parameters)
+            self.connection.commit()
+
+        return cursor.rowcount
+
+    @staticmethod
+    def generate_entry(row):
+        entry_id, status, submission, job_id, created_at, attempted_at = row
+        return {
+            "entry_id": entry_id,
+            "status": status,
+            "submission": json.loads(submission),
+            "job_id": job_id,
+            "created_at": created_at,
+            "attempted_at": attempted_at,
+        }
+
+
+def get_outbox_store():
+    """Returns the outbox store, creating it on first use, or None if not configured."""
+    global outbox_store
+
+    if outbox_store is None and (
+        outbox_store_factory is not None or args.outbox_store_path
+    ):
+        with cached_state_lock:
+            if outbox_store is None:
+                outbox_store = create_outbox_store(args)
+
+    return outbox_store
+
+
+def create_outbox_store(config):
+    """Creates the outbox store, or returns None if not configured."""
+    if outbox_store_factory is not None:
+        return outbox_store_factory(config)
+
+    if config.outbox_store_path:
+        return SqliteOutboxStore(config.outbox_store_path)
+
+    return None
+
+
+def set_outbox_store_factory(factory):
+    """Registers the factory of the outbox store, kept across config rebuilds.
+
+    Register it before the first invocation, for example in a wrapper module that is
+    the lambda entry point, so retries on any container see the same outbox.
+
+    Arguments:
+        factory (function): called with the config when the outbox is first needed,
+            returning an object with the methods of SqliteOutboxStore (or None for no
+            outbox). None restores the SQLite store at OUTBOX_STORE_PATH.
+
+    """
+    global outbox_store_factory
+    global outbox_store
+
+    with cached_state_lock:
+        outbox_store_factory = factory
+        outbox_store = None
+
+
+def generate_outbox_entry_id(glue_event, job_request):
+    """Generates the outbox entry id of a job launched from a glue event.
+
+    Arguments:
+        glue_event (dict): the glue success event (or None)
+        job_request (dict): the job request built for the event, before routing
+
+    Returns:
+        string: the entry id, or None if the outbox is not configured
+
+    """
+    if glue_event is None or get_outbox_store() is None:
+        return None
+
+    return hashlib.sha256(
+        json.dumps([glue_event, job_request], sort_keys=True, default=str).encode(
+            "utf-8"
+        )
+    ).hexdigest()
 
-    new_handler = logging.StreamHandler(sys.stdout)
-    hostname = socket.gethostname()
 
-    json_format = (
-        f'{{ "timestamp": "%(asctime)s", "log_level": "%(levelname)s", "message": "%(message)s", '
-        f'"environment": "{args.environment}", "application": "{args.application}", '
-        f'"module": "%(module)s", "process":"%(process)s", '
-        f'"thread": "[%(thread)s]", "host": "{hostname}" }}'
-    )
+def generate_outbox_submission(job_request, scheduling_hints, depends_on=None):
+    """Returns what the outbox records to reconcile or resubmit a submission."""
+    submission = {
+        "job_queue": job_request["job_queue"],
+        "job_name": job_request["job_name"],
+        "job_definition_name": job_request["job_definition_name"],
+        "parameters": job_request["parameters"],
+        "scheduling_hints": scheduling_hints,
+    }
 
-    new_handler.setFormatter(logging.Formatter(json_format))
-    the_logger.addHandler(new_handler)
-    new_level = logging.getLevelName(logger_level)
-    the_logger.setLevel(new_level)
+    if depends_on:
+        submission["depends_on"] = depends_on
 
-    if the_logger.isEnabledFor(logging.DEBUG):
-        # Log everything from boto3
-        boto3.set_stream_logger()
-        the_logger.debug(f'Using boto3", "version": "{boto3.__version__}')
+    return submission
 
-    return the_logger
 
+def open_outbox_entry(batch_client, entry_id, submission):
+    """Writes the outbox entry for a submission, reconciling any earlier attempt.
 
-def get_parameters():
-    """Parse the supplied command line arguments.
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        entry_id (string): the outbox entry id
+        submission (dict): the submission about to be made
 
     Returns:
-        args: The parsed and validated command line arguments
+        string: the job id if an earlier attempt launched the job, otherwise None once
+            the entry is pending for this attempt
 
     """
-    parser = argparse.ArgumentParser(
-        description="Start up and shut down ASGs on demand"
-    )
+    store = get_outbox_store()
+    now = time.time()
 
-    # Parse command line inputs and set defaults
-    parser.add_argument("--aws-profile", default="default")
-    parser.add_argument("--aws-region", default="eu-west-2")
-    parser.add_argument("--sns-topic", help="SNS topic ARN")
-    parser.add_argument("--environment", help="Environment value", default=UNSET_TEXT)
-    parser.add_argument("--application", help="Application", default=UNSET_TEXT)
-    parser.add_argument(
-        "--slack-channel-override",
-        help="Slack channel to use for overriden jobs",
-        default=UNSET_TEXT,
-    )
-    parser.add_argument("--log-level", help="Log level for lambda", default="INFO")
+    entry = store.claim(entry_id, submission, now)
 
-    _args = parser.parse_args()
+    if entry is not None and entry["status"] == OUTBOX_DONE:
+        if entry["attempted_at"] >= now - args.outbox_retention_seconds:
+            return entry["job_id"]
 
-    # Override arguments with environment variables where set
-    if "AWS_PROFILE" in os.environ:
-        _args.aws_profile = os.environ["AWS_PROFILE"]
+        store.remove(entry_id)
+        entry = store.claim(entry_id, submission, now)
 
-    if "AWS_REGION" in os.environ:
-        _args.aws_region = os.environ["AWS_REGION"]
+    if entry is None:
+        return None
 
-    if "ENVIRONMENT" in os.environ:
-        _args.environment = os.environ["ENVIRONMENT"]
+    if entry["attempted_at"] >= now - args.outbox_lease_seconds:
+        raise SubmissionDeferredError(
+            "An earlier submission of the job is still in flight"
+        )
 
-    if "APPLICATION" in os.environ:
-        _args.application = os.environ["APPLICATION"]
+    store.renew(entry_id, now)
 
-    if "MONITORING_SNS_TOPIC" in os.environ:
-        _args.monitoring_sns_topic = os.environ["MONITORING_SNS_TOPIC"]
+    job_id = find_outbox_job(batch_client, entry)
+    if job_id is not None:
+        increment_metric("OutboxReconciled")
+        store.complete(entry_id, job_id, now)
+        return job_id
 
-    if "MONITORING_ERRORS_SEVERITY" in os.environ:
-        _args.severity = os.environ["MONITORING_ERRORS_SEVERITY"]
-    else:
-        _args.severity = "High"
+    return None
 
-    if "MONITORING_ERRORS_TYPE" in os.environ:
-        _args.notification_type = os.environ["MONITORING_ERRORS_TYPE"]
+
+def abandon_outbox_entry(entry_id, err):
+    """Clears the outbox entry of a failed submission.
+
+    The entry is removed when the error shows the job was not launched. Otherwise it
+    stays pending with its lease expired, so a retry reconciles it against Batch first.
+    """
+    store = get_outbox_store()
+
+    if is_submission_ambiguous(err):
+        store.release(entry_id)
     else:
-        _args.notification_type = "Warning"
+        store.remove(entry_id)
 
-    if "SLACK_CHANNEL_OVERRIDE" in os.environ:
-        _args.slack_channel_override = os.environ["SLACK_CHANNEL_OVERRIDE"]
 
-    if "BATCH_JOB_QUEUE" in os.environ:
-        _args.batch_job_queue = os.environ["BATCH_JOB_QUEUE"]
+def is_submission_ambiguous(err):
+    """Returns True if a failed SubmitJob call may still have launched the job."""
+    if isinstance(err, (SubmissionDeferredError, SubmissionRejectedError)):
+        return False
 
-    if "BATCH_JOB_NAME" in os.environ:
-        _args.batch_job_name = os.environ["BATCH_JOB_NAME"]
+    if isinstance(err, botocore.exceptions.ClientError):
+        error_code = err.response.get("Error", {}).get("Code")
+        status_code = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error_code not in THROTTLING_ERROR_CODES and status_code >= 500
 
-    if "BATCH_JOB_DEFINITION_NAME" in os.environ:
-        _args.batch_job_definition_name = os.environ["BATCH_JOB_DEFINITION_NAME"]
+    if isinstance(err, botocore.exceptions.ParamValidationError):
+        # Rejected by botocore before the request was sent
+        return False
 
-    if "BATCH_PARAMETERS_JSON" in os.environ:
-        _args.batch_parameters_json = json.loads(os.environ["BATCH_PARAMETERS_JSON"])
-    else:
-        _args.batch_parameters_json = None
+    # Timeouts and dropped connections may happen after Batch accepted the job
+    return True
 
-    if "LOG_LEVEL" in os.environ:
-        _args.log_level = os.environ["LOG_LEVEL"]
 
-    return _args
+def find_outbox_job(batch_client, entry):
+    """Finds the job an outbox entry launched, listing the queue's jobs by job name.
 
+    Jobs created before the entry, less the allowed clock skew, are ignored, and the
+    candidates must have been submitted with the entry's parameters.
 
-def get_sns_client():
-    global boto_client_config
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        entry (dict): the pending outbox entry
 
-    return boto3.client("sns", config=boto_client_config)
+    Returns:
+        string: the id of the earliest matching job, or None if there is none
 
+    """
+    submission = entry["submission"]
+    created_after = (entry["created_at"] - OUTBOX_CLOCK_SKEW_SECONDS) * 1000
+    candidates = []
 
-def get_batch_client():
-    global boto_client_config
+    list_arguments = {
+        "jobQueue": submission["job_queue"],
+        "filters": [{"name": "JOB_NAME", "values": [submission["job_name"]]}],
+    }
+    while True:
+        response = call_aws_api("ListJobs", batch_client.list_jobs, **list_arguments)
+        candidates.extend(
+            summary
+            for summary in response.get("jobSummaryList", [])
+            if summary.get("createdAt", 0) >= created_after
+        )
 
-    return boto3.client("batch", config=boto_client_config)
+        if not response.get("nextToken"):
+            break
+        list_arguments["nextToken"] = response["nextToken"]
 
+    candidates.sort(key=lambda summary: summary.get("createdAt", 0))
 
-def handler(event, context):
-    """Handle the event from AWS.
+    if not candidates or not submission["parameters"]:
+        return candidates[0]["jobId"] if candidates else None
 
-    Args:
-        event (Object): The event details from AWS
-        context (Object): The context info from AWS
+    submitted_parameters = submission["parameters"]
+    if parameter_offloader is not None:
+        submitted_parameters = parameter_offloader.get_submitted_parameters(
+            submitted_parameters
+        )
+
+    expected_parameters = {
+        name: str(value) for name, value in submitted_parameters.items()
+    }
+    for start in range(0, len(candidates), MAX_DESCRIBE_JOBS):
+        job_ids = [
+            summary["jobId"]
+            for summary in candidates[start : start + MAX_DESCRIBE_JOBS]
+        ]
+        response = call_aws_api(
+            "DescribeJobs", batch_client.describe_jobs, jobs=job_ids
+        )
+        jobs = {job["jobId"]: job for job in response.get("jobs", [])}
+
+        for job_id in job_ids:
+            parameters = jobs.get(job_id, {}).get("parameters", {})
+            if all(
+                parameters.get(name) == value
+                for name, value in expected_parameters.items()
+            ):
+                return job_id
+
+    return None
+
+
+def sweep_outbox(batch_client, sns_client):
+    """Reconciles the pending outbox entries whose lease expired, resubmitting lost jobs.
+
+    Entries whose job is found in Batch are completed. The others are submitted again,
+    and an entry is dropped with a monitoring alert if Batch refuses it. Completed
+    entries past OUTBOX_RETENTION_SECONDS are removed.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        sns_client (client): The boto3 client for SNS
+
+    Returns:
+        dict: the number of entries reconciled, resubmitted, failed and pruned
 
     """
-    global args
-    global logger
+    store = get_outbox_store()
+    totals = {"reconciled": 0, "resubmitted": 0, "failed": 0, "pruned": 0}
 
-    args = get_parameters()
-    logger = setup_logging(args.log_level)
+    if store is None:
+        return totals
 
-    dumped_event = get_escaped_json_string(event)
-    logger.info(f'SNS Event", "sns_event": {dumped_event}, "mode": "handler')
+    now = time.time()
 
-    if not args.monitoring_sns_topic:
-        raise Exception("Monitoring SNS topic is not set")
+    for entry in store.get_pending(now - args.outbox_lease_seconds):
+        entry_id = entry["entry_id"]
+        submission = entry["submission"]
+        store.renew(entry_id, now)
 
-    batch_client = get_batch_client()
-    sns_client = get_sns_client()
+        try:
+            job_id = find_outbox_job(batch_client, entry)
+            if job_id is not None:
+                totals["reconciled"] += 1
+            else:
+                submit_arguments = dict(submission["scheduling_hints"])
+                if submission.get("depends_on"):
+                    submit_arguments["depends_on"] = submission["depends_on"]
 
-    try:
-        response = submit_batch_job(
-            batch_client,
-            args.batch_job_queue,
-            args.batch_job_name,
-            args.batch_job_definition_name,
-            args.batch_parameters_json,
+                response = submit_batch_job(
+                    batch_client,
+                    submission["job_queue"],
+                    submission["job_name"],
+                    submission["job_definition_name"],
+                    submission["parameters"],
+                    **submit_arguments,
+                )
+                job_id = response["jobId"]
+                totals["resubmitted"] += 1
+
+            store.complete(entry_id, job_id, time.time())
+        except Exception as err:
+            totals["failed"] += 1
+            if isinstance(err, botocore.exceptions.ClientError):
+                error_message = err.response["Error"]["Message"]
+            else:
+                error_message = str(err)
+
+            logger.error(
+                "Error occurred sweeping outbox entry",
+                extra={
+                    "error_message": error_message,
+                    "outbox_entry_id": entry_id,
+                    "job_name": submission["job_name"],
+                },
+            )
+
+            if is_service_failure(err) or is_submission_ambiguous(err):
+                # Left pending for the next sweep
+                store.release(entry_id)
+            else:
+                store.remove(entry_id)
+                send_error_alert(sns_client, error_message, submission)
+
+    totals["pruned"] = store.remove_completed(now - args.outbox_retention_seconds)
+
+    increment_metric("OutboxReconciled", totals["reconciled"])
+    increment_metric("OutboxResubmitted", totals["resubmitted"])
+
+    return totals
+
+
+class ParameterOffloader:
+    """Passes job parameter maps above a size threshold by reference to stored copies.
+
+    A map over the threshold is stored gzipped under the sha256 of its canonical json,
+    and the job is submitted with only OFFLOADED_PARAMETERS_PARAMETER pointing at it.
+    Identical maps share one stored copy, which each container uploads once.
+    """
+
+    def __init__(self, store, threshold_bytes):
+        self.store = store
+        self.threshold_bytes = threshold_bytes
+        self.lock = threading.Lock()
+        self.stored_keys = set()
+
+    def prepare(self, parameters):
+        """Returns the key and canonical json of the parameters, or (None, None) if small."""
+        encoded = json.dumps(parameters, sort_keys=True, separators=(",", ":")).encode(
+            "utf-8"
         )
+        if len(encoded) <= self.threshold_bytes:
+            return None, None
 
-        job_arn = response["jobArn"]
-        job_id = response["jobId"]
+        return f"{hashlib.sha256(encoded).hexdigest()}.json.gz", encoded
 
-        logger.info(
-            f'Batch job submitted successfully", '
-            + f'"job_queue": "{args.batch_job_queue}", "job_name": "{args.batch_job_name}", '
-            + f'"job_definition_name": "{args.batch_job_definition_name}", '
-            + f'"job_arn": "{job_arn}", "job_id": "{job_id}'
+    def get_submitted_parameters(self, parameters):
+        """Returns the parameters a job is submitted with, without storing anything."""
+        key, _ = self.prepare(parameters)
+        if key is None:
+            return parameters
+
+        return {OFFLOADED_PARAMETERS_PARAMETER: self.store.get_uri(key)}
+
+    def offload(self, parameters):
+        """Stores the parameters if they are over the threshold.
+
+        Returns:
+            dict: the parameters to submit the job with, either as given or the pointer
+
+        """
+        key, encoded = self.prepare(parameters)
+        if key is None:
+            return parameters
+
+        with self.lock:
+            stored = key in self.stored_keys
+
+        if not stored and not self.store.exists(key):
+            # Imported here as only deployments offloading parameters need it
+            import gzip
+
+            # A fixed mtime keeps the compressed bytes identical for identical maps
+            self.store.put(key, gzip.compress(encoded, mtime=0))
+            increment_metric("ParameterUploads")
+
+        with self.lock:
+            self.stored_keys.add(key)
+
+        increment_metric("ParametersOffloaded")
+        return {OFFLOADED_PARAMETERS_PARAMETER: self.store.get_uri(key)}
+
+
+class S3ParameterStore:
+    """Stores offloaded parameters as objects under an S3 prefix."""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get_uri(self, key):
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def exists(self, key):
+        # Without s3:ListBucket a missing key looks the same as a forbidden one, and
+        # putting the same content again under its sha256 is harmless
+        return False
+
+    def put(self, key, body):
+        call_aws_api(
+            "PutObject",
+            get_cached_s3_client().put_object,
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=body,
+            ContentType="application/json",
+            ContentEncoding="gzip",
         )
-    except botocore.exceptions.ClientError as err:
-        error_message = err.response["Error"]["Message"]
 
-        logger.error(
-            f'Error occurred submitting batch job", "error_message": "{error_message}", '
-            + f'"job_queue": "{args.batch_job_queue}", "job_name": "{args.batch_job_name}", '
-            + f'"job_definition_name": "{args.batch_job_definition_name}'
-        )
-
-        payload = generate_monitoring_error_message_payload(
-            args.slack_channel_override,
-            args.batch_job_queue,
-            args.batch_job_name,
-            args.batch_job_definition_name,
-            args.severity,
-            args.notification_type,
+
+class FileParameterStore:
+    """Stores offloaded parameters as files in a local directory.
+
+    This is the local stand-in for S3, e.g. for a directory on EFS mounted by the jobs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_uri(self, key):
+        return f"file://{os.path.join(self.directory, key)}"
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def put(self, key, body):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+
+        # Written aside and renamed so a reader never sees a partial file
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as parameters_file:
+            parameters_file.write(body)
+        os.replace(temporary_path, path)
+
+
+def parse_parameter_offload_uri(uri):
+    """Splits an offload uri into its scheme and location.
+
+    Returns:
+        tuple: ("s3", (bucket, prefix)) or ("file", directory)
+
+    Raises:
+        ValueError: if the uri is not an s3:// uri with a bucket or a file:// uri
+
+    """
+    if uri.startswith("s3://"):
+        bucket, _, prefix = uri[len("s3://") :].partition("/")
+        if not bucket:
+            raise ValueError(f"BATCH_PARAMETERS_OFFLOAD_URI has no bucket: {uri}")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return "s3", (bucket, prefix)
+
+    if uri.startswith("file://") and len(uri) > len("file://"):
+        return "file", uri[len("file://") :]
+
+    raise ValueError(
+        f"BATCH_PARAMETERS_OFFLOAD_URI must start s3:// or file://, not {uri}"
+    )
+
+
+def create_parameter_offloader(config):
+    """Creates the parameter offloader, or returns None if not configured."""
+    if not config.batch_parameters_offload_uri:
+        return None
+
+    scheme, location = parse_parameter_offload_uri(config.batch_parameters_offload_uri)
+    if scheme == "s3":
+        store = S3ParameterStore(*location)
+    else:
+        store = FileParameterStore(location)
+
+    return ParameterOffloader(store, config.batch_parameters_offload_threshold_bytes)
+
+
+def send_error_alert(sns_client, error_message, job_request=None):
+    """Sends a monitoring alert for a failed batch job submission.
+
+    Arguments:
+        sns_client (client): The boto3 client for SNS
+        error_message (string): the error message
+        job_request (dict): the job request that failed (or None for the configured job)
+
+    """
+    if job_request is None:
+        job_request = build_job_request()
+
+    if alert_aggregator is not None:
+        alert_aggregator.add(error_message, job_request)
+        return
+
+    payload = generate_monitoring_error_message_payload(
+        args.slack_channel_override,
+        job_request["job_queue"],
+        job_request["job_name"],
+        job_request["job_definition_name"],
+        args.severity,
+        args.notification_type,
+        error_message,
+    )
+
+    send_sns_message(
+        sns_client,
+        payload,
+        args.monitoring_sns_topic,
+        job_request["job_queue"],
+        job_request["job_name"],
+        job_request["job_definition_name"],
+    )
+
+
+class AlertAggregator:
+    """Groups identical error alerts so an outage sends one summary per error, not per job.
+
+    Alerts are grouped by job queue, job definition and error message and counted until
+    flush_error_alerts publishes them. A group is not alerted again until cooldown_seconds
+    after its last alert, its occurrences in the meantime are added to the next summary.
+    """
+
+    def __init__(self, cooldown_seconds, clock=time.monotonic):
+        self.cooldown_seconds = cooldown_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_alerted = {}
+
+    def add(self, error_message, job_request):
+        """Counts an occurrence of the error for the job request."""
+        key = (
+            job_request["job_queue"],
+            job_request["job_definition_name"],
             error_message,
         )
 
-        send_sns_message(
-            sns_client,
-            payload,
-            args.monitoring_sns_topic,
-            args.batch_job_queue,
-            args.batch_job_name,
-            args.batch_job_definition_name,
+        with self.lock:
+            if key in self.pending:
+                self.pending[key]["count"] += 1
+            else:
+                self.pending[key] = {
+                    "error_message": error_message,
+                    "job_request": job_request,
+                    "count": 1,
+                }
+
+    def take_due_alerts(self):
+        """Removes and returns the pending alerts whose groups are out of their cooldown.
+
+        Returns:
+            list: the alerts, as dicts of error_message, job_request and count
+
+        """
+        now = self.clock()
+
+        with self.lock:
+            self.last_alerted = {
+                key: alerted_at
+                for key, alerted_at in self.last_alerted.items()
+                if now - alerted_at < self.cooldown_seconds
+            }
+
+            due_keys = [key for key in self.pending if key not in self.last_alerted]
+            for key in due_keys:
+                self.last_alerted[key] = now
+
+            return [self.pending.pop(key) for key in due_keys]
+
+    def restore(self, alerts):
+        """Returns alerts that could not be published, so the next flush retries them.
+
+        Arguments:
+            alerts (list): alerts returned by take_due_alerts
+
+        """
+        with self.lock:
+            for alert in alerts:
+                job_request = alert["job_request"]
+                key = (
+                    job_request["job_queue"],
+                    job_request["job_definition_name"],
+                    alert["error_message"],
+                )
+
+                self.last_alerted.pop(key, None)
+                if key in self.pending:
+                    self.pending[key]["count"] += alert["count"]
+                else:
+                    self.pending[key] = dict(alert)
+
+
+def flush_error_alerts(sns_client):
+    """Publishes the aggregated error alerts that are due, if alerts are aggregated.
+
+    A failure to publish is logged rather than raised so it does not replace the
+    outcome of the invocation, and the alerts not yet published are put back for the
+    next flush.
+
+    Arguments:
+        sns_client (client): The boto3 client for SNS (or None if not yet created)
+
+    """
+    if alert_aggregator is None or sns_client is None:
+        return
+
+    alerts = alert_aggregator.take_due_alerts()
+
+    if alert_aggregator.pending:
+        logger.info(
+            "Holding back alerts within their cooldown",
+            extra={"held_alert_count": len(alert_aggregator.pending)},
+        )
+
+    if not alerts:
+        return
+
+    payloads = []
+    for alert in alerts:
+        job_request = alert["job_request"]
+        error_message = alert["error_message"]
+        if alert["count"] > 1:
+            error_message = f"{error_message} ({alert['count']} occurrences)"
+
+        payloads.append(
+            generate_monitoring_error_message_payload(
+                args.slack_channel_override,
+                job_request["job_queue"],
+                job_request["job_name"],
+                job_request["job_definition_name"],
+                args.severity,
+                args.notification_type,
+                error_message,
+            )
         )
 
+    for index in range(0, len(payloads), MAX_PUBLISH_BATCH_ENTRIES):
+        try:
+            failed_indexes = send_sns_messages(
+                sns_client,
+                payloads[index : index + MAX_PUBLISH_BATCH_ENTRIES],
+                args.monitoring_sns_topic,
+            )
+        except (
+            botocore.exceptions.ClientError,
+            botocore.exceptions.BotoCoreError,
+        ) as err:
+            logger.error(
+                "Failed to publish aggregated alerts",
+                extra={
+                    "error_message": str(err),
+                    "alert_count": len(payloads) - index,
+                },
+            )
+            alert_aggregator.restore(alerts[index:])
+            return
+
+        if failed_indexes:
+            alert_aggregator.restore(
+                [alerts[index + failed_index] for failed_index in failed_indexes]
+            )
+
 
 def generate_monitoring_error_message_payload(
     slack_channel_override,
@@ -248,10 +5250,15 @@ def generate_monitoring_error_message_payload(
     if slack_channel_override:
         payload["slack_channel_override"] = slack_channel_override
 
-    dumped_payload = get_escaped_json_string(payload)
     logger.info(
-        f'Generated monitoring SNS error payload", "payload": {dumped_payload}, "error_message": "{error_message}", '
-        + f'"job_queue": "{job_queue}", "job_name": "{job_name}", "job_definition_name": "{job_definition_name}'
+        "Generated monitoring SNS error payload",
+        extra={
+            "payload": payload,
+            "error_message": error_message,
+            "job_queue": job_queue,
+            "job_name": job_name,
+            "job_definition_name": job_definition_name,
+        },
     )
 
     return payload
@@ -273,8 +5280,13 @@ def generate_custom_elements(
 
     """
     logger.info(
-        f'Generating custom elements", "job_name": "{job_name}", "error_message": "{error_message}", '
-        + f'"job_queue": "{job_queue}", "job_definition_name": "{job_definition_name}'
+        "Generating custom elements",
+        extra={
+            "job_name": job_name,
+            "error_message": error_message,
+            "job_queue": job_queue,
+            "job_definition_name": job_definition_name,
+        },
     )
 
     job_queue_end = job_queue.split("/")[-1]
@@ -310,13 +5322,87 @@ def send_sns_message(
 
     json_message = json.dumps(payload)
 
-    dumped_payload = get_escaped_json_string(payload)
     logger.info(
-        f'Publishing payload to SNS", "payload": {dumped_payload}, "sns_topic_arn": "{sns_topic_arn}", '
-        + f'"job_queue": "{job_queue}", "job_name": "{job_name}", "job_definition_name": "{job_definition_name}'
+        "Publishing payload to SNS",
+        extra={
+            "payload": payload,
+            "sns_topic_arn": sns_topic_arn,
+            "job_queue": job_queue,
+            "job_name": job_name,
+            "job_definition_name": job_definition_name,
+        },
+    )
+
+    acquire_sns_publish_token(sns_topic_arn)
+
+    response = call_aws_api(
+        "Publish", sns_client.publish, TopicArn=sns_topic_arn, Message=json_message
     )
+    increment_metric("SnsAlerts")
+
+    return response
+
+
+def send_sns_messages(sns_client, payloads, sns_topic_arn):
+    """Publishes the messages to sns with as few PublishBatch calls as possible.
+
+    Arguments:
+        sns_client (client): The boto3 client for SNS
+        payloads (list): the payloads to post to SNS
+        sns_topic_arn (string): the arn for the SNS topic
+
+    Returns:
+        list: the indexes of the payloads SNS reported as failed
 
-    return sns_client.publish(TopicArn=sns_topic_arn, Message=json_message)
+    """
+    failed_indexes = []
+
+    for index in range(0, len(payloads), MAX_PUBLISH_BATCH_ENTRIES):
+        entries = [
+            {"Id": str(index + entry_index), "Message": json.dumps(payload)}
+            for entry_index, payload in enumerate(
+                payloads[index : index + MAX_PUBLISH_BATCH_ENTRIES]
+            )
+        ]
+
+        logger.info(
+            "Publishing payload batch to SNS",
+            extra={"entry_count": len(entries), "sns_topic_arn": sns_topic_arn},
+        )
+
+        acquire_sns_publish_token(sns_topic_arn)
+
+        response = call_aws_api(
+            "PublishBatch",
+            sns_client.publish_batch,
+            TopicArn=sns_topic_arn,
+            PublishBatchRequestEntries=entries,
+        )
+
+        increment_metric("SnsAlerts", len(response.get("Successful", [])))
+
+        if response.get("Failed"):
+            logger.error(
+                "Failed to publish some SNS messages",
+                extra={"failed": response["Failed"], "sns_topic_arn": sns_topic_arn},
+            )
+            failed_indexes.extend(int(entry["Id"]) for entry in response["Failed"])
+
+    return failed_indexes
+
+
+def acquire_sns_publish_token(sns_topic_arn):
+    """Waits for the SNS publish rate limiter, if publishes are rate limited."""
+    if sns_publish_rate_limiter is None:
+        return
+
+    wait_seconds = sns_publish_rate_limiter.acquire()
+    if wait_seconds > 0:
+        increment_metric("RateLimiterWaits")
+        logger.info(
+            "Rate limited SNS publish",
+            extra={"wait_seconds": wait_seconds, "sns_topic_arn": sns_topic_arn},
+        )
 
 
 def submit_batch_job(
@@ -325,8 +5411,12 @@ def submit_batch_job(
     job_name,
     job_definition_name,
     parameters,
+    array_size=None,
+    scheduling_priority=None,
+    share_identifier=None,
+    depends_on=None,
 ):
-    """Publishes the message to sns.
+    """Submits the batch job.
 
     Arguments:
         batch_client (client): The boto3 client for Batch
@@ -334,47 +5424,173 @@ def submit_batch_job(
         job_name (dict): The job name
         job_definition_name (dict): The job name
         parameters (string): The parameters as a json string
+        array_size (int): The number of child jobs to submit as an array job (or None)
+        scheduling_priority (int): overrides the job definition's scheduling priority
+            in fair share queues (or None)
+        share_identifier (string): the fair share identifier of the job (or None)
+        depends_on (list): dicts of the "jobId" of each job this job waits for and
+            optionally its dependency "type", e.g. N_TO_N between array jobs (or None)
 
     """
     global logger
 
+    # Checked first so events that are deferred do not offload their parameters
+    circuit_breaker = submit_circuit_breaker
+    if circuit_breaker is not None and not circuit_breaker.allow():
+        increment_metric("CircuitBreakerRejections", array_size or 1)
+        raise SubmissionDeferredError("Batch submission circuit breaker is open")
+
+    if parameters and parameter_offloader is not None:
+        try:
+            parameters = parameter_offloader.offload(parameters)
+        except Exception:
+            if circuit_breaker is not None:
+                circuit_breaker.release_trial()
+            raise
+
     logger.info(
-        f'Submitting batch job", "job_definition_name": "{job_definition_name}", '
-        + f'"job_queue": "{job_queue}", "job_name": "{job_name}", "parameters": "{parameters}'
+        "Submitting batch job",
+        extra={
+            "job_definition_name": job_definition_name,
+            "job_queue": job_queue,
+            "job_name": job_name,
+            "parameters": parameters,
+            "array_size": array_size,
+            "scheduling_priority": scheduling_priority,
+            "share_identifier": share_identifier,
+            "depends_on": depends_on,
+        },
     )
 
+    submit_job_arguments = {
+        "jobName": job_name,
+        "jobQueue": job_queue,
+        "jobDefinition": job_definition_name,
+    }
+
     if parameters:
-        return batch_client.submit_job(
-            jobName=job_name,
-            jobQueue=job_queue,
-            jobDefinition=job_definition_name,
-            parameters=parameters,
-        )
-    else:
-        return batch_client.submit_job(
-            jobName=job_name, jobQueue=job_queue, jobDefinition=job_definition_name
-        )
+        submit_job_arguments["parameters"] = parameters
 
+    if array_size:
+        submit_job_arguments["arrayProperties"] = {"size": array_size}
+
+    if scheduling_priority is not None:
+        submit_job_arguments["schedulingPriorityOverride"] = scheduling_priority
+
+    if share_identifier:
+        submit_job_arguments["shareIdentifier"] = share_identifier
+
+    if depends_on:
+        submit_job_arguments["dependsOn"] = depends_on
+
+    if batch_submit_rate_limiter is not None:
+        wait_seconds = batch_submit_rate_limiter.acquire()
+        if wait_seconds > 0:
+            increment_metric("RateLimiterWaits")
+            logger.info(
+                "Rate limited batch job submission",
+                extra={"wait_seconds": wait_seconds, "job_name": job_name},
+            )
 
-def get_escaped_json_string(json_string):
     try:
-        escaped_string = json.dumps(json.dumps(json_string))
-    except:
-        escaped_string = json.dumps(json_string)
+        response = call_aws_api(
+            "SubmitJob", batch_client.submit_job, **submit_job_arguments
+        )
+    except Exception as err:
+        if circuit_breaker is not None:
+            if is_service_failure(err):
+                circuit_breaker.record_failure()
+            elif isinstance(err, botocore.exceptions.ClientError):
+                circuit_breaker.record_success()
+            else:
+                # The request never reached Batch, so says nothing about its health
+                circuit_breaker.release_trial()
+        raise
+
+    if circuit_breaker is not None:
+        circuit_breaker.record_success()
+
+    increment_metric("JobsSubmitted", array_size or 1)
 
-    return escaped_string
+    return response
+
+
+def terminate_batch_jobs(batch_client, job_ids, reason):
+    """Terminates batch jobs, logging rather than raising the error of each failed call.
+
+    Arguments:
+        batch_client (client): The boto3 client for Batch
+        job_ids (iterable): the ids of the jobs to terminate
+        reason (string): the reason recorded against each job
+
+    """
+    for job_id in job_ids:
+        try:
+            call_aws_api(
+                "TerminateJob", batch_client.terminate_job, jobId=job_id, reason=reason
+            )
+        except Exception as err:
+            logger.error(
+                "Error occurred terminating batch job",
+                extra={"job_id": job_id, "error_message": str(err)},
+            )
+            continue
+
+        logger.info("Batch job terminated", extra={"job_id": job_id, "reason": reason})
 
 
 if __name__ == "__main__":
     try:
+        command_line_arguments = parse_command_line_arguments()
         args = get_parameters()
-        logger = setup_logging("INFO")
+        logger = setup_logging("INFO", args)
+        validate_config(args)
 
-        boto3.setup_default_session(
-            profile_name=args.aws_profile, region_name=args.aws_region
-        )
-        logger.info(os.getcwd())
-        json_content = json.loads(open("resources/event.json", "r").read())
-        handler(json_content, None)
+        setup_aws_session(args.aws_profile, args.aws_region)
+
+        if args.backfill_events or args.backfill_collections:
+            if args.backfill_concurrency:
+                args = args.replace(batch_submit_concurrency=args.backfill_concurrency)
+            if args.backfill_rate_per_second:
+                args = args.replace(
+                    batch_submit_rate_per_second=args.backfill_rate_per_second
+                )
+
+            apply_config(args)
+            batch_client, sns_client = get_cached_clients()
+            tracker = None
+            if args.backfill_track_jobs:
+                tracker = create_job_status_tracker(batch_client, sns_client)
+
+            totals = run_backfill(
+                batch_client,
+                sns_client,
+                get_backfill_events(),
+                args.backfill_checkpoint,
+                args.backfill_chunk_size,
+                tracker,
+            )
+            logger.info("Backfill complete", extra=totals)
+
+            if tracker is not None:
+                tracker.wait()
+
+            flush_error_alerts(sns_client)
+            if metrics is not None:
+                metrics.flush()
+        elif args.sweep_outbox:
+            apply_config(args)
+            batch_client, sns_client = get_cached_clients()
+            totals = sweep_outbox(batch_client, sns_client)
+            logger.info("Outbox sweep complete", extra=totals)
+            if metrics is not None:
+                metrics.flush()
+        else:
+            logger.info(os.getcwd())
+            json_content = json.loads(open("resources/event.json", "r").read())
+            handler(json_content, None)
     except Exception as err:
-        logger.error(f'Exception occurred for invocation", "error_message": {err}')
+        logger.error(
+            "Exception occurred for invocation",
+            extra={"error_message": err},
+        )
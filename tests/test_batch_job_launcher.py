@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
 """batch_job_launcher_lambda"""
+
 import pytest
 import argparse
+import concurrent.futures
 import botocore
+import gzip
+import io
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from batch_job_launcher_lambda import batch_job_launcher
 
 import unittest
@@ -40,9 +53,54 @@ args.batch_job_queue = JOB_QUEUE_NAME
 args.batch_job_name = JOB_NAME
 args.batch_job_definition_name = JOB_DEFINITION_NAME
 args.batch_parameters_json = None
+args.batch_submit_concurrency = 10
+args.batch_job_name_template = None
+args.batch_parameters_template_json = None
+args.idempotency_key_fields = None
+args.idempotency_ttl_seconds = 86400
+args.idempotency_cache_size = 1000
+args.idempotency_store_path = None
+args.batch_coalesce_max_events = 0
+args.batch_coalesce_window_seconds = 0
+args.batch_submit_rate_per_second = None
+args.batch_submit_burst = None
+args.sns_publish_rate_per_second = None
+args.sns_publish_burst = None
+args.batch_job_queues = None
+args.batch_queue_depth_ttl_seconds = 30
+args.batch_queue_max_depth = None
+args.batch_queue_depth_action = "defer"
+args.metrics_namespace = None
+args.profile_sample_rate = 0
+args.profile_top_n = 15
+args.profile_trace_memory = False
+args.job_tracking_seconds = 0
+args.job_tracking_min_interval_seconds = 5
+args.job_tracking_max_interval_seconds = 60
+args.alert_aggregation = False
+args.alert_cooldown_seconds = 300
+args.circuit_breaker_failure_threshold = None
+args.circuit_breaker_reset_seconds = 30
+args.circuit_breaker_store_path = None
+args.deferral_queue_url = None
+args.deferral_delay_seconds = 60
+args.batch_metadata_ttl_seconds = None
+args.batch_submit_engine = "threads"
+args.batch_routing_config = None
+args.batch_scheduling_rules_json = None
+args.batch_pipeline_json = None
+args.outbox_store_path = None
+args.outbox_lease_seconds = 300
+args.outbox_retention_seconds = 86400
+args.batch_parameters_offload_uri = None
+args.batch_parameters_offload_threshold_bytes = 8192
+args.glue_event_schema_json = None
 
 
 class TestRetriever(unittest.TestCase):
+    def setUp(self):
+        batch_job_launcher.reset_cached_state()
+
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_sns_message")
     @mock.patch(
         "batch_job_launcher_lambda.batch_job_launcher.generate_monitoring_error_message_payload"
@@ -68,7 +126,7 @@ class TestRetriever(unittest.TestCase):
         sns_client_mock = mock.MagicMock()
         get_batch_client_mock.return_value = batch_client_mock
         get_sns_client_mock.return_value = sns_client_mock
-        get_parameters_mock.return_value = args
+        get_parameters_mock.return_value = batch_job_launcher.Config(**vars(args))
 
         response_dict = {
             JOB_ARN_KEY: JOB_NAME,
@@ -114,6 +172,9 @@ class TestRetriever(unittest.TestCase):
 
 
 class TestRetriever(unittest.TestCase):
+    def setUp(self):
+        batch_job_launcher.reset_cached_state()
+
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_sns_message")
     @mock.patch(
         "batch_job_launcher_lambda.batch_job_launcher.generate_monitoring_error_message_payload"
@@ -139,7 +200,7 @@ class TestRetriever(unittest.TestCase):
         sns_client_mock = mock.MagicMock()
         get_batch_client_mock.return_value = batch_client_mock
         get_sns_client_mock.return_value = sns_client_mock
-        get_parameters_mock.return_value = args
+        get_parameters_mock.return_value = batch_job_launcher.Config(**vars(args))
 
         response_dict = {
             JOB_ARN_KEY: JOB_NAME,
@@ -206,6 +267,414 @@ class TestRetriever(unittest.TestCase):
             JOB_DEFINITION_NAME,
         )
 
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_handler_reuses_cached_config_and_clients_on_warm_invocation(
+        self,
+        mock_logger,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+    ):
+        batch_client_mock = mock.MagicMock()
+        get_batch_client_mock.return_value = batch_client_mock
+        get_parameters_mock.return_value = batch_job_launcher.Config(**vars(args))
+        submit_batch_job_mock.return_value = {
+            JOB_ARN_KEY: JOB_ARN,
+            JOB_ID_KEY: JOB_ID,
+        }
+
+        event = {
+            "test_key": "test_value",
+        }
+
+        with mock.patch.dict("os.environ", {"BATCH_JOB_QUEUE": JOB_QUEUE_NAME}):
+            batch_job_launcher.handler(event, None)
+            batch_job_launcher.handler(event, None)
+
+        get_parameters_mock.assert_called_once()
+        setup_logging_mock.assert_called_once()
+        get_batch_client_mock.assert_called_once()
+        get_sns_client_mock.assert_called_once()
+        self.assertEqual(2, submit_batch_job_mock.call_count)
+        submit_batch_job_mock.assert_called_with(
+            batch_client_mock,
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            None,
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_handler_rebuilds_config_and_clients_when_environment_changes(
+        self,
+        mock_logger,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+    ):
+        get_parameters_mock.return_value = batch_job_launcher.Config(**vars(args))
+        submit_batch_job_mock.return_value = {
+            JOB_ARN_KEY: JOB_ARN,
+            JOB_ID_KEY: JOB_ID,
+        }
+
+        event = {
+            "test_key": "test_value",
+        }
+
+        with mock.patch.dict("os.environ", {"BATCH_JOB_QUEUE": JOB_QUEUE_NAME}):
+            batch_job_launcher.handler(event, None)
+
+        with mock.patch.dict("os.environ", {"BATCH_JOB_QUEUE": "test/other_queue"}):
+            batch_job_launcher.handler(event, None)
+
+        self.assertEqual(2, get_parameters_mock.call_count)
+        self.assertEqual(2, setup_logging_mock.call_count)
+        self.assertEqual(2, get_batch_client_mock.call_count)
+        self.assertEqual(2, get_sns_client_mock.call_count)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_sns_message")
+    @mock.patch(
+        "batch_job_launcher_lambda.batch_job_launcher.generate_monitoring_error_message_payload"
+    )
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_handler_processes_multi_record_event_and_alerts_only_for_failures(
+        self,
+        mock_logger,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+        generate_monitoring_error_message_payload_mock,
+        send_sns_message_mock,
+    ):
+        serial_args = argparse.Namespace(**vars(args))
+        serial_args.batch_submit_concurrency = 1
+        get_parameters_mock.return_value = batch_job_launcher.Config(
+            **vars(serial_args)
+        )
+
+        error_message = "test_error_message"
+        client_error = botocore.exceptions.ClientError(
+            error_response={
+                "Error": {"Code": "test_error_code", "Message": error_message}
+            },
+            operation_name="op_name",
+        )
+        submit_batch_job_mock.side_effect = [
+            {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID},
+            client_error,
+            {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID},
+        ]
+
+        event = [
+            {"correlation_id": "test_1"},
+            {"correlation_id": "test_2"},
+            {"correlation_id": "test_3"},
+        ]
+
+        results = batch_job_launcher.handler(event, None)
+
+        self.assertEqual(3, submit_batch_job_mock.call_count)
+        self.assertEqual(
+            ["test_1", "test_2", "test_3"], [result["record_id"] for result in results]
+        )
+        self.assertEqual(
+            [None, error_message, None],
+            [result["error_message"] for result in results],
+        )
+        self.assertEqual(JOB_ID, results[0]["job_id"])
+
+        generate_monitoring_error_message_payload_mock.assert_called_once_with(
+            MOCK_CHANNEL,
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            CRITICAL_SEVERITY,
+            ERROR_NOTIFICATION_TYPE,
+            error_message,
+        )
+        send_sns_message_mock.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_sns_message")
+    @mock.patch(
+        "batch_job_launcher_lambda.batch_job_launcher.generate_monitoring_error_message_payload"
+    )
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_handler_returns_batch_item_failures_for_sqs_event(
+        self,
+        mock_logger,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+        generate_monitoring_error_message_payload_mock,
+        send_sns_message_mock,
+    ):
+        serial_args = argparse.Namespace(**vars(args))
+        serial_args.batch_submit_concurrency = 1
+        get_parameters_mock.return_value = batch_job_launcher.Config(
+            **vars(serial_args)
+        )
+
+        client_error = botocore.exceptions.ClientError(
+            error_response={
+                "Error": {"Code": "test_error_code", "Message": ERROR_MESSAGE}
+            },
+            operation_name="op_name",
+        )
+        submit_batch_job_mock.side_effect = [
+            client_error,
+            {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID},
+        ]
+
+        event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-1",
+                    "body": json.dumps({"correlation_id": "test_1"}),
+                },
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-2",
+                    "body": json.dumps({"correlation_id": "test_2"}),
+                },
+            ]
+        }
+
+        response = batch_job_launcher.handler(event, None)
+
+        self.assertEqual(
+            {"batchItemFailures": [{"itemIdentifier": "message-1"}]}, response
+        )
+        generate_monitoring_error_message_payload_mock.assert_called_once()
+        send_sns_message_mock.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_handler_coalesces_multi_record_event_into_array_jobs(
+        self,
+        mock_logger,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+    ):
+        batch_client_mock = mock.MagicMock()
+        get_batch_client_mock.return_value = batch_client_mock
+        coalescing_args = argparse.Namespace(**vars(args))
+        coalescing_args.batch_submit_concurrency = 1
+        coalescing_args.batch_coalesce_max_events = 2
+        get_parameters_mock.return_value = batch_job_launcher.Config(
+            **vars(coalescing_args)
+        )
+        submit_batch_job_mock.return_value = {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID}
+
+        event = [
+            {"correlation_id": "test_1"},
+            {"correlation_id": "test_2"},
+            {"correlation_id": "test_3"},
+        ]
+
+        results = batch_job_launcher.handler(event, None)
+
+        submit_batch_job_mock.assert_has_calls(
+            [
+                call(
+                    batch_client_mock,
+                    JOB_QUEUE_NAME,
+                    JOB_NAME,
+                    JOB_DEFINITION_NAME,
+                    {"manifest": json.dumps(event[:2])},
+                    array_size=2,
+                ),
+                call(
+                    batch_client_mock,
+                    JOB_QUEUE_NAME,
+                    JOB_NAME,
+                    JOB_DEFINITION_NAME,
+                    None,
+                ),
+            ]
+        )
+        self.assertEqual(
+            [f"{JOB_ID}:0", f"{JOB_ID}:1", JOB_ID],
+            [result["job_id"] for result in results],
+        )
+
+    def test_event_coalescer_flushes_on_count_and_window(self):
+        now = [0.0]
+        flushed = []
+        coalescer = batch_job_launcher.EventCoalescer(
+            max_events=2,
+            window_seconds=5,
+            flush_callback=flushed.append,
+            clock=lambda: now[0],
+        )
+
+        coalescer.add("1", {"correlation_id": "test_1"})
+        coalescer.add("2", {"correlation_id": "test_2"})
+        coalescer.add("3", {"correlation_id": "test_3"})
+        coalescer.poll()
+
+        self.assertEqual([["1", "2"]], [[r for r, _ in group] for group in flushed])
+
+        now[0] += 5
+        coalescer.poll()
+
+        self.assertEqual(
+            [["1", "2"], ["3"]], [[r for r, _ in group] for group in flushed]
+        )
+
+    def test_json_formatter_outputs_valid_json_with_extra_fields(self):
+        formatter = batch_job_launcher.JsonFormatter("dev", "test-app", "test-host")
+        record = logging.LogRecord(
+            "test", logging.INFO, "test.py", 1, "Publishing payload", (), None
+        )
+        record.payload = {"title_text": 'Error "quoted" message'}
+        record.job_name = JOB_NAME
+
+        log_entry = json.loads(formatter.format(record))
+
+        self.assertEqual("Publishing payload", log_entry["message"])
+        self.assertEqual("INFO", log_entry["log_level"])
+        self.assertEqual("dev", log_entry["environment"])
+        self.assertEqual("test-app", log_entry["application"])
+        self.assertEqual("test-host", log_entry["host"])
+        self.assertEqual({"title_text": 'Error "quoted" message'}, log_entry["payload"])
+        self.assertEqual(JOB_NAME, log_entry["job_name"])
+        self.assertNotIn("msg", log_entry)
+
+    def test_json_formatter_does_not_serialise_dropped_records(self):
+        formatter = batch_job_launcher.JsonFormatter("dev", "test-app", "test-host")
+        the_logger = logging.getLogger("test_json_formatter_dropped")
+        the_logger.propagate = False
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        the_logger.addHandler(handler)
+        the_logger.setLevel(logging.WARNING)
+        payload = mock.MagicMock()
+
+        with mock.patch.object(formatter, "format") as format_mock:
+            the_logger.info("Publishing payload", extra={"payload": payload})
+
+        format_mock.assert_not_called()
+        payload.__str__.assert_not_called()
+
+    def test_module_import_skips_modules_not_needed_by_the_handler(self):
+        imported = (
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; "
+                    "from batch_job_launcher_lambda import batch_job_launcher; "
+                    "print(','.join(sorted(sys.modules)))",
+                ],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            )
+            .stdout.strip()
+            .split(",")
+        )
+
+        for module in ("boto3", "s3transfer", "argparse", "sqlite3", "asyncio"):
+            self.assertNotIn(module, imported)
+
+    def test_get_parameters_uses_command_line_defaults_without_argparse(self):
+        with mock.patch.dict("os.environ", {"ENVIRONMENT": "test"}, clear=True):
+            parameters = batch_job_launcher.get_parameters()
+
+        self.assertEqual("test", parameters.environment)
+        self.assertEqual("INFO", parameters.log_level)
+        self.assertEqual("eu-west-2", parameters.aws_region)
+        self.assertEqual(batch_job_launcher.UNSET_TEXT, parameters.application)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_aws_session")
+    def test_get_batch_client_creates_client_from_shared_session(
+        self, get_aws_session_mock
+    ):
+        client = batch_job_launcher.get_batch_client()
+
+        get_aws_session_mock.return_value.create_client.assert_called_once_with(
+            "batch", config=batch_job_launcher.boto_client_config
+        )
+        self.assertEqual(
+            get_aws_session_mock.return_value.create_client.return_value, client
+        )
+
+    def test_get_glue_events_returns_none_for_single_event(self):
+        self.assertIsNone(
+            batch_job_launcher.get_glue_events({"test_key": "test_value"})
+        )
+
+    def test_get_glue_events_extracts_sqs_and_sns_records(self):
+        glue_event = {"correlation_id": "test_1"}
+        sns_envelope = {"Type": "Notification", "Message": json.dumps(glue_event)}
+
+        event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-1",
+                    "body": json.dumps(glue_event),
+                },
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-2",
+                    "body": json.dumps(sns_envelope),
+                },
+                {
+                    "EventSource": "aws:sns",
+                    "Sns": {
+                        "MessageId": "message-3",
+                        "Message": json.dumps(glue_event),
+                    },
+                },
+            ]
+        }
+
+        expected = [
+            ("message-1", glue_event),
+            ("message-2", glue_event),
+            ("message-3", glue_event),
+        ]
+
+        self.assertEqual(expected, batch_job_launcher.get_glue_events(event))
+
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.generate_custom_elements")
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
     def test_sns_payload_generates_valid_payload(
@@ -334,13 +803,2460 @@ class TestRetriever(unittest.TestCase):
         )
         self.assertEqual(expected_payload, actual_payload)
 
+    def test_build_job_request_renders_templates_from_glue_event(self):
+        template_args = argparse.Namespace(**vars(args))
+        template_args.batch_job_name_template = "reconciliation-{collection_name}"
+        template_args.batch_parameters_template_json = {
+            "collection": "{collection_name}",
+            "date": "{export_date}",
+            "type": "{snapshot_type}",
+        }
+
+        glue_event = {
+            "collection_name": "db.test.collection",
+            "snapshot_type": "incremental",
+            "export_date": "2020-01-22",
+        }
+
+        with mock.patch.object(batch_job_launcher, "args", template_args):
+            job_request = batch_job_launcher.build_job_request(glue_event)
+
+        expected = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": "reconciliation-db_test_collection",
+            "job_definition_name": JOB_DEFINITION_NAME,
+            "parameters": {
+                "collection": "db.test.collection",
+                "date": "2020-01-22",
+                "type": "incremental",
+            },
+        }
+        self.assertEqual(expected, job_request)
+
+    def test_build_job_request_uses_static_config_without_templates(self):
+        with mock.patch.object(batch_job_launcher, "args", args):
+            job_request = batch_job_launcher.build_job_request({"test_key": "test"})
+
+        expected = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+            "parameters": None,
+        }
+        self.assertEqual(expected, job_request)
+
+    def test_compile_template_reuses_compiled_template(self):
+        template = "reconciliation-{collection_name}-{export_date}"
+
+        compiled_template = batch_job_launcher.compile_template(template)
+
+        self.assertEqual(
+            [("reconciliation-", "collection_name"), ("-", "export_date")],
+            compiled_template,
+        )
+        self.assertIs(compiled_template, batch_job_launcher.compile_template(template))
+
+    def test_render_template_raises_for_missing_event_field(self):
+        with self.assertRaises(Exception) as context:
+            batch_job_launcher.render_template("job-{collection_name}", {})
+
+        self.assertIn("collection_name", str(context.exception))
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
-    def test_submit_batch_job_sends_right_message_with_parameters(
+    def test_launch_batch_job_skips_duplicate_glue_event(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+    ):
+        idempotent_args = argparse.Namespace(**vars(args))
+        idempotent_args.idempotency_key_fields = ["correlation_id", "export_date"]
+        submit_batch_job_mock.return_value = {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID}
+
+        glue_event = {"correlation_id": "test_1", "export_date": "2020-01-22"}
+
+        with mock.patch.object(batch_job_launcher, "args", idempotent_args):
+            first_result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), glue_event, "message-1"
+            )
+            second_result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), dict(glue_event), "message-2"
+            )
+            other_result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(),
+                mock.MagicMock(),
+                {"correlation_id": "test_2", "export_date": "2020-01-22"},
+                "message-3",
+            )
+
+        self.assertEqual(2, submit_batch_job_mock.call_count)
+        self.assertFalse(first_result["duplicate"])
+        self.assertTrue(second_result["duplicate"])
+        self.assertEqual(JOB_ID, second_result["job_id"])
+        self.assertFalse(other_result["duplicate"])
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_sns_message")
+    @mock.patch(
+        "batch_job_launcher_lambda.batch_job_launcher.generate_monitoring_error_message_payload"
+    )
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_releases_idempotency_key_after_failure(
         self,
         mock_logger,
+        submit_batch_job_mock,
+        generate_monitoring_error_message_payload_mock,
+        send_sns_message_mock,
     ):
+        idempotent_args = argparse.Namespace(**vars(args))
+        idempotent_args.idempotency_key_fields = ["correlation_id"]
+        client_error = botocore.exceptions.ClientError(
+            error_response={
+                "Error": {"Code": "test_error_code", "Message": ERROR_MESSAGE}
+            },
+            operation_name="op_name",
+        )
+        submit_batch_job_mock.side_effect = [
+            client_error,
+            {JOB_ARN_KEY: JOB_ARN, JOB_ID_KEY: JOB_ID},
+        ]
+
+        glue_event = {"correlation_id": "test_1"}
+
+        with mock.patch.object(batch_job_launcher, "args", idempotent_args):
+            failed_result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), glue_event
+            )
+            retried_result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), glue_event
+            )
+
+        self.assertEqual(ERROR_MESSAGE, failed_result["error_message"])
+        self.assertEqual(JOB_ID, retried_result["job_id"])
+        self.assertFalse(retried_result["duplicate"])
+
+    def test_idempotency_cache_expires_and_evicts_entries(self):
+        now = [1000.0]
+        cache = batch_job_launcher.IdempotencyCache(
+            max_size=2, ttl_seconds=60, clock=lambda: now[0]
+        )
+
+        cache.put("key-1", "job-1")
+        cache.put("key-2", "job-2")
+        cache.get("key-1")
+        cache.put("key-3", "job-3")
+
+        self.assertEqual("job-1", cache.get("key-1"))
+        self.assertIsNone(cache.get("key-2"))
+
+        now[0] += 61
+        self.assertIsNone(cache.get("key-1"))
+
+    def test_token_bucket_allows_burst_then_waits_for_refill(self):
+        now = [0.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = batch_job_launcher.TokenBucket(
+            rate_per_second=2, capacity=2, clock=lambda: now[0], sleep=fake_sleep
+        )
+
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0.5, bucket.acquire())
+        self.assertEqual(0.5, bucket.acquire())
+
+        now[0] += 10
+        self.assertEqual(0, bucket.acquire())
+
+        self.assertEqual([0.5, 0.5], sleeps)
+        self.assertEqual(
+            {
+                "acquired_count": 5,
+                "waited_count": 2,
+                "total_wait_seconds": 1.0,
+                "max_wait_seconds": 0.5,
+            },
+            bucket.get_metrics(),
+        )
+
+    def test_token_bucket_reserves_tokens_for_concurrent_callers(self):
+        now = [0.0]
+        bucket = batch_job_launcher.TokenBucket(
+            rate_per_second=1, capacity=1, clock=lambda: now[0], sleep=lambda _: None
+        )
+
+        waits = [bucket.acquire() for _ in range(3)]
+
+        self.assertEqual([0, 1.0, 2.0], waits)
+
+    def test_create_rate_limiter_returns_none_without_rate(self):
+        self.assertIsNone(batch_job_launcher.create_rate_limiter(None, None))
+        self.assertEqual(5, batch_job_launcher.create_rate_limiter(5, None).capacity)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_acquires_rate_limiter_token(self, mock_logger):
         batch_mock = mock.MagicMock()
-        batch_mock.submit_job = mock.MagicMock()
+        rate_limiter_mock = mock.MagicMock()
+        rate_limiter_mock.acquire.return_value = 0.25
+
+        with mock.patch.object(
+            batch_job_launcher, "batch_submit_rate_limiter", rate_limiter_mock
+        ):
+            batch_job_launcher.submit_batch_job(
+                batch_mock, JOB_QUEUE_NAME, JOB_NAME, JOB_DEFINITION_NAME, None
+            )
+
+        rate_limiter_mock.acquire.assert_called_once()
+        batch_mock.submit_job.assert_called_once()
+
+    def generate_queue_router_batch_mock(self, queue_depths, disabled_queues=()):
+        batch_mock = mock.MagicMock()
+        batch_mock.describe_job_queues.return_value = {
+            "jobQueues": [
+                {
+                    "jobQueueName": job_queue,
+                    "jobQueueArn": f"arn:{job_queue}",
+                    "state": "DISABLED" if job_queue in disabled_queues else "ENABLED",
+                    "status": "VALID",
+                }
+                for job_queue in queue_depths
+            ]
+        }
+        batch_mock.list_jobs.side_effect = lambda jobQueue, **kwargs: {
+            "jobSummaryList": [{}] * queue_depths[jobQueue]
+        }
+        return batch_mock
+
+    def test_queue_router_selects_least_loaded_enabled_queue(self):
+        now = [0.0]
+        batch_mock = self.generate_queue_router_batch_mock(
+            {"queue-1": 5, "queue-2": 2, "queue-3": 0}, disabled_queues=["queue-3"]
+        )
+        router = batch_job_launcher.QueueRouter(
+            batch_mock,
+            ["queue-1", "queue-2", "queue-3"],
+            ttl_seconds=30,
+            clock=lambda: now[0],
+        )
+
+        selected = [router.select_queue() for _ in range(5)]
+
+        self.assertEqual(
+            ["queue-2", "queue-2", "queue-2", "queue-1", "queue-2"], selected
+        )
+        batch_mock.describe_job_queues.assert_called_once()
+        self.assertEqual(2, batch_mock.list_jobs.call_count)
+
+        now[0] += 30
+        router.select_queue()
+
+        self.assertEqual(2, batch_mock.describe_job_queues.call_count)
+        self.assertEqual(4, batch_mock.list_jobs.call_count)
+
+    def test_queue_router_defers_or_rejects_when_all_queues_are_full(self):
+        batch_mock = self.generate_queue_router_batch_mock({"queue-1": 10})
+
+        deferring_router = batch_job_launcher.QueueRouter(
+            batch_mock, ["queue-1"], ttl_seconds=30, max_depth=10
+        )
+        rejecting_router = batch_job_launcher.QueueRouter(
+            batch_mock, ["queue-1"], ttl_seconds=30, max_depth=10, depth_action="reject"
+        )
+
+        with self.assertRaises(batch_job_launcher.SubmissionDeferredError):
+            deferring_router.select_queue()
+
+        with self.assertRaises(batch_job_launcher.SubmissionRejectedError):
+            rejecting_router.select_queue()
+
+    def test_queue_router_caps_depth_count_and_records_list_jobs_metrics(self):
+        batch_mock = self.generate_queue_router_batch_mock({"queue-1": 0})
+        batch_mock.list_jobs.side_effect = lambda **kwargs: {
+            "jobSummaryList": [{}] * 100,
+            "nextToken": "more",
+        }
+        recorder = batch_job_launcher.MetricsRecorder("Test/Namespace", {})
+        router = batch_job_launcher.QueueRouter(batch_mock, ["queue-1"], ttl_seconds=30)
+
+        with mock.patch.object(batch_job_launcher, "metrics", recorder):
+            self.assertEqual("queue-1", router.select_queue())
+
+        self.assertEqual(
+            batch_job_launcher.MAX_COUNTED_QUEUE_DEPTH + 1,
+            router.get_queue_depth("queue-1"),
+        )
+        self.assertEqual(10, batch_mock.list_jobs.call_count)
+        self.assertEqual(10, len(recorder.timings["ListJobsTime"]))
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_defers_without_alert_when_queues_are_full(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        routing_args = argparse.Namespace(**vars(args))
+        routing_args.batch_job_queues = ["queue-1"]
+        routing_args.batch_queue_max_depth = 10
+        batch_mock = self.generate_queue_router_batch_mock({"queue-1": 10})
+
+        with mock.patch.object(batch_job_launcher, "args", routing_args):
+            result = batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), {"correlation_id": "test_1"}, "message-1"
+            )
+
+        self.assertTrue(result["deferred"])
+        self.assertIsNotNone(result["error_message"])
+        submit_batch_job_mock.assert_not_called()
+        send_error_alert_mock.assert_not_called()
+
+    def test_metrics_recorder_flushes_one_embedded_metric_format_line(self):
+        stream = io.StringIO()
+        recorder = batch_job_launcher.MetricsRecorder(
+            "Test/Namespace",
+            {"Application": "app", "Environment": "dev"},
+            clock=lambda: 1000.0,
+            stream=stream,
+        )
+
+        recorder.add_timing("SubmitJobTime", 12.5)
+        recorder.add_timing("SubmitJobTime", 7.25)
+        recorder.increment("JobsSubmitted", 2)
+        recorder.flush()
+        recorder.flush()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        metric_line = json.loads(lines[0])
+        self.assertEqual(1000000, metric_line["_aws"]["Timestamp"])
+        directive = metric_line["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual("Test/Namespace", directive["Namespace"])
+        self.assertEqual([["Application", "Environment"]], directive["Dimensions"])
+        self.assertIn(
+            {"Name": "SubmitJobTime", "Unit": "Milliseconds"}, directive["Metrics"]
+        )
+        self.assertIn({"Name": "JobsSubmitted", "Unit": "Count"}, directive["Metrics"])
+        self.assertEqual([12.5, 7.25], metric_line["SubmitJobTime"])
+        self.assertEqual(2, metric_line["JobsSubmitted"])
+        self.assertEqual("app", metric_line["Application"])
+
+    def test_metrics_recorder_splits_timers_over_value_limit(self):
+        stream = io.StringIO()
+        recorder = batch_job_launcher.MetricsRecorder(
+            "Test/Namespace", {"Application": "app"}, stream=stream
+        )
+
+        for value in range(250):
+            recorder.add_timing("SubmitJobTime", value)
+        recorder.increment("JobsSubmitted")
+        recorder.flush()
+
+        metric_lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(
+            [100, 100, 50], [len(line["SubmitJobTime"]) for line in metric_lines]
+        )
+        self.assertEqual(1, metric_lines[0]["JobsSubmitted"])
+        self.assertNotIn("JobsSubmitted", metric_lines[1])
+
+    def test_call_aws_api_records_throttles_and_retries(self):
+        recorder = batch_job_launcher.MetricsRecorder("Test/Namespace", {})
+        throttled = botocore.exceptions.ClientError(
+            error_response={
+                "Error": {"Code": "TooManyRequestsException", "Message": "slow down"},
+                "ResponseMetadata": {"RetryAttempts": 4},
+            },
+            operation_name="SubmitJob",
+        )
+        api_call = mock.MagicMock(
+            side_effect=[{"ResponseMetadata": {"RetryAttempts": 1}}, throttled]
+        )
+
+        with mock.patch.object(batch_job_launcher, "metrics", recorder):
+            batch_job_launcher.call_aws_api("SubmitJob", api_call, jobName=JOB_NAME)
+            with self.assertRaises(botocore.exceptions.ClientError):
+                batch_job_launcher.call_aws_api("SubmitJob", api_call, jobName=JOB_NAME)
+
+        self.assertEqual(5, recorder.counts["Retries"])
+        self.assertEqual(1, recorder.counts["Throttles"])
+        self.assertEqual(1, recorder.counts["SubmitJobErrors"])
+        self.assertEqual(2, len(recorder.timings["SubmitJobTime"]))
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sns_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_parameters")
+    def test_handler_flushes_metrics_once_per_invocation(
+        self,
+        get_parameters_mock,
+        setup_logging_mock,
+        get_batch_client_mock,
+        get_sns_client_mock,
+        submit_batch_job_mock,
+    ):
+        metrics_args = argparse.Namespace(**vars(args))
+        metrics_args.metrics_namespace = "Test/Namespace"
+        metrics_args.environment = "dev"
+        metrics_args.application = "app"
+        get_parameters_mock.return_value = batch_job_launcher.Config(
+            **vars(metrics_args)
+        )
+        submit_batch_job_mock.return_value = {"jobArn": "arn", "jobId": "id"}
+        stream = io.StringIO()
+
+        with mock.patch("sys.stdout", stream):
+            batch_job_launcher.handler({"correlation_id": "test_1"}, None)
+            batch_job_launcher.handler({"correlation_id": "test_2"}, None)
+
+        metric_lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(2, len(metric_lines))
+        self.assertEqual(1, len(metric_lines[0]["HandlerTime"]))
+        self.assertIn("ConfigRebuilds", metric_lines[0])
+        self.assertIn("WarmStarts", metric_lines[1])
+
+    def test_is_profiled_invocation_samples_at_configured_rate(self):
+        profile_args = argparse.Namespace(**vars(args))
+
+        with mock.patch.object(batch_job_launcher, "args", profile_args):
+            self.assertFalse(batch_job_launcher.is_profiled_invocation())
+
+            profile_args.profile_sample_rate = 0.1
+            with mock.patch("random.random", side_effect=[0.05, 0.5]):
+                self.assertTrue(batch_job_launcher.is_profiled_invocation())
+                self.assertFalse(batch_job_launcher.is_profiled_invocation())
+
+            profile_args.profile_sample_rate = 1
+            self.assertTrue(batch_job_launcher.is_profiled_invocation())
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_profile_invocation_logs_hotspots_and_memory(self, mock_logger):
+        profile_args = argparse.Namespace(**vars(args))
+        profile_args.profile_top_n = 3
+        profile_args.profile_trace_memory = True
+
+        def allocate(count):
+            return len([str(number) for number in range(count)])
+
+        with mock.patch.object(batch_job_launcher, "args", profile_args):
+            result = batch_job_launcher.profile_invocation(allocate, 1000)
+
+        self.assertEqual(1000, result)
+        mock_logger.info.assert_called_once()
+        (message,) = mock_logger.info.call_args[0]
+        profile = mock_logger.info.call_args[1]["extra"]["profile"]
+        self.assertEqual("Handler profile", message)
+        self.assertLessEqual(len(profile["hotspots"]), 3)
+        self.assertTrue(
+            any("allocate" in hotspot["function"] for hotspot in profile["hotspots"])
+        )
+        self.assertGreater(profile["memory_peak_bytes"], 0)
+        self.assertLessEqual(len(profile["memory_hotspots"]), 3)
+        json.dumps(profile)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_profile_invocation_includes_worker_threads(self, mock_logger):
+        profile_args = argparse.Namespace(**vars(args))
+        profile_args.profile_top_n = 50
+        profile_args.profile_trace_memory = False
+
+        def work_in_worker(count):
+            return sum(len(str(number)) for number in range(count))
+
+        def submit_to_pool(count):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                return sum(executor.map(work_in_worker, [count, count]))
+
+        with mock.patch.object(batch_job_launcher, "args", profile_args):
+            result = batch_job_launcher.profile_invocation(submit_to_pool, 10000)
+
+        self.assertEqual(2 * work_in_worker(10000), result)
+        profile = mock_logger.info.call_args[1]["extra"]["profile"]
+        self.assertTrue(
+            any(
+                "work_in_worker" in hotspot["function"]
+                for hotspot in profile["hotspots"]
+            )
+        )
+
+    def test_generate_backfill_events_covers_date_range_per_collection(self):
+        glue_events = list(
+            batch_job_launcher.generate_backfill_events(
+                ["db.a", "db.b"], "2020-01-30", "2020-02-01", "full"
+            )
+        )
+
+        self.assertEqual(6, len(glue_events))
+        self.assertEqual(
+            {
+                "correlation_id": "backfill_db.b_2020-02-01",
+                "collection_name": "db.b",
+                "snapshot_type": "full",
+                "export_date": "2020-02-01",
+            },
+            glue_events[-1],
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_batch_jobs")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_run_backfill_resumes_from_checkpoint(
+        self, mock_logger, launch_batch_jobs_mock
+    ):
+        glue_events = [{"correlation_id": f"test_{index}"} for index in range(5)]
+        failed_key = batch_job_launcher.generate_backfill_key(glue_events[3])
+
+        def launch(batch_client, sns_client, pending):
+            return [
+                batch_job_launcher.generate_launch_result(
+                    key,
+                    error_message="failed" if key == failed_key else None,
+                    job_id=None if key == failed_key else "job",
+                )
+                for key, _ in pending
+            ]
+
+        launch_batch_jobs_mock.side_effect = launch
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", args
+        ):
+            checkpoint_path = os.path.join(directory, "backfill.checkpoint")
+
+            first_totals = batch_job_launcher.run_backfill(
+                None, None, iter(glue_events), checkpoint_path, 2
+            )
+            launch_batch_jobs_mock.side_effect = None
+            launch_batch_jobs_mock.return_value = [
+                batch_job_launcher.generate_launch_result(failed_key, job_id="job")
+            ]
+            second_totals = batch_job_launcher.run_backfill(
+                None, None, iter(glue_events), checkpoint_path, 2
+            )
+
+            self.assertEqual(
+                5, len(batch_job_launcher.load_backfill_checkpoint(checkpoint_path))
+            )
+
+        self.assertEqual(
+            {"submitted": 4, "duplicate": 0, "skipped": 0, "rejected": 0, "failed": 1},
+            first_totals,
+        )
+        self.assertEqual(
+            {"submitted": 1, "duplicate": 0, "skipped": 4, "rejected": 0, "failed": 0},
+            second_totals,
+        )
+        self.assertEqual(4, launch_batch_jobs_mock.call_count)
+        self.assertEqual(
+            [(failed_key, glue_events[3])], launch_batch_jobs_mock.call_args[0][2]
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_batch_jobs")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_run_backfill_rejects_invalid_events(
+        self, mock_logger, launch_batch_jobs_mock
+    ):
+        validating_args = argparse.Namespace(**vars(args))
+        validating_args.glue_event_schema_json = {"export_date": r"\d{4}-\d{2}-\d{2}"}
+        glue_events = [
+            {"export_date": "2020-01-01"},
+            {"export_date": "yesterday"},
+            ["not", "an", "object"],
+        ]
+        launch_batch_jobs_mock.side_effect = lambda batch_client, sns_client, pending: [
+            batch_job_launcher.generate_launch_result(key, job_id="job")
+            for key, _ in pending
+        ]
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", validating_args
+        ):
+            totals = batch_job_launcher.run_backfill(
+                None,
+                None,
+                iter(glue_events),
+                os.path.join(directory, "backfill.checkpoint"),
+                10,
+            )
+
+        self.assertEqual(
+            {"submitted": 1, "duplicate": 0, "skipped": 0, "rejected": 2, "failed": 0},
+            totals,
+        )
+        self.assertEqual(
+            [glue_events[0]],
+            [glue_event for _, glue_event in launch_batch_jobs_mock.call_args[0][2]],
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_batch_jobs")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_run_backfill_continues_past_malformed_lines(
+        self, mock_logger, launch_batch_jobs_mock
+    ):
+        launch_batch_jobs_mock.side_effect = lambda batch_client, sns_client, pending: [
+            batch_job_launcher.generate_launch_result(key, job_id="job")
+            for key, _ in pending
+        ]
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", args
+        ):
+            events_path = os.path.join(directory, "events.jsonl")
+            with open(events_path, "w") as events_file:
+                events_file.write('{"export_date": "1"}\n{"export_date": \n\n')
+                events_file.write('{"export_date": "3"}\n')
+
+            totals = batch_job_launcher.run_backfill(
+                None,
+                None,
+                batch_job_launcher.read_backfill_events(events_path),
+                os.path.join(directory, "backfill.checkpoint"),
+                10,
+            )
+
+        self.assertEqual(
+            {"submitted": 2, "duplicate": 0, "skipped": 0, "rejected": 1, "failed": 0},
+            totals,
+        )
+        mock_logger.error.assert_called_once()
+        self.assertEqual(2, mock_logger.error.call_args[1]["extra"]["line_number"])
+
+    def test_job_status_tracker_describes_jobs_in_batches_of_100(self):
+        batch_mock = mock.MagicMock()
+        batch_mock.describe_jobs.side_effect = lambda jobs: {
+            "jobs": [{"jobId": job_id, "status": "RUNNING"} for job_id in jobs]
+        }
+        tracker = batch_job_launcher.JobStatusTracker(batch_mock, None, 5, 60)
+
+        for index in range(250):
+            tracker.add(f"job-{index}")
+        tracker.add("job-0:3")
+
+        self.assertEqual(0, tracker.poll())
+        self.assertEqual(
+            [100, 100, 50],
+            [
+                len(describe_call[1]["jobs"])
+                for describe_call in batch_mock.describe_jobs.call_args_list
+            ],
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_job_status_tracker_backs_off_and_alerts_failed_jobs(
+        self, mock_logger, send_error_alert_mock
+    ):
+        statuses = iter(
+            [
+                [{"jobId": "job-1", "status": "RUNNING"}],
+                [{"jobId": "job-1", "status": "RUNNING"}],
+                [
+                    {
+                        "jobId": "job-1",
+                        "jobName": JOB_NAME,
+                        "jobQueue": JOB_QUEUE_NAME,
+                        "jobDefinition": JOB_DEFINITION_NAME,
+                        "status": "FAILED",
+                        "statusReason": "Essential container exited",
+                        "createdAt": 1000,
+                        "startedAt": 4000,
+                        "stoppedAt": 9000,
+                    }
+                ],
+            ]
+        )
+        batch_mock = mock.MagicMock()
+        batch_mock.describe_jobs.side_effect = lambda jobs: {"jobs": next(statuses)}
+        sleeps = []
+        recorder = batch_job_launcher.MetricsRecorder("Test/Namespace", {})
+        tracker = batch_job_launcher.JobStatusTracker(
+            batch_mock, "sns", 5, 15, clock=lambda: 0, sleep=sleeps.append
+        )
+
+        tracker.add("job-1")
+        with mock.patch.object(batch_job_launcher, "metrics", recorder):
+            unfinished = tracker.wait(100)
+
+        self.assertEqual(0, unfinished)
+        self.assertEqual([5, 10, 15], sleeps)
+        self.assertEqual(1, recorder.counts["JobsFailed"])
+        self.assertEqual([3000], recorder.timings["JobQueuedTime"])
+        self.assertEqual([5000], recorder.timings["JobRunTime"])
+        send_error_alert_mock.assert_called_once_with(
+            "sns",
+            "Batch job job-1 failed: Essential container exited",
+            {
+                "job_queue": JOB_QUEUE_NAME,
+                "job_name": JOB_NAME,
+                "job_definition_name": JOB_DEFINITION_NAME,
+            },
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_job_status_tracker_stops_at_timeout(self, mock_logger):
+        now = [0]
+        batch_mock = mock.MagicMock()
+        batch_mock.describe_jobs.return_value = {
+            "jobs": [{"jobId": "job-1", "status": "RUNNABLE"}]
+        }
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        tracker = batch_job_launcher.JobStatusTracker(
+            batch_mock, None, 4, 60, clock=lambda: now[0], sleep=sleep
+        )
+        tracker.add_results(
+            [
+                batch_job_launcher.generate_launch_result("1", job_id="job-1"),
+                batch_job_launcher.generate_launch_result(
+                    "2", job_id="job-2", duplicate=True
+                ),
+                batch_job_launcher.generate_launch_result("3", error_message="error"),
+            ]
+        )
+
+        self.assertEqual(1, tracker.wait(10))
+        self.assertEqual(10, now[0])
+        self.assertEqual(2, batch_mock.describe_jobs.call_count)
+
+    def test_alert_aggregator_groups_errors_and_respects_cooldown(self):
+        now = [0]
+        aggregator = batch_job_launcher.AlertAggregator(300, clock=lambda: now[0])
+        job_request = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+        }
+
+        for _ in range(3):
+            aggregator.add("Service unavailable", job_request)
+        aggregator.add("Access denied", job_request)
+
+        due_alerts = aggregator.take_due_alerts()
+        self.assertEqual(
+            {"Service unavailable": 3, "Access denied": 1},
+            {alert["error_message"]: alert["count"] for alert in due_alerts},
+        )
+
+        now[0] = 200
+        aggregator.add("Service unavailable", job_request)
+        self.assertEqual([], aggregator.take_due_alerts())
+
+        now[0] = 301
+        aggregator.add("Service unavailable", job_request)
+        due_alerts = aggregator.take_due_alerts()
+        self.assertEqual(1, len(due_alerts))
+        self.assertEqual(2, due_alerts[0]["count"])
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_flush_error_alerts_publishes_summaries_in_batches_of_10(self, mock_logger):
+        sns_mock = mock.MagicMock()
+        sns_mock.publish_batch.side_effect = (
+            lambda TopicArn, PublishBatchRequestEntries: {
+                "Successful": [
+                    {"Id": entry["Id"]} for entry in PublishBatchRequestEntries
+                ]
+            }
+        )
+        aggregator = batch_job_launcher.AlertAggregator(300)
+        job_request = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+        }
+
+        with mock.patch.object(batch_job_launcher, "args", args), mock.patch.object(
+            batch_job_launcher, "alert_aggregator", aggregator
+        ):
+            for index in range(12):
+                batch_job_launcher.send_error_alert(
+                    sns_mock, f"error {index}", job_request
+                )
+            batch_job_launcher.send_error_alert(sns_mock, "error 0", job_request)
+
+            sns_mock.publish.assert_not_called()
+            batch_job_launcher.flush_error_alerts(sns_mock)
+
+        self.assertEqual(2, sns_mock.publish_batch.call_count)
+        entries = [
+            entry
+            for publish_call in sns_mock.publish_batch.call_args_list
+            for entry in publish_call[1]["PublishBatchRequestEntries"]
+        ]
+        self.assertEqual(12, len(entries))
+        payload = json.loads(entries[0]["Message"])
+        self.assertIn(
+            {"key": "Error", "value": "error 0 (2 occurrences)"},
+            payload["custom_elements"],
+        )
+        self.assertEqual(SNS_TOPIC_ARN, sns_mock.publish_batch.call_args[1]["TopicArn"])
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_circuit_breaker_opens_half_opens_and_closes(self, mock_logger):
+        now = [0]
+        breaker = batch_job_launcher.CircuitBreaker("test", 2, 30, clock=lambda: now[0])
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(batch_job_launcher.CIRCUIT_OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+
+        now[0] = 31
+        self.assertTrue(breaker.allow())
+        self.assertEqual(batch_job_launcher.CIRCUIT_HALF_OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(batch_job_launcher.CIRCUIT_OPEN, breaker.state)
+
+        now[0] = 62
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(batch_job_launcher.CIRCUIT_CLOSED, breaker.state)
+        self.assertEqual(0, breaker.failure_count)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_circuit_breaker_shares_state_through_store(self, mock_logger):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "circuit.db")
+            first = batch_job_launcher.CircuitBreaker(
+                "test", 1, 30, batch_job_launcher.SqliteCircuitBreakerStore(path)
+            )
+            second = batch_job_launcher.CircuitBreaker(
+                "test", 1, 30, batch_job_launcher.SqliteCircuitBreakerStore(path)
+            )
+
+            first.record_failure()
+
+            self.assertFalse(second.allow())
+            self.assertEqual(batch_job_launcher.CIRCUIT_OPEN, second.state)
+            first.store.connection.close()
+            second.store.connection.close()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_circuit_breaker_lets_one_container_make_the_trial(self, mock_logger):
+        now = [0]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "circuit.db")
+            first, second = [
+                batch_job_launcher.CircuitBreaker(
+                    "test",
+                    1,
+                    30,
+                    batch_job_launcher.SqliteCircuitBreakerStore(path),
+                    clock=lambda: now[0],
+                )
+                for _ in range(2)
+            ]
+
+            first.record_failure()
+            now[0] = 31
+            self.assertTrue(second.allow())
+            self.assertFalse(first.allow())
+            self.assertEqual(batch_job_launcher.CIRCUIT_HALF_OPEN, first.state)
+
+            # The second container never reports its trial, so it is claimed again
+            now[0] = 61
+            self.assertTrue(first.allow())
+            self.assertFalse(second.allow())
+            first.record_success()
+            self.assertTrue(second.allow())
+            first.store.connection.close()
+            second.store.connection.close()
+
+    def test_only_connection_errors_are_service_failures(self):
+        param_error = botocore.exceptions.ParamValidationError(report="bad value")
+
+        self.assertFalse(batch_job_launcher.is_service_failure(param_error))
+        self.assertFalse(batch_job_launcher.is_submission_ambiguous(param_error))
+        for connection_error in (
+            botocore.exceptions.EndpointConnectionError(endpoint_url="https://batch"),
+            botocore.exceptions.ConnectionClosedError(endpoint_url="https://batch"),
+            botocore.exceptions.ReadTimeoutError(endpoint_url="https://batch"),
+        ):
+            self.assertTrue(batch_job_launcher.is_service_failure(connection_error))
+            self.assertTrue(
+                batch_job_launcher.is_submission_ambiguous(connection_error)
+            )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_checks_circuit_before_offloading(self, mock_logger):
+        breaker = mock.MagicMock()
+        breaker.allow.return_value = False
+        offloader_mock = mock.MagicMock()
+
+        with mock.patch.object(
+            batch_job_launcher, "submit_circuit_breaker", breaker
+        ), mock.patch.object(batch_job_launcher, "parameter_offloader", offloader_mock):
+            with self.assertRaises(batch_job_launcher.SubmissionDeferredError):
+                batch_job_launcher.submit_batch_job(
+                    mock.MagicMock(),
+                    JOB_QUEUE_NAME,
+                    JOB_NAME,
+                    JOB_DEFINITION_NAME,
+                    {"manifest": "large"},
+                )
+
+            offloader_mock.offload.assert_not_called()
+
+            breaker.allow.return_value = True
+            offloader_mock.offload.side_effect = RuntimeError("s3 unavailable")
+            with self.assertRaises(RuntimeError):
+                batch_job_launcher.submit_batch_job(
+                    mock.MagicMock(),
+                    JOB_QUEUE_NAME,
+                    JOB_NAME,
+                    JOB_DEFINITION_NAME,
+                    {"manifest": "large"},
+                )
+
+        breaker.release_trial.assert_called_once()
+        breaker.record_failure.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_fails_fast_while_circuit_is_open(self, mock_logger):
+        breaker_args = argparse.Namespace(**vars(args))
+        breaker_args.circuit_breaker_failure_threshold = 1
+        batch_mock = mock.MagicMock()
+        batch_mock.submit_job.side_effect = botocore.exceptions.ClientError(
+            error_response={
+                "Error": {"Code": "ServerException", "Message": "unavailable"},
+                "ResponseMetadata": {"HTTPStatusCode": 503},
+            },
+            operation_name="SubmitJob",
+        )
+
+        breaker = batch_job_launcher.create_submit_circuit_breaker(breaker_args)
+
+        with mock.patch.object(batch_job_launcher, "submit_circuit_breaker", breaker):
+            with self.assertRaises(botocore.exceptions.ClientError):
+                batch_job_launcher.submit_batch_job(
+                    batch_mock, JOB_QUEUE_NAME, JOB_NAME, JOB_DEFINITION_NAME, None
+                )
+            with self.assertRaises(batch_job_launcher.SubmissionDeferredError):
+                batch_job_launcher.submit_batch_job(
+                    batch_mock, JOB_QUEUE_NAME, JOB_NAME, JOB_DEFINITION_NAME, None
+                )
+
+        batch_mock.submit_job.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_sqs_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_divert_deferred_events_sends_them_to_deferral_queue(
+        self, mock_logger, get_sqs_client_mock
+    ):
+        deferral_args = argparse.Namespace(**vars(args))
+        deferral_args.deferral_queue_url = "https://sqs/deferral"
+        sqs_mock = get_sqs_client_mock.return_value
+        sqs_mock.send_message_batch.return_value = {"Successful": [{"Id": "1"}]}
+        glue_events = [
+            ("message-1", {"correlation_id": "test_1"}),
+            ("message-2", {"correlation_id": "test_2"}),
+        ]
+        results = [
+            batch_job_launcher.generate_launch_result("message-1", job_id="job-1"),
+            batch_job_launcher.generate_launch_result(
+                "message-2", error_message="circuit open", deferred=True
+            ),
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", deferral_args):
+            diverted_results = batch_job_launcher.divert_deferred_events(
+                glue_events, results
+            )
+
+        sqs_mock.send_message_batch.assert_called_once_with(
+            QueueUrl="https://sqs/deferral",
+            Entries=[
+                {
+                    "Id": "1",
+                    "MessageBody": json.dumps({"correlation_id": "test_2"}),
+                    "DelaySeconds": 60,
+                }
+            ],
+        )
+        self.assertEqual(results[0], diverted_results[0])
+        self.assertFalse(diverted_results[1]["deferred"])
+        self.assertIsNone(diverted_results[1]["error_message"])
+
+    def test_batch_metadata_cache_pins_latest_active_revision(self):
+        now = [0.0]
+        batch_mock = mock.MagicMock()
+        batch_mock.describe_job_definitions.side_effect = [
+            {
+                "jobDefinitions": [
+                    {"revision": 3, "jobDefinitionArn": "arn:definition:3"}
+                ],
+                "nextToken": "page-2",
+            },
+            {
+                "jobDefinitions": [
+                    {"revision": 7, "jobDefinitionArn": "arn:definition:7"}
+                ]
+            },
+            {
+                "jobDefinitions": [
+                    {"revision": 8, "jobDefinitionArn": "arn:definition:8"}
+                ]
+            },
+        ]
+        cache = batch_job_launcher.BatchMetadataCache(
+            batch_mock, 60, clock=lambda: now[0]
+        )
+
+        self.assertEqual(
+            "arn:definition:7", cache.get_job_definition_arn(JOB_DEFINITION_NAME)
+        )
+        self.assertEqual(
+            "arn:definition:7", cache.get_job_definition_arn(JOB_DEFINITION_NAME)
+        )
+        self.assertEqual("pinned:2", cache.get_job_definition_arn("pinned:2"))
+        self.assertEqual(2, batch_mock.describe_job_definitions.call_count)
+        batch_mock.describe_job_definitions.assert_called_with(
+            jobDefinitionName=JOB_DEFINITION_NAME, status="ACTIVE", nextToken="page-2"
+        )
+
+        now[0] = 60
+        self.assertEqual(
+            "arn:definition:8", cache.get_job_definition_arn(JOB_DEFINITION_NAME)
+        )
+
+    def test_batch_metadata_cache_rejects_disabled_or_missing_queues(self):
+        batch_mock = self.generate_queue_router_batch_mock(
+            {"queue-1": 0, "queue-2": 0}, disabled_queues=["queue-2"]
+        )
+        cache = batch_job_launcher.BatchMetadataCache(batch_mock, 60)
+
+        cache.check_job_queue("queue-1")
+        cache.check_job_queue("arn:queue-1")
+        with self.assertRaises(batch_job_launcher.SubmissionRejectedError):
+            cache.check_job_queue("queue-2")
+        batch_mock.describe_job_queues.return_value = {"jobQueues": []}
+        with self.assertRaises(batch_job_launcher.SubmissionRejectedError):
+            cache.check_job_queue("queue-3")
+
+        self.assertEqual(4, batch_mock.describe_job_queues.call_count)
+        cache.check_job_queue("queue-1")
+        self.assertEqual(4, batch_mock.describe_job_queues.call_count)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_submits_pinned_job_definition_arn(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        metadata_args = argparse.Namespace(**vars(args))
+        metadata_args.batch_metadata_ttl_seconds = 60
+        batch_mock = self.generate_queue_router_batch_mock({JOB_QUEUE_NAME: 0})
+        batch_mock.describe_job_definitions.return_value = {
+            "jobDefinitions": [{"revision": 4, "jobDefinitionArn": "arn:definition:4"}]
+        }
+        submit_batch_job_mock.return_value = {"jobArn": "arn", "jobId": "id"}
+
+        with mock.patch.object(batch_job_launcher, "args", metadata_args):
+            batch_job_launcher.launch_batch_job(batch_mock, mock.MagicMock())
+
+        submit_batch_job_mock.assert_called_once_with(
+            batch_mock, JOB_QUEUE_NAME, JOB_NAME, "arn:definition:4", None
+        )
+        send_error_alert_mock.assert_not_called()
+
+    @mock.patch(
+        "batch_job_launcher_lambda.batch_job_launcher.launch_batch_job_for_record"
+    )
+    def test_async_engine_launches_records_with_bounded_concurrency(
+        self, launch_batch_job_for_record_mock
+    ):
+        engine_args = argparse.Namespace(**vars(args))
+        engine_args.batch_submit_engine = "asyncio"
+        engine_args.batch_submit_concurrency = 3
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def launch(batch_client, sns_client, glue_event, record_id):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return batch_job_launcher.generate_launch_result(record_id, job_id="job")
+
+        launch_batch_job_for_record_mock.side_effect = launch
+        glue_events = [
+            (f"message-{index}", {"correlation_id": f"test_{index}"})
+            for index in range(10)
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", engine_args):
+            results = batch_job_launcher.launch_batch_jobs(
+                mock.MagicMock(), mock.MagicMock(), glue_events
+            )
+
+        self.assertEqual(
+            [record_id for record_id, _ in glue_events],
+            [result["record_id"] for result in results],
+        )
+        self.assertLessEqual(in_flight[1], 3)
+        self.assertGreater(in_flight[1], 1)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_array_batch_job")
+    def test_async_engine_coalesces_records_into_array_jobs(
+        self, launch_array_batch_job_mock
+    ):
+        engine_args = argparse.Namespace(**vars(args))
+        engine_args.batch_submit_engine = "asyncio"
+        engine_args.batch_coalesce_max_events = 2
+        launch_array_batch_job_mock.side_effect = (
+            lambda batch_client, sns_client, coalesced_events: [
+                batch_job_launcher.generate_launch_result(record_id)
+                for record_id, _ in coalesced_events
+            ]
+        )
+        glue_events = [
+            (f"message-{index}", {"correlation_id": f"test_{index}"})
+            for index in range(5)
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", engine_args):
+            results = batch_job_launcher.launch_batch_jobs(None, None, glue_events)
+
+        self.assertEqual(3, launch_array_batch_job_mock.call_count)
+        self.assertEqual(
+            [record_id for record_id, _ in glue_events],
+            [result["record_id"] for result in results],
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    def test_async_engine_submit_batch_job_runs_on_executor(
+        self, submit_batch_job_mock
+    ):
+        submit_batch_job_mock.return_value = {"jobId": "id"}
+        engine = batch_job_launcher.AsyncSubmissionEngine(2)
+
+        response = engine.run(
+            engine.submit_batch_job,
+            "batch",
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            None,
+        )
+
+        self.assertEqual({"jobId": "id"}, response)
+        submit_batch_job_mock.assert_called_once_with(
+            "batch", JOB_QUEUE_NAME, JOB_NAME, JOB_DEFINITION_NAME, None
+        )
+        self.assertIsNone(engine.executor)
+
+    def test_routing_index_matches_exact_prefix_and_regex_routes_in_order(self):
+        routing_index = batch_job_launcher.RoutingIndex(
+            [
+                {"collection_name": "db.core.*", "jobs": [{"job_name": "prefix"}]},
+                {
+                    "collection_name": "db.core.contract",
+                    "snapshot_type": "full",
+                    "jobs": [{"job_name": "exact-full"}],
+                },
+                {
+                    "collection_name": "re:^db\\.(core|agent)\\.con",
+                    "jobs": [{"job_name": "regex"}, {"job_name": "regex-2"}],
+                },
+                {"collection_name": "db.*", "jobs": [{"job_name": "database"}]},
+            ]
+        )
+
+        def match(collection_name, snapshot_type="incremental"):
+            return [
+                job_spec["job_name"]
+                for job_spec in routing_index.match(
+                    {"collection_name": collection_name, "snapshot_type": snapshot_type}
+                )
+            ]
+
+        self.assertEqual(
+            ["prefix", "exact-full", "regex", "regex-2", "database"],
+            match("db.core.contract", "full"),
+        )
+        self.assertEqual(
+            ["prefix", "regex", "regex-2", "database"], match("db.core.contract")
+        )
+        self.assertEqual(["regex", "regex-2", "database"], match("db.agent.contact"))
+        self.assertEqual([], match("other.collection"))
+        self.assertEqual([], routing_index.match({"correlation_id": "test_1"}))
+
+    def test_routing_index_rejects_invalid_routes(self):
+        with self.assertRaises(ValueError):
+            batch_job_launcher.RoutingIndex([{"collection_name": "db.*", "jobs": []}])
+        with self.assertRaises(ValueError):
+            batch_job_launcher.RoutingIndex(
+                [{"collection_name": "db.*", "jobs": [{"job_queue_name": "typo"}]}]
+            )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_load_routing_index_reads_yaml_config(self, mock_logger):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "routes.yaml")
+            with open(path, "w") as config_file:
+                config_file.write(
+                    "routes:\n"
+                    "  - collection_name: db.core.*\n"
+                    "    jobs:\n"
+                    "      - job_definition_name: core-definition\n"
+                )
+
+            routing_index = batch_job_launcher.load_routing_index(path)
+
+        self.assertEqual(
+            [{"job_definition_name": "core-definition"}],
+            routing_index.match({"collection_name": "db.core.contract"}),
+        )
+
+    def test_build_job_request_applies_routed_job_spec(self):
+        template_args = argparse.Namespace(**vars(args))
+        template_args.batch_job_name_template = "default-{collection_name}"
+        job_spec = {
+            "job_queue": "routed-queue",
+            "job_name_template": "routed-{collection_name}",
+            "parameters_template": {"date": "{export_date}"},
+        }
+        glue_event = {"collection_name": "db.core", "export_date": "2020-01-22"}
+
+        with mock.patch.object(batch_job_launcher, "args", template_args):
+            job_request = batch_job_launcher.build_job_request(glue_event, job_spec)
+
+        self.assertEqual(
+            {
+                "job_queue": "routed-queue",
+                "job_name": "routed-db_core",
+                "job_definition_name": JOB_DEFINITION_NAME,
+                "parameters": {"date": "2020-01-22"},
+            },
+            job_request,
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_batch_job")
+    def test_launch_batch_jobs_fans_out_routed_events_and_merges_results(
+        self, launch_batch_job_mock
+    ):
+        routing_args = argparse.Namespace(**vars(args))
+        routing_args.batch_routing_config = "routes.json"
+        routing_index = batch_job_launcher.RoutingIndex(
+            [
+                {
+                    "collection_name": "db.core.*",
+                    "jobs": [
+                        {"job_definition_name": "first"},
+                        {"job_definition_name": "second"},
+                    ],
+                }
+            ]
+        )
+
+        def launch(batch_client, sns_client, glue_event, record_id, job_spec):
+            job_definition = job_spec["job_definition_name"] if job_spec else "default"
+            if job_definition == "second":
+                return batch_job_launcher.generate_launch_result(
+                    record_id, error_message="second failed"
+                )
+            return batch_job_launcher.generate_launch_result(
+                record_id, job_id=f"{record_id}-{job_definition}"
+            )
+
+        launch_batch_job_mock.side_effect = launch
+
+        with mock.patch.object(
+            batch_job_launcher, "args", routing_args
+        ), mock.patch.object(batch_job_launcher, "routing_index", routing_index):
+            results = batch_job_launcher.launch_batch_jobs(
+                None,
+                None,
+                [
+                    ("message-1", {"collection_name": "db.core.contract"}),
+                    ("message-2", {"collection_name": "db.other"}),
+                ],
+            )
+
+        self.assertEqual(3, launch_batch_job_mock.call_count)
+        self.assertEqual("second failed", results[0]["error_message"])
+        self.assertEqual(
+            ["message-1-first", None],
+            [job_result["job_id"] for job_result in results[0]["jobs"]],
+        )
+        self.assertIsNone(results[1]["error_message"])
+        self.assertEqual("message-2-default", results[1]["job_id"])
+        self.assertEqual(
+            {"batchItemFailures": [{"itemIdentifier": "message-1"}]},
+            batch_job_launcher.generate_batch_item_failures(results),
+        )
+
+    def test_scheduling_rules_apply_first_matching_rule(self):
+        compiled_rules = batch_job_launcher.compile_scheduling_rules(
+            [
+                {
+                    "match": {
+                        "snapshot_type": "incremental",
+                        "collection_name": ["db.core.*", "re:^db\\.agent\\."],
+                    },
+                    "scheduling_priority": 100,
+                    "share_identifier": "core",
+                },
+                {"match": {"snapshot_type": "incremental"}, "share_identifier": "inc"},
+                {"match": {}, "scheduling_priority": 1},
+            ]
+        )
+
+        def match(collection_name, snapshot_type):
+            return batch_job_launcher.match_scheduling_rules(
+                compiled_rules,
+                {"collection_name": collection_name, "snapshot_type": snapshot_type},
+            )
+
+        self.assertEqual(
+            {"scheduling_priority": 100, "share_identifier": "core"},
+            match("db.core.contract", "incremental"),
+        )
+        self.assertEqual(
+            {"scheduling_priority": 100, "share_identifier": "core"},
+            match("db.agent.todo", "incremental"),
+        )
+        self.assertEqual({"share_identifier": "inc"}, match("db.other", "incremental"))
+        self.assertEqual({"scheduling_priority": 1}, match("db.core.contract", "full"))
+        self.assertEqual(
+            {}, batch_job_launcher.match_scheduling_rules(compiled_rules[:2], {})
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_sends_scheduling_hints(self, mock_logger):
+        batch_mock = mock.MagicMock()
+
+        batch_job_launcher.submit_batch_job(
+            batch_mock,
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            None,
+            scheduling_priority=0,
+            share_identifier="incremental",
+        )
+
+        batch_mock.submit_job.assert_called_once_with(
+            jobName=JOB_NAME,
+            jobQueue=JOB_QUEUE_NAME,
+            jobDefinition=JOB_DEFINITION_NAME,
+            schedulingPriorityOverride=0,
+            shareIdentifier="incremental",
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_submits_scheduling_hints_of_glue_event(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        scheduling_args = argparse.Namespace(**vars(args))
+        scheduling_args.batch_scheduling_rules_json = [
+            {
+                "match": {"snapshot_type": "full"},
+                "scheduling_priority": 10,
+                "share_identifier": "full",
+            }
+        ]
+        submit_batch_job_mock.return_value = {"jobArn": "arn", "jobId": "id"}
+        batch_mock = mock.MagicMock()
+
+        with mock.patch.object(batch_job_launcher, "args", scheduling_args):
+            batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), {"snapshot_type": "full"}
+            )
+
+        submit_batch_job_mock.assert_called_once_with(
+            batch_mock,
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            None,
+            scheduling_priority=10,
+            share_identifier="full",
+        )
+        send_error_alert_mock.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_array_job_takes_scheduling_hints_of_most_urgent_event(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+    ):
+        scheduling_args = argparse.Namespace(**vars(args))
+        scheduling_args.batch_scheduling_rules_json = [
+            {
+                "match": {"snapshot_type": "incremental"},
+                "scheduling_priority": 100,
+                "share_identifier": "incremental",
+            },
+            {"match": {"snapshot_type": "full"}, "scheduling_priority": 10},
+        ]
+        submit_batch_job_mock.return_value = {"jobArn": "arn", "jobId": "id"}
+        batch_mock = mock.MagicMock()
+
+        with mock.patch.object(batch_job_launcher, "args", scheduling_args):
+            batch_job_launcher.launch_array_batch_job(
+                batch_mock,
+                mock.MagicMock(),
+                [
+                    ("message-1", {"snapshot_type": "full"}),
+                    ("message-2", {"snapshot_type": "incremental"}),
+                ],
+            )
+
+        self.assertEqual(
+            {
+                "array_size": 2,
+                "scheduling_priority": 100,
+                "share_identifier": "incremental",
+            },
+            submit_batch_job_mock.call_args[1],
+        )
+
+    def test_sqlite_outbox_store_tracks_pending_and_completed_entries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "outbox.db")
+            store = batch_job_launcher.SqliteOutboxStore(path)
+
+            self.assertIsNone(store.claim("entry-1", {"job_name": "job"}, 1000))
+            entry = store.claim("entry-1", {"job_name": "other"}, 2000)
+            self.assertEqual(batch_job_launcher.OUTBOX_PENDING, entry["status"])
+            self.assertEqual({"job_name": "job"}, entry["submission"])
+            self.assertEqual(1000, entry["attempted_at"])
+
+            self.assertEqual([], store.get_pending(1000))
+            store.release("entry-1")
+            self.assertEqual(["entry-1"], [e["entry_id"] for e in store.get_pending(1)])
+
+            store.complete("entry-1", "job-1", 3000)
+            store.connection.close()
+            store = batch_job_launcher.SqliteOutboxStore(path)
+
+            entry = store.claim("entry-1", {}, 4000)
+            self.assertEqual(("done", "job-1"), (entry["status"], entry["job_id"]))
+            self.assertEqual([], store.get_pending(5000))
+            self.assertEqual(0, store.remove_completed(3000))
+            self.assertEqual(1, store.remove_completed(3001))
+            store.connection.close()
+
+    def generate_outbox_args(self, directory):
+        outbox_args = argparse.Namespace(**vars(args))
+        outbox_args.outbox_store_path = os.path.join(directory, "outbox.db")
+        return outbox_args
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_writes_outbox_entry_around_submission(
+        self, mock_logger, submit_batch_job_mock
+    ):
+        glue_event = {"correlation_id": "test_1"}
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", self.generate_outbox_args(directory)
+        ):
+            entry_id = batch_job_launcher.generate_outbox_entry_id(
+                glue_event, batch_job_launcher.build_job_request(glue_event)
+            )
+            store = batch_job_launcher.get_outbox_store()
+
+            def submit(*arguments, **keyword_arguments):
+                entry = store.claim(entry_id, {}, 0)
+                self.assertEqual(batch_job_launcher.OUTBOX_PENDING, entry["status"])
+                return {"jobArn": "arn", "jobId": "job-1"}
+
+            submit_batch_job_mock.side_effect = submit
+            batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), glue_event
+            )
+            result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), glue_event
+            )
+
+            self.assertEqual(1, submit_batch_job_mock.call_count)
+            self.assertEqual("job-1", result["job_id"])
+            self.assertTrue(result["duplicate"])
+            store.connection.close()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_reconciles_interrupted_outbox_entry(
+        self, mock_logger, submit_batch_job_mock
+    ):
+        glue_event = {"correlation_id": "test_1"}
+        batch_mock = mock.MagicMock()
+        batch_mock.list_jobs.side_effect = [
+            {
+                "jobSummaryList": [{"jobId": "old-job", "createdAt": 0}],
+                "nextToken": "page-2",
+            },
+            {"jobSummaryList": [{"jobId": "job-1", "createdAt": time.time() * 1000}]},
+        ]
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", self.generate_outbox_args(directory)
+        ):
+            job_request = batch_job_launcher.build_job_request(glue_event)
+            entry_id = batch_job_launcher.generate_outbox_entry_id(
+                glue_event, job_request
+            )
+            store = batch_job_launcher.get_outbox_store()
+            store.claim(
+                entry_id,
+                batch_job_launcher.generate_outbox_submission(job_request, {}),
+                time.time(),
+            )
+
+            with self.assertRaises(batch_job_launcher.SubmissionDeferredError):
+                batch_job_launcher.open_outbox_entry(batch_mock, entry_id, {})
+
+            store.release(entry_id)
+            result = batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), glue_event
+            )
+
+            submit_batch_job_mock.assert_not_called()
+            self.assertEqual("job-1", result["job_id"])
+            batch_mock.list_jobs.assert_called_with(
+                jobQueue=JOB_QUEUE_NAME,
+                filters=[{"name": "JOB_NAME", "values": [JOB_NAME]}],
+                nextToken="page-2",
+            )
+            self.assertEqual("done", store.claim(entry_id, {}, 0)["status"])
+            store.connection.close()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_keeps_outbox_entry_only_for_ambiguous_failures(
+        self, mock_logger, submit_batch_job_mock, send_error_alert_mock
+    ):
+        def generate_client_error(status_code):
+            return botocore.exceptions.ClientError(
+                error_response={
+                    "Error": {"Code": "Error", "Message": "failed"},
+                    "ResponseMetadata": {"HTTPStatusCode": status_code},
+                },
+                operation_name="SubmitJob",
+            )
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", self.generate_outbox_args(directory)
+        ):
+            store = batch_job_launcher.get_outbox_store()
+
+            submit_batch_job_mock.side_effect = generate_client_error(400)
+            batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), {"correlation_id": "test_1"}
+            )
+            self.assertEqual([], store.get_pending(time.time()))
+
+            submit_batch_job_mock.side_effect = generate_client_error(500)
+            batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), {"correlation_id": "test_2"}
+            )
+            self.assertEqual(1, len(store.get_pending(1)))
+            store.connection.close()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_sweep_outbox_completes_found_jobs_and_resubmits_lost_ones(
+        self, mock_logger, submit_batch_job_mock
+    ):
+        batch_mock = mock.MagicMock()
+        batch_mock.list_jobs.side_effect = lambda **arguments: {
+            "jobSummaryList": (
+                [{"jobId": "found-job", "createdAt": time.time() * 1000}]
+                if arguments["filters"][0]["values"] == ["found"]
+                else []
+            )
+        }
+        batch_mock.describe_jobs.return_value = {
+            "jobs": [{"jobId": "found-job", "parameters": {"date": "2020-01-22"}}]
+        }
+        submit_batch_job_mock.return_value = {"jobArn": "arn", "jobId": "new-job"}
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            batch_job_launcher, "args", self.generate_outbox_args(directory)
+        ):
+            store = batch_job_launcher.get_outbox_store()
+            for job_name in ("found", "lost"):
+                store.claim(
+                    job_name,
+                    {
+                        "job_queue": JOB_QUEUE_NAME,
+                        "job_name": job_name,
+                        "job_definition_name": JOB_DEFINITION_NAME,
+                        "parameters": {"date": "2020-01-22"},
+                        "scheduling_hints": {"share_identifier": "share"},
+                    },
+                    time.time(),
+                )
+                store.release(job_name)
+
+            totals = batch_job_launcher.sweep_outbox(batch_mock, mock.MagicMock())
+
+            self.assertEqual(
+                {"reconciled": 1, "resubmitted": 1, "failed": 0, "pruned": 0}, totals
+            )
+            submit_batch_job_mock.assert_called_once_with(
+                batch_mock,
+                JOB_QUEUE_NAME,
+                "lost",
+                JOB_DEFINITION_NAME,
+                {"date": "2020-01-22"},
+                share_identifier="share",
+            )
+            self.assertEqual("found-job", store.claim("found", {}, 0)["job_id"])
+            self.assertEqual("new-job", store.claim("lost", {}, 0)["job_id"])
+            store.connection.close()
+
+    def test_parameter_offloader_stores_large_parameters_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = batch_job_launcher.FileParameterStore(directory)
+            offloader = batch_job_launcher.ParameterOffloader(store, 50)
+            small_parameters = {"date": "2020-01-22"}
+            large_parameters = {"manifest": json.dumps(["db.core.contract"] * 10)}
+
+            self.assertEqual(small_parameters, offloader.offload(small_parameters))
+
+            with mock.patch.object(store, "put", wraps=store.put) as put_mock:
+                pointer = offloader.offload(large_parameters)
+                self.assertEqual(pointer, offloader.offload(dict(large_parameters)))
+                self.assertEqual(
+                    pointer,
+                    batch_job_launcher.ParameterOffloader(store, 50).offload(
+                        large_parameters
+                    ),
+                )
+
+            put_mock.assert_called_once()
+            self.assertEqual(
+                pointer, offloader.get_submitted_parameters(large_parameters)
+            )
+
+            uri = pointer[batch_job_launcher.OFFLOADED_PARAMETERS_PARAMETER]
+            self.assertTrue(uri.startswith(f"file://{directory}/"))
+            with gzip.open(uri[len("file://") :]) as parameters_file:
+                self.assertEqual(large_parameters, json.load(parameters_file))
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_cached_s3_client")
+    def test_s3_parameter_store_uploads_without_checking_for_objects(
+        self, get_cached_s3_client_mock
+    ):
+        s3_mock = get_cached_s3_client_mock.return_value
+        offloader_args = argparse.Namespace(**vars(args))
+        offloader_args.batch_parameters_offload_uri = "s3://bucket/prefix"
+        offloader_args.batch_parameters_offload_threshold_bytes = 10
+
+        offloader = batch_job_launcher.create_parameter_offloader(offloader_args)
+
+        pointer = offloader.offload({"manifest": "a long manifest"})
+
+        key = s3_mock.put_object.call_args[1]["Key"]
+        self.assertTrue(key.startswith("prefix/") and key.endswith(".json.gz"))
+        self.assertEqual(
+            {"parameters_uri": f"s3://bucket/{key}"},
+            pointer,
+        )
+        self.assertEqual(
+            {"manifest": "a long manifest"},
+            json.loads(gzip.decompress(s3_mock.put_object.call_args[1]["Body"])),
+        )
+
+        offloader.offload({"manifest": "a long manifest"})
+        s3_mock.put_object.assert_called_once()
+        s3_mock.head_object.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_sends_pointer_to_offloaded_parameters(self, mock_logger):
+        batch_mock = mock.MagicMock()
+        offloader_mock = mock.MagicMock()
+        offloader_mock.offload.return_value = {"parameters_uri": "s3://bucket/key"}
+
+        with mock.patch.object(
+            batch_job_launcher, "parameter_offloader", offloader_mock
+        ):
+            batch_job_launcher.submit_batch_job(
+                batch_mock,
+                JOB_QUEUE_NAME,
+                JOB_NAME,
+                JOB_DEFINITION_NAME,
+                {"manifest": "[]"},
+            )
+
+        offloader_mock.offload.assert_called_once_with({"manifest": "[]"})
+        batch_mock.submit_job.assert_called_once_with(
+            jobName=JOB_NAME,
+            jobQueue=JOB_QUEUE_NAME,
+            jobDefinition=JOB_DEFINITION_NAME,
+            parameters={"parameters_uri": "s3://bucket/key"},
+        )
+
+    def test_get_parameters_returns_immutable_config(self):
+        with mock.patch.dict(
+            "os.environ", {"BATCH_JOB_QUEUE": JOB_QUEUE_NAME}, clear=True
+        ):
+            config = batch_job_launcher.get_parameters()
+
+        self.assertEqual(JOB_QUEUE_NAME, config.batch_job_queue)
+        self.assertIsNone(config.batch_job_name)
+        with self.assertRaises(AttributeError):
+            config.batch_job_queue = "test/other_queue"
+        with self.assertRaises(AttributeError):
+            config.undeclared_field = True
+
+        replaced = config.replace(batch_submit_concurrency=50)
+        self.assertEqual(50, replaced.batch_submit_concurrency)
+        self.assertEqual(10, config.batch_submit_concurrency)
+        with self.assertRaises(TypeError):
+            config.replace(undeclared_field=True)
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    def test_handler_rejects_incomplete_config_before_creating_clients(
+        self, setup_logging_mock, get_batch_client_mock
+    ):
+        environment = {
+            "MONITORING_SNS_TOPIC": SNS_TOPIC_ARN,
+            "BATCH_JOB_NAME": JOB_NAME,
+            "BATCH_SUBMIT_ENGINE": "processes",
+        }
+
+        with mock.patch.dict("os.environ", environment, clear=True):
+            for _ in range(2):
+                with self.assertRaises(batch_job_launcher.ConfigError) as context:
+                    batch_job_launcher.handler({"correlation_id": "test_1"}, None)
+
+        message = str(context.exception)
+        self.assertIn("BATCH_JOB_QUEUE is not set", message)
+        self.assertIn("BATCH_JOB_DEFINITION_NAME is not set", message)
+        self.assertIn("BATCH_SUBMIT_ENGINE", message)
+        self.assertNotIn("MONITORING_SNS_TOPIC", message)
+        self.assertIsNone(batch_job_launcher.args)
+        get_batch_client_mock.assert_not_called()
+
+    def test_glue_event_validator_checks_required_fields_and_patterns(self):
+        validator = batch_job_launcher.GlueEventValidator(
+            {"collection_name": None, "export_date": r"\d{4}-\d{2}-\d{2}"}
+        )
+        glue_event = {"collection_name": "db.core", "export_date": "2020-01-22"}
+
+        self.assertIsNone(validator.validate(glue_event))
+        self.assertEqual("Event is not a json object", validator.validate(None))
+        self.assertIn(
+            "'collection_name' is missing",
+            validator.validate(dict(glue_event, collection_name="")),
+        )
+        self.assertIn(
+            "'collection_name' is not a single value",
+            validator.validate(dict(glue_event, collection_name=["db.core"])),
+        )
+        self.assertIn(
+            "'export_date' has an unexpected value",
+            validator.validate(dict(glue_event, export_date="2020-01-22T00")),
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_cached_clients")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_process_event_rejects_invalid_glue_event_before_creating_clients(
+        self, mock_logger, get_cached_clients_mock
+    ):
+        template_args = argparse.Namespace(**vars(args))
+        template_args.batch_job_name_template = "reconciliation-{collection_name}"
+        template_args.glue_event_schema_json = {"snapshot_type": "full|incremental"}
+
+        with mock.patch.object(batch_job_launcher, "args", template_args):
+            with self.assertRaises(batch_job_launcher.InvalidEventError) as context:
+                batch_job_launcher.process_event({"snapshot_type": "full"}, None, False)
+            self.assertIn("collection_name", str(context.exception))
+
+            with self.assertRaises(batch_job_launcher.InvalidEventError):
+                batch_job_launcher.process_event(
+                    {"collection_name": "db.core", "snapshot_type": "partial"},
+                    None,
+                    False,
+                )
+
+        get_cached_clients_mock.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.launch_batch_jobs")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_cached_clients")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_process_event_fails_only_malformed_records(
+        self, mock_logger, get_cached_clients_mock, launch_batch_jobs_mock
+    ):
+        get_cached_clients_mock.return_value = (mock.MagicMock(), mock.MagicMock())
+        launch_batch_jobs_mock.side_effect = lambda batch, sns, glue_events: [
+            batch_job_launcher.generate_launch_result(record_id, job_id="job")
+            for record_id, _ in glue_events
+        ]
+        event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": f"message-{index}",
+                    "body": body,
+                }
+                for index, body in enumerate(
+                    [json.dumps({"correlation_id": "test_0"}), "{not json", "[]"]
+                )
+            ]
+        }
+
+        with mock.patch.object(batch_job_launcher, "args", args):
+            response = batch_job_launcher.process_event(event, None, False)
+
+        self.assertEqual(
+            {
+                "batchItemFailures": [
+                    {"itemIdentifier": "message-1"},
+                    {"itemIdentifier": "message-2"},
+                ]
+            },
+            response,
+        )
+        launch_batch_jobs_mock.assert_called_once_with(
+            mock.ANY, mock.ANY, [("message-0", {"correlation_id": "test_0"})]
+        )
+
+    def test_compile_pipeline_orders_stages_and_rejects_invalid_ones(self):
+        stages = batch_job_launcher.compile_pipeline(
+            [
+                {
+                    "stage": "report",
+                    "job_name": "report",
+                    "depends_on": ["compare"],
+                },
+                {"stage": "query", "job_name": "query"},
+                {
+                    "stage": "compare",
+                    "job_name": "compare",
+                    "depends_on": [{"stage": "query", "type": "N_TO_N"}],
+                },
+            ]
+        )
+
+        self.assertEqual(
+            [
+                ("query", {"job_name": "query"}, []),
+                ("compare", {"job_name": "compare"}, [("query", "N_TO_N")]),
+                ("report", {"job_name": "report"}, [("compare", None)]),
+            ],
+            stages,
+        )
+
+        for invalid_stages in (
+            [],
+            [{"job_name": "unnamed"}],
+            [{"stage": "query", "job_queue_arn": "queue"}],
+            [{"stage": "query"}, {"stage": "compare"}],
+            [{"stage": "query", "depends_on": ["missing"]}],
+            [{"stage": "query", "depends_on": [{"stage": "query", "type": "ALL"}]}],
+            [
+                {"stage": "query", "job_name": "query", "depends_on": ["compare"]},
+                {"stage": "compare", "job_name": "compare", "depends_on": ["query"]},
+            ],
+        ):
+            with self.assertRaises(ValueError):
+                batch_job_launcher.compile_pipeline(invalid_stages)
+
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.batch_pipeline_json = [{"stage": "query", "depends_on": ["x"]}]
+        with self.assertRaises(batch_job_launcher.ConfigError) as context:
+            batch_job_launcher.validate_config(pipeline_args)
+        self.assertIn("BATCH_PIPELINE_JSON", str(context.exception))
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_submits_pipeline_stages_depending_on_each_other(
+        self,
+        mock_logger,
+        send_error_alert_mock,
+    ):
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.batch_pipeline_json = [
+            {"stage": "query", "job_name": "query"},
+            {
+                "stage": "compare",
+                "job_name_template": "compare-{collection_name}",
+                "depends_on": [{"stage": "query", "type": "N_TO_N"}],
+            },
+            {"stage": "report", "job_name": "report", "depends_on": ["compare"]},
+        ]
+        batch_mock = mock.MagicMock()
+        batch_mock.submit_job.side_effect = [
+            {"jobArn": f"arn-{job_id}", "jobId": job_id}
+            for job_id in ("query-id", "compare-id", "report-id")
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", pipeline_args):
+            result = batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), {"collection_name": "db.core"}, "1"
+            )
+
+        submitted = [call[1] for call in batch_mock.submit_job.call_args_list]
+        self.assertEqual(
+            ["query", "compare-db_core", "report"],
+            [arguments["jobName"] for arguments in submitted],
+        )
+        self.assertNotIn("dependsOn", submitted[0])
+        self.assertEqual([{"jobId": "query-id"}], submitted[1]["dependsOn"])
+        self.assertEqual([{"jobId": "compare-id"}], submitted[2]["dependsOn"])
+
+        self.assertEqual("report-id", result["job_id"])
+        self.assertIsNone(result["error_message"])
+        self.assertEqual(
+            ["query", "compare", "report"], [job["stage"] for job in result["jobs"]]
+        )
+        send_error_alert_mock.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_launch_batch_job_stops_pipeline_at_failed_stage(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.batch_pipeline_json = [
+            {"stage": "query", "job_name": "query"},
+            {"stage": "compare", "job_name": "compare", "depends_on": ["query"]},
+            {"stage": "report", "job_name": "report", "depends_on": ["compare"]},
+        ]
+        submit_batch_job_mock.side_effect = [
+            {"jobArn": "arn", "jobId": "query-id"},
+            botocore.exceptions.ClientError(
+                error_response={"Error": {"Code": "Client", "Message": "refused"}},
+                operation_name="SubmitJob",
+            ),
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", pipeline_args):
+            result = batch_job_launcher.launch_batch_job(
+                mock.MagicMock(), mock.MagicMock(), {"collection_name": "db.core"}
+            )
+
+        self.assertEqual(2, submit_batch_job_mock.call_count)
+        self.assertEqual(
+            [{"jobId": "query-id"}], submit_batch_job_mock.call_args[1]["depends_on"]
+        )
+        self.assertEqual("refused", result["error_message"])
+        self.assertIsNone(result["job_id"])
+        self.assertEqual(["query", "compare"], [job["stage"] for job in result["jobs"]])
+        send_error_alert_mock.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_failed_pipeline_terminates_submitted_stages_unless_resumable(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.batch_pipeline_json = [
+            {"stage": "query", "job_name": "query"},
+            {"stage": "compare", "job_name": "compare", "depends_on": ["query"]},
+        ]
+        refused = botocore.exceptions.ClientError(
+            error_response={"Error": {"Code": "Client", "Message": "refused"}},
+            operation_name="SubmitJob",
+        )
+        submit_batch_job_mock.side_effect = [
+            {"jobArn": "arn", "jobId": "query-id"},
+            refused,
+            {"jobArn": "arn", "jobId": "keyed-query-id"},
+            refused,
+        ]
+        batch_mock = mock.MagicMock()
+
+        with mock.patch.object(batch_job_launcher, "args", pipeline_args):
+            batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), {"export_date": "1"}
+            )
+            batch_mock.terminate_job.assert_called_once_with(
+                jobId="query-id", reason="Pipeline submission failed: refused"
+            )
+
+            pipeline_args.idempotency_key_fields = ["export_date"]
+            batch_job_launcher.launch_batch_job(
+                batch_mock, mock.MagicMock(), {"export_date": "2"}
+            )
+
+        batch_mock.terminate_job.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_array_pipeline_stages_depend_child_by_child(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+    ):
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.batch_pipeline_json = [
+            {"stage": "query", "job_name": "query"},
+            {
+                "stage": "compare",
+                "job_name": "compare",
+                "parameters": {"mode": "strict"},
+                "depends_on": [{"stage": "query", "type": "N_TO_N"}],
+            },
+            {"stage": "report", "job_name": "report", "depends_on": ["compare"]},
+        ]
+        submit_batch_job_mock.side_effect = [
+            {"jobArn": f"arn-{job_id}", "jobId": job_id}
+            for job_id in ("query-id", "compare-id", "report-id")
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", pipeline_args):
+            results = batch_job_launcher.launch_array_batch_job(
+                mock.MagicMock(),
+                mock.MagicMock(),
+                [
+                    ("message-1", {"export_date": "1"}),
+                    ("message-2", {"export_date": "2"}),
+                ],
+            )
+
+        calls = submit_batch_job_mock.call_args_list
+        self.assertEqual(["query", "compare", "report"], [call[0][2] for call in calls])
+        self.assertEqual(calls[0][0][4]["manifest"], calls[1][0][4]["manifest"])
+        self.assertEqual("strict", calls[1][0][4]["mode"])
+        self.assertEqual({"array_size": 2}, calls[0][1])
+        self.assertEqual(
+            {
+                "array_size": 2,
+                "depends_on": [{"jobId": "query-id", "type": "N_TO_N"}],
+            },
+            calls[1][1],
+        )
+        self.assertEqual(
+            {"array_size": 2, "depends_on": [{"jobId": "compare-id"}]}, calls[2][1]
+        )
+        self.assertEqual(
+            ["report-id:0", "report-id:1"], [result["job_id"] for result in results]
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    def test_handler_fails_every_invocation_while_circuit_breaker_store_is_unusable(
+        self, setup_logging_mock, get_batch_client_mock
+    ):
+        environment = {
+            "MONITORING_SNS_TOPIC": SNS_TOPIC_ARN,
+            "BATCH_JOB_QUEUE": JOB_QUEUE_NAME,
+            "BATCH_JOB_NAME": JOB_NAME,
+            "BATCH_JOB_DEFINITION_NAME": JOB_DEFINITION_NAME,
+            "CIRCUIT_BREAKER_FAILURE_THRESHOLD": "1",
+            "CIRCUIT_BREAKER_STORE_PATH": "/nonexistent/directory/breaker.db",
+        }
+
+        with mock.patch.dict("os.environ", environment, clear=True):
+            for _ in range(2):
+                with self.assertRaises(sqlite3.Error):
+                    batch_job_launcher.handler({"correlation_id": "test_1"}, None)
+
+        self.assertIsNone(batch_job_launcher.args)
+        self.assertIsNone(batch_job_launcher.submit_circuit_breaker)
+        get_batch_client_mock.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.get_batch_client")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.setup_logging")
+    def test_handler_rejects_invalid_offload_uri_on_every_invocation(
+        self, setup_logging_mock, get_batch_client_mock
+    ):
+        environment = {
+            "MONITORING_SNS_TOPIC": SNS_TOPIC_ARN,
+            "BATCH_JOB_QUEUE": JOB_QUEUE_NAME,
+            "BATCH_JOB_NAME": JOB_NAME,
+            "BATCH_JOB_DEFINITION_NAME": JOB_DEFINITION_NAME,
+            "BATCH_PARAMETERS_OFFLOAD_URI": "gs://bucket/parameters",
+        }
+
+        with mock.patch.dict("os.environ", environment, clear=True):
+            for _ in range(2):
+                with self.assertRaises(batch_job_launcher.ConfigError) as context:
+                    batch_job_launcher.handler({"correlation_id": "test_1"}, None)
+
+        self.assertIn("BATCH_PARAMETERS_OFFLOAD_URI", str(context.exception))
+        self.assertIsNone(batch_job_launcher.parameter_offloader)
+        get_batch_client_mock.assert_not_called()
+
+    def test_apply_config_sizes_connection_pool_and_creates_metrics(self):
+        config_args = argparse.Namespace(**vars(args))
+        config_args.batch_submit_concurrency = 250
+        config_args.metrics_namespace = "Reconciliation"
+        config_args.batch_submit_rate_per_second = 20
+        config = batch_job_launcher.Config(**vars(config_args))
+
+        with mock.patch.object(
+            batch_job_launcher,
+            "boto_client_config",
+            batch_job_launcher.boto_client_config,
+        ):
+            batch_job_launcher.apply_config(config)
+
+            self.assertEqual(
+                250, batch_job_launcher.boto_client_config.max_pool_connections
+            )
+
+        self.assertIs(config, batch_job_launcher.args)
+        self.assertIsNotNone(batch_job_launcher.metrics)
+        self.assertIsNotNone(batch_job_launcher.batch_submit_rate_limiter)
+
+    def test_concurrent_first_claims_share_one_idempotency_cache(self):
+        cache_class = batch_job_launcher.IdempotencyCache
+
+        def create_cache_slowly(*arguments):
+            time.sleep(0.05)
+            return cache_class(*arguments)
+
+        barrier = threading.Barrier(5)
+
+        def claim():
+            barrier.wait()
+            return batch_job_launcher.claim_idempotency_key("key")
+
+        with mock.patch.object(batch_job_launcher, "args", args), mock.patch.object(
+            batch_job_launcher, "IdempotencyCache", side_effect=create_cache_slowly
+        ) as cache_mock:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+                claims = list(executor.map(lambda _: claim(), range(5)))
+
+        cache_mock.assert_called_once()
+        self.assertEqual(1, claims.count(None))
+        self.assertEqual(4, claims.count(batch_job_launcher.PENDING_JOB_ID))
+
+    def test_registered_idempotency_store_survives_config_rebuilds(self):
+        class DictStore:
+            def __init__(self):
+                self.job_ids = {}
+
+            def get(self, key, now):
+                return self.job_ids.get(key)
+
+            def put(self, key, job_id, expires_at):
+                self.job_ids[key] = job_id
+
+            def remove(self, key):
+                self.job_ids.pop(key, None)
+
+        store = DictStore()
+        factory = mock.MagicMock(return_value=store)
+        config = batch_job_launcher.Config(**vars(args))
+
+        batch_job_launcher.set_idempotency_store_factory(factory)
+        try:
+            batch_job_launcher.apply_config(config)
+            self.assertIsNone(batch_job_launcher.claim_idempotency_key("key"))
+            batch_job_launcher.record_idempotency_key("key", "job-1")
+
+            batch_job_launcher.apply_config(config)
+            self.assertEqual("job-1", batch_job_launcher.claim_idempotency_key("key"))
+        finally:
+            batch_job_launcher.set_idempotency_store_factory(None)
+
+        self.assertEqual({"key": "job-1"}, store.job_ids)
+        factory.assert_called_with(config)
+        self.assertEqual(2, factory.call_count)
+
+    def test_registered_outbox_store_survives_config_rebuilds(self):
+        store = batch_job_launcher.SqliteOutboxStore(":memory:")
+        factory = mock.MagicMock(return_value=store)
+        config = batch_job_launcher.Config(**vars(args))
+
+        batch_job_launcher.set_outbox_store_factory(factory)
+        try:
+            for _ in range(2):
+                batch_job_launcher.apply_config(config)
+                self.assertIs(store, batch_job_launcher.get_outbox_store())
+                self.assertIsNotNone(
+                    batch_job_launcher.generate_outbox_entry_id(
+                        {"correlation_id": "test_1"}, {"job_name": JOB_NAME}
+                    )
+                )
+        finally:
+            batch_job_launcher.set_outbox_store_factory(None)
+            store.connection.close()
+
+        factory.assert_called_with(config)
+        self.assertEqual(2, factory.call_count)
+        self.assertIsNone(batch_job_launcher.get_outbox_store())
+
+    def test_get_parameters_reports_every_malformed_environment_variable(self):
+        environment = {
+            "BATCH_SUBMIT_CONCURRENCY": "ten",
+            "BATCH_SCHEDULING_RULES_JSON": "[{",
+            "DEFERRAL_DELAY_SECONDS": "soon",
+        }
+
+        with mock.patch.dict("os.environ", environment, clear=True):
+            with self.assertRaises(batch_job_launcher.ConfigError) as context:
+                batch_job_launcher.get_parameters()
+
+        message = str(context.exception)
+        for variable in environment:
+            self.assertIn(f"{variable} is invalid", message)
+
+    def test_validate_config_rejects_coalescing_above_the_array_size_limit(self):
+        config_args = argparse.Namespace(**vars(args))
+        config_args.batch_coalesce_max_events = batch_job_launcher.MAX_ARRAY_SIZE
+
+        batch_job_launcher.validate_config(config_args)
+
+        config_args.batch_coalesce_max_events += 1
+        with self.assertRaises(batch_job_launcher.ConfigError) as context:
+            batch_job_launcher.validate_config(config_args)
+
+        self.assertIn(
+            "BATCH_COALESCE_MAX_EVENTS must not be above 10000", str(context.exception)
+        )
+
+    def test_validate_config_checks_rules_routing_and_json_objects(self):
+        config_args = argparse.Namespace(**vars(args))
+        config_args.batch_scheduling_rules_json = [
+            {"match": {"snapshot_type": 5}, "scheduling_priority": 1}
+        ]
+        config_args.batch_routing_config = "/nonexistent/routes.json"
+        config_args.batch_parameters_json = ["not", "an", "object"]
+
+        with self.assertRaises(batch_job_launcher.ConfigError) as context:
+            batch_job_launcher.validate_config(config_args)
+
+        message = str(context.exception)
+        self.assertIn("BATCH_SCHEDULING_RULES_JSON is invalid", message)
+        self.assertIn("BATCH_ROUTING_CONFIG /nonexistent/routes.json", message)
+        self.assertIn("BATCH_PARAMETERS_JSON must be a json object", message)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as routing_file:
+            json.dump({"routes": [{"collection_name": "db.*"}]}, routing_file)
+            routing_file.flush()
+            config_args.batch_scheduling_rules_json = [{"scheduling_priority": 1}]
+            config_args.batch_routing_config = routing_file.name
+            config_args.batch_parameters_json = None
+
+            with self.assertRaises(batch_job_launcher.ConfigError) as context:
+                batch_job_launcher.validate_config(config_args)
+
+        self.assertEqual(
+            f"Invalid config: BATCH_ROUTING_CONFIG {routing_file.name} is invalid: "
+            "Route 0 needs a collection_name and jobs",
+            str(context.exception),
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_array_job_is_named_from_template_when_no_job_name_is_set(
+        self,
+        mock_logger,
+        send_error_alert_mock,
+    ):
+        template_args = argparse.Namespace(**vars(args))
+        template_args.batch_job_name = None
+        template_args.batch_job_name_template = "reconciliation-{collection_name}"
+        batch_mock = mock.MagicMock()
+        batch_mock.submit_job.return_value = {"jobArn": "arn", "jobId": "id"}
+
+        with mock.patch.object(batch_job_launcher, "args", template_args):
+            batch_job_launcher.validate_config(template_args)
+            results = batch_job_launcher.launch_array_batch_job(
+                batch_mock,
+                mock.MagicMock(),
+                [
+                    (f"message-{index}", {"collection_name": f"db.core.{index}"})
+                    for index in range(3)
+                ],
+            )
+
+        self.assertEqual(
+            "reconciliation-db_core_0", batch_mock.submit_job.call_args[1]["jobName"]
+        )
+        self.assertEqual(["id:0", "id:1", "id:2"], [r["job_id"] for r in results])
+        send_error_alert_mock.assert_not_called()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.send_error_alert")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.submit_batch_job")
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_failed_array_pipeline_terminates_submitted_stages(
+        self,
+        mock_logger,
+        submit_batch_job_mock,
+        send_error_alert_mock,
+    ):
+        pipeline_args = argparse.Namespace(**vars(args))
+        pipeline_args.idempotency_key_fields = ["export_date"]
+        pipeline_args.batch_pipeline_json = [
+            {"stage": "query", "job_name": "query"},
+            {
+                "stage": "compare",
+                "job_name": "compare",
+                "depends_on": [{"stage": "query", "type": "N_TO_N"}],
+            },
+        ]
+        submit_batch_job_mock.side_effect = [
+            {"jobArn": "arn", "jobId": "query-id"},
+            botocore.exceptions.ClientError(
+                error_response={"Error": {"Code": "Client", "Message": "refused"}},
+                operation_name="SubmitJob",
+            ),
+            {"jobArn": "arn", "jobId": "retried-query-id"},
+            {"jobArn": "arn", "jobId": "retried-compare-id"},
+        ]
+        batch_mock = mock.MagicMock()
+        glue_events = [
+            ("message-1", {"export_date": "1"}),
+            ("message-2", {"export_date": "2"}),
+        ]
+
+        with mock.patch.object(batch_job_launcher, "args", pipeline_args):
+            results = batch_job_launcher.launch_array_batch_job(
+                batch_mock, mock.MagicMock(), glue_events
+            )
+            batch_mock.terminate_job.assert_called_once_with(
+                jobId="query-id", reason="Array job submission failed: refused"
+            )
+            self.assertEqual(
+                ["refused", "refused"], [r["error_message"] for r in results]
+            )
+
+            retried_results = batch_job_launcher.launch_array_batch_job(
+                batch_mock, mock.MagicMock(), glue_events
+            )
+
+        self.assertEqual(4, submit_batch_job_mock.call_count)
+        self.assertEqual(
+            ["retried-compare-id:0", "retried-compare-id:1"],
+            [result["job_id"] for result in retried_results],
+        )
+        batch_mock.terminate_job.assert_called_once()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_flush_error_alerts_puts_back_alerts_it_could_not_publish(
+        self, mock_logger
+    ):
+        sns_mock = mock.MagicMock()
+        sns_mock.publish_batch.side_effect = [
+            {"Successful": [{"Id": str(index)} for index in range(10)]},
+            botocore.exceptions.EndpointConnectionError(endpoint_url="https://sns"),
+            {"Successful": [{"Id": "0"}, {"Id": "1"}]},
+        ]
+        aggregator = batch_job_launcher.AlertAggregator(300)
+        job_request = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+        }
+
+        with mock.patch.object(batch_job_launcher, "args", args), mock.patch.object(
+            batch_job_launcher, "alert_aggregator", aggregator
+        ):
+            for index in range(12):
+                batch_job_launcher.send_error_alert(
+                    sns_mock, f"error {index}", job_request
+                )
+
+            batch_job_launcher.flush_error_alerts(sns_mock)
+            self.assertEqual(
+                {"error 10", "error 11"},
+                {alert["error_message"] for alert in aggregator.pending.values()},
+            )
+
+            batch_job_launcher.send_error_alert(sns_mock, "error 10", job_request)
+            batch_job_launcher.flush_error_alerts(sns_mock)
+
+        self.assertEqual({}, aggregator.pending)
+        messages = [
+            json.loads(entry["Message"])
+            for entry in sns_mock.publish_batch.call_args[1][
+                "PublishBatchRequestEntries"
+            ]
+        ]
+        self.assertIn(
+            {"key": "Error", "value": "error 10 (2 occurrences)"},
+            messages[0]["custom_elements"],
+        )
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_flush_error_alerts_puts_back_alerts_sns_reported_as_failed(
+        self, mock_logger
+    ):
+        sns_mock = mock.MagicMock()
+        sns_mock.publish_batch.side_effect = [
+            {
+                "Successful": [{"Id": "0"}],
+                "Failed": [{"Id": "1", "Code": "InternalError", "SenderFault": False}],
+            },
+            {"Successful": [{"Id": "0"}]},
+        ]
+        aggregator = batch_job_launcher.AlertAggregator(300)
+        job_request = {
+            "job_queue": JOB_QUEUE_NAME,
+            "job_name": JOB_NAME,
+            "job_definition_name": JOB_DEFINITION_NAME,
+        }
+
+        with mock.patch.object(batch_job_launcher, "args", args), mock.patch.object(
+            batch_job_launcher, "alert_aggregator", aggregator
+        ):
+            batch_job_launcher.send_error_alert(sns_mock, "error 0", job_request)
+            batch_job_launcher.send_error_alert(sns_mock, "error 1", job_request)
+
+            batch_job_launcher.flush_error_alerts(sns_mock)
+            self.assertEqual(
+                ["error 1"],
+                [alert["error_message"] for alert in aggregator.pending.values()],
+            )
+
+            batch_job_launcher.flush_error_alerts(sns_mock)
+
+        self.assertEqual({}, aggregator.pending)
+        (entry,) = sns_mock.publish_batch.call_args[1]["PublishBatchRequestEntries"]
+        self.assertIn(
+            {"key": "Error", "value": "error 1"},
+            json.loads(entry["Message"])["custom_elements"],
+        )
+
+    def test_sqlite_idempotency_store_persists_keys(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "idempotency.db")
+
+            batch_job_launcher.SqliteIdempotencyStore(path).put("key-1", "job-1", 2000)
+            store = batch_job_launcher.SqliteIdempotencyStore(path)
+
+            self.assertEqual("job-1", store.get("key-1", 1000))
+            self.assertIsNone(store.get("key-1", 3000))
+
+            store.remove("key-1")
+            self.assertIsNone(store.get("key-1", 1000))
+            store.connection.close()
+
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_sends_right_message_with_parameters(
+        self,
+        mock_logger,
+    ):
+        batch_mock = mock.MagicMock()
+        batch_mock.submit_job = mock.MagicMock()
 
         parameters = '{"test_key": "test_value"}'
 
@@ -359,6 +3275,33 @@ class TestRetriever(unittest.TestCase):
             parameters=parameters,
         )
 
+    @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
+    def test_submit_batch_job_sends_right_message_for_array_job(
+        self,
+        mock_logger,
+    ):
+        batch_mock = mock.MagicMock()
+        batch_mock.submit_job = mock.MagicMock()
+
+        parameters = {"manifest": "[]"}
+
+        batch_job_launcher.submit_batch_job(
+            batch_mock,
+            JOB_QUEUE_NAME,
+            JOB_NAME,
+            JOB_DEFINITION_NAME,
+            parameters,
+            array_size=5,
+        )
+
+        batch_mock.submit_job.assert_called_once_with(
+            jobName=JOB_NAME,
+            jobQueue=JOB_QUEUE_NAME,
+            jobDefinition=JOB_DEFINITION_NAME,
+            parameters=parameters,
+            arrayProperties={"size": 5},
+        )
+
     @mock.patch("batch_job_launcher_lambda.batch_job_launcher.logger")
     def test_submit_batch_job_sends_right_message_without_parameters(
         self,